@@ -1,7 +1,8 @@
 import os
 import logging
 import traceback  # 导入 traceback 模块
-import logging.handlers
+
+from .fog_log import setup_logging
 
 def setup_logger(logger_name: str = 'ComfyFog', log_dir: str = 'logs') -> logging.Logger:
     """
@@ -19,26 +20,10 @@ def setup_logger(logger_name: str = 'ComfyFog', log_dir: str = 'logs') -> loggin
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
-    # 配置日志
+    # 配置日志：JSON 格式，经队列由后台线程写入回滚文件，DEBUG 日志按调用位置限流
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
-
-    # 添加回滚文件处理器
     log_file = os.path.join(log_dir, f'{logger_name.lower()}.log')
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_file,
-        maxBytes=5 * 1024 * 1024,
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setLevel(logging.DEBUG)
-
-    # 设置日志格式
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-
-    # 将处理器添加到logger
-    logger.addHandler(file_handler)
+    setup_logging(logger, log_file, level=logging.INFO)
     
     logger.info(f"{logger_name} logger initialized")
     return logger
@@ -54,29 +39,31 @@ try:
     if not os.path.exists(WEB_DIRECTORY):
         os.makedirs(WEB_DIRECTORY)
         
-    # 2. 导入核心组件
-    from .fog_server import ROUTES
-    from .fog_manager import FogManager  # 新的管理类
+    # 2. 导入核心组件，调度器、HTTP 客户端等在 FogManager 创建时才加载
+    from .fog_server import ROUTES, register_routes, start_on_server_startup
+    from .fog_capture import FogMemorySaveImage
 
-    # 3. 初始化fog管理器
-    fog_manager = FogManager()
+    # 3. 注册路由，FogManager 在 ComfyUI 服务启动或首次访问 /fog 路由时创建
+    from server import PromptServer
+    if PromptServer.instance is not None:
+        register_routes(PromptServer.instance)
+        start_on_server_startup(PromptServer.instance)
+    else:
+        logger.warning("PromptServer instance not available, ComfyFog not started")
 
     logger.info("ComfyFog initialized Success")
 
     # 4. 定义节点映射
     NODE_CLASS_MAPPINGS = {
         # "节点名称": 节点类
-        # 例如:
-        # "FogNode": FogNode
+        "FogMemorySaveImage": FogMemorySaveImage    # Fog 任务内存输出，由调度器替换 SaveImage 使用
     }
 
     # 可选：添加节点类别映射
-    NODE_DISPLAY_NAME_MAPPINGS = {
-        # "FogNode": "Fog Node"
-    }
+    NODE_DISPLAY_NAME_MAPPINGS = {}     # FogMemorySaveImage 为内部节点，不提供显示名称
 
     # 5. 导出必要的变量
-    __all__ = ['WEB_DIRECTORY', 'ROUTES', 'fog_manager', 'NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
+    __all__ = ['WEB_DIRECTORY', 'ROUTES', 'NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
 
 except Exception as e:
     logger.error(f"ComfyFog Error initializing : {e}")
@@ -0,0 +1,275 @@
+import os
+import time
+import logging
+import threading
+
+from typing import Optional, Dict, Any
+from collections import deque
+
+from .fog_affinity import extract_model_refs
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+MB = 1024 * 1024
+
+
+class ComfyMemoryBackend:
+    """通过 comfy.model_management 获取 ComfyUI 推理设备的显存（CPU 模式下为内存）"""
+
+    def free_memory(self) -> int:
+        import comfy.model_management
+        return comfy.model_management.get_free_memory()
+
+    def total_memory(self) -> int:
+        import comfy.model_management
+        return comfy.model_management.get_total_memory()
+
+    def freeable_memory(self) -> int:
+        """ComfyUI 缓存的已加载模型占用的显存，需要时 ComfyUI 会将其卸载"""
+        import comfy.model_management
+        device = comfy.model_management.get_torch_device()
+        freeable = 0
+        for loaded in list(comfy.model_management.current_loaded_models):
+            if getattr(loaded, "device", device) != device:
+                continue
+            # 新版本只统计实际在显存中的部分
+            size = loaded.model_loaded_memory() if hasattr(loaded, "model_loaded_memory") else loaded.model_memory()
+            freeable += size
+        return freeable
+
+    def available_memory(self, keep: int = 0) -> int:
+        """
+        可用于新任务的显存 = 空闲显存 + 可卸载的模型显存
+
+        Args:
+            keep: 任务仍需使用的已加载模型字节数，不可卸载
+        """
+        return self.free_memory() + max(0, self.freeable_memory() - keep)
+
+    def _cuda(self):
+        try:
+            import torch
+            if torch.cuda.is_available():
+                return torch.cuda
+        except Exception:
+            pass
+        return None
+
+    def reset_peak(self) -> Optional[int]:
+        """重置峰值统计，返回当前已分配量"""
+        cuda = self._cuda()
+        if cuda is None:
+            return None
+        cuda.reset_peak_memory_stats()
+        return cuda.memory_allocated()
+
+    def peak(self) -> Optional[int]:
+        cuda = self._cuda()
+        return cuda.max_memory_allocated() if cuda is not None else None
+
+
+class StubMemoryBackend:
+    """固定数值的显存后端，用于无 GPU 环境联调"""
+
+    def __init__(self, free_mb: float = 16000, total_mb: float = 24000, peak_mb: Optional[float] = None):
+        self.free_mb = free_mb
+        self.total_mb = total_mb
+        self.peak_mb = peak_mb
+
+    def free_memory(self) -> int:
+        return int(self.free_mb * MB)
+
+    def available_memory(self, keep: int = 0) -> int:
+        return self.free_memory()
+
+    def total_memory(self) -> int:
+        return int(self.total_mb * MB)
+
+    def reset_peak(self) -> Optional[int]:
+        return 0 if self.peak_mb is not None else None
+
+    def peak(self) -> Optional[int]:
+        return int(self.peak_mb * MB) if self.peak_mb is not None else None
+
+
+BACKENDS = {
+    "comfy": ComfyMemoryBackend,
+    "stub": StubMemoryBackend,
+}
+
+
+def model_file_size(folder: str, name: str) -> int:
+    """模型文件字节数，找不到时为 0"""
+    import folder_paths
+    try:
+        path = folder_paths.get_full_path(folder, name)
+        return os.path.getsize(path) if path else 0
+    except Exception:
+        return 0
+
+
+def workflow_megapixels(workflow: dict) -> float:
+    """workflow 生成的最大图像尺寸(百万像素)，按含 width/height 输入的节点计算，含 batch_size"""
+    megapixels = 0.0
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs") or {}
+        width, height = inputs.get("width"), inputs.get("height")
+        if isinstance(width, int) and isinstance(height, int):
+            batch = inputs.get("batch_size") if isinstance(inputs.get("batch_size"), int) else 1
+            megapixels = max(megapixels, width * height * batch / 1e6)
+    return megapixels
+
+
+class AdmissionController:
+    """
+    任务准入控制
+
+    提交前估算 workflow 的显存占用 = 未加载模型的文件大小 + 像素数 × 每百万像素显存，
+    与可用显存（空闲显存 + ComfyUI 可卸载的其他模型）比较，推理后至少保留 min_free_mb（min_gpu_memory_available）：
+        admit:  空闲显存足够；或模型大于设备总显存、只能由 ComfyUI 部分加载（lowvram），推理中间结果放得下
+        defer:  暂时不够（如本地用户占用显存），任务放回队列稍后再试，超过 defer_timeout 后释放
+        reject: 推理中间结果超过设备总显存，模型全部卸载到内存也无法执行，释放租约交给其他节点
+    每个任务执行后记录显存峰值，修正每百万像素显存的估算。
+    """
+    ADMIT = "admit"
+    DEFER = "defer"
+    REJECT = "reject"
+
+    def __init__(self, backend=None, min_free_mb: float = 4000, mb_per_megapixel: float = 1024,
+                 defer_timeout: float = 300, history_size: int = 100):
+        """
+        Args:
+            backend: 显存后端，默认 ComfyMemoryBackend
+            min_free_mb: 推理时至少保留的空闲显存(MB)
+            mb_per_megapixel: 每百万像素显存的初始估算(MB)，随实际峰值修正
+            defer_timeout: 任务最长推迟时间(秒)
+            history_size: 保留的任务显存记录数
+        """
+        self.backend = backend or ComfyMemoryBackend()
+        self.min_free = min_free_mb * MB
+        self.bytes_per_megapixel = mb_per_megapixel * MB
+        self.defer_timeout = defer_timeout
+
+        self.deferred: Dict[str, float] = {}    # task_id -> 首次推迟时间
+        self.history = deque(maxlen=history_size)
+        self.counts = {self.ADMIT: 0, self.DEFER: 0, self.REJECT: 0}
+        self.lock = threading.Lock()
+
+    def estimate(self, workflow: dict, loaded: Optional[Dict[str, set]] = None) -> Dict[str, int]:
+        """
+        估算 workflow 的显存占用
+
+        Args:
+            loaded: 已加载的模型 {folder: {name}}，已占用显存，不再计入
+
+        Returns:
+            {"models": 需加载的模型字节数, "loaded": 已加载的模型字节数, "activations": 推理中间结果字节数, "total": 合计}
+        """
+        loaded = loaded or {}
+        model_bytes = loaded_bytes = 0
+        for folder, names in extract_model_refs(workflow).items():
+            for name in names:
+                if name in loaded.get(folder, set()):
+                    loaded_bytes += model_file_size(folder, name)
+                else:
+                    model_bytes += model_file_size(folder, name)
+
+        activations = int(workflow_megapixels(workflow) * self.bytes_per_megapixel)
+        return {"models": model_bytes, "loaded": loaded_bytes, "activations": activations,
+                "total": model_bytes + activations}
+
+    def check(self, task: dict, loaded: Optional[Dict[str, set]] = None) -> Dict[str, Any]:
+        """
+        判断任务是否可以提交
+
+        Returns:
+            {"decision": admit/defer/reject, "estimate": {...}, "free": 可用字节数（含可卸载的模型）, "reason": str}
+        """
+        task_id = task.get("task_id")
+        estimate = self.estimate(task.get("workflow"), loaded)
+        required = estimate["total"] + self.min_free
+        # ComfyUI 显存不足时部分加载模型权重，其余留在内存，推理中间结果必须在显存中
+        minimum = estimate["activations"] + self.min_free
+
+        try:
+            # 任务使用的已加载模型不会被卸载，其余缓存模型可卸载
+            free = self.backend.available_memory(keep=estimate["loaded"])
+            total = self.backend.total_memory()
+        except Exception as e:
+            # 无法获取显存时不阻塞任务
+            logger.debug(f"Failed to get device memory, admit task {task_id}: {e}")
+            return {"decision": self.ADMIT, "estimate": estimate, "free": None, "reason": str(e)}
+
+        now = time.time()
+        with self.lock:
+            if estimate["activations"] > total:
+                decision = self.REJECT
+                reason = f"activations require {estimate['activations'] / MB:.0f}MB, device total {total / MB:.0f}MB"
+            elif required <= free:
+                decision = self.ADMIT
+                reason = ""
+            elif estimate["total"] > total and minimum <= free:
+                # 模型无论如何都无法全部加载，等待也没有意义
+                decision = self.ADMIT
+                reason = f"lowvram, requires {required / MB:.0f}MB, device total {total / MB:.0f}MB"
+            else:
+                first = self.deferred.setdefault(task_id, now)
+                if now - first > self.defer_timeout:
+                    decision = self.REJECT
+                    reason = f"deferred over {self.defer_timeout}s, requires {required / MB:.0f}MB, available {free / MB:.0f}MB"
+                else:
+                    decision = self.DEFER
+                    reason = f"requires {required / MB:.0f}MB, available {free / MB:.0f}MB"
+
+            if decision != self.DEFER:
+                self.deferred.pop(task_id, None)
+            self.counts[decision] += 1
+
+        return {"decision": decision, "estimate": estimate, "free": free, "reason": reason}
+
+    def begin(self) -> Optional[int]:
+        """任务提交前调用，重置显存峰值统计"""
+        try:
+            return self.backend.reset_peak()
+        except Exception:
+            return None
+
+    def record(self, task: dict, estimate: Dict[str, int], baseline: Optional[int]):
+        """记录任务执行的显存峰值，修正每百万像素显存估算"""
+        try:
+            peak = self.backend.peak()
+        except Exception:
+            peak = None
+        if peak is None or baseline is None:
+            return
+
+        used = max(0, peak - baseline)
+        megapixels = workflow_megapixels(task.get("workflow"))
+        with self.lock:
+            self.history.append({
+                "task_id": task.get("task_id"),
+                "estimate_mb": round(estimate["total"] / MB),
+                "peak_mb": round(used / MB),
+                "megapixels": round(megapixels, 3),
+                "at": int(time.time())
+            })
+            if megapixels > 0:
+                # 峰值减去新加载的模型即为推理中间结果，指数平均，偏大时立即采用避免 OOM
+                observed = max(0, used - estimate["models"]) / megapixels
+                if observed > self.bytes_per_megapixel:
+                    self.bytes_per_megapixel = observed
+                else:
+                    self.bytes_per_megapixel = 0.8 * self.bytes_per_megapixel + 0.2 * observed
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "counts": dict(self.counts),
+                "deferred": len(self.deferred),
+                "mb_per_megapixel": round(self.bytes_per_megapixel / MB),
+                "history": list(self.history)[-10:]
+            }
@@ -0,0 +1,137 @@
+import os
+import time
+import logging
+import threading
+
+from typing import Dict, Set
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+# 加载器节点输入名 -> folder_paths 目录名
+MODEL_INPUTS = {
+    "ckpt_name": "checkpoints",
+    "lora_name": "loras",
+    "control_net_name": "controlnet",
+    "unet_name": "diffusion_models",
+    "vae_name": "vae",
+    "clip_name": "clip",
+    "clip_name1": "clip",
+    "clip_name2": "clip",
+    "upscale_model_name": "upscale_models",
+}
+
+# 切换代价越大的模型权重越高
+MODEL_WEIGHTS = {
+    "checkpoints": 10,
+    "diffusion_models": 10,
+    "clip": 3,
+    "controlnet": 2,
+    "vae": 1,
+    "loras": 1,
+    "upscale_models": 1,
+}
+
+
+def extract_model_refs(workflow: dict) -> Dict[str, Set[str]]:
+    """提取 workflow 引用的模型文件，返回 {folder_name: {filename, ...}}"""
+    refs: Dict[str, Set[str]] = {}
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        for name, value in (node.get("inputs") or {}).items():
+            folder = MODEL_INPUTS.get(name)
+            if folder and isinstance(value, str):
+                refs.setdefault(folder, set()).add(value)
+    return refs
+
+
+class ModelInventory:
+    """
+    节点模型清单
+        loaded: 最近一次执行的 workflow 使用的模型，ComfyUI 卸载所有模型后清空
+        cached: 本地磁盘上的模型文件（不含 ComfyFog models/ 下的远程挂载目录）
+        hashes: ModelIndex 中已计算 sha256 的模型，任务中心可据此确认文件内容
+    随任务获取请求上报给任务中心，并用于本地队列按模型亲和度排序。
+    """
+    def __init__(self, cache_ttl: float = 60, index=None):
+        self.cache_ttl = cache_ttl
+        self.index = index
+        self.loaded: Dict[str, Set[str]] = {}
+        self.cached: Dict[str, list] = {}
+        self.cached_at = 0.0
+        self.lock = threading.Lock()
+
+    def mark_loaded(self, workflow: dict):
+        """记录刚执行完成的 workflow 使用的模型"""
+        refs = extract_model_refs(workflow)
+        with self.lock:
+            self.loaded = refs
+
+    def loaded_models(self) -> Dict[str, Set[str]]:
+        """当前仍驻留的模型，ComfyUI 已卸载全部模型时清空记录"""
+        try:
+            import comfy.model_management
+            if not comfy.model_management.current_loaded_models:
+                with self.lock:
+                    self.loaded = {}
+        except Exception:
+            pass
+        with self.lock:
+            return self.loaded
+
+    def _cached_models(self) -> Dict[str, list]:
+        """本地模型文件列表，按 cache_ttl 缓存"""
+        if time.time() - self.cached_at < self.cache_ttl:
+            return self.cached
+
+        import folder_paths
+        from .fog_model import FOG_MODEL_DIR
+
+        cached = {}
+        for folder in set(MODEL_INPUTS.values()):
+            if folder not in folder_paths.folder_names_and_paths:
+                continue
+            local_paths = [p for p in folder_paths.get_folder_paths(folder)
+                           if not os.path.abspath(p).startswith(FOG_MODEL_DIR)]
+            if not local_paths:
+                continue
+            names = []
+            for path in local_paths:
+                if os.path.isdir(path):
+                    names.extend(folder_paths.recursive_search(path, excluded_dir_names=[".git"])[0])
+            names = sorted(set(folder_paths.filter_files_extensions(names, folder_paths.folder_names_and_paths[folder][1])))
+            if names:
+                cached[folder] = names
+
+        self.cached = cached
+        self.cached_at = time.time()
+        return cached
+
+    def snapshot(self) -> Dict[str, dict]:
+        """上报给任务中心的模型清单"""
+        loaded = self.loaded_models()
+        try:
+            cached = self._cached_models()
+        except Exception as e:
+            logger.error(f"Failed to list local models: {e}")
+            cached = self.cached
+        snapshot = {
+            "loaded": {folder: sorted(names) for folder, names in loaded.items()},
+            "cached": cached
+        }
+        if self.index is not None:
+            snapshot["hashes"] = self.index.snapshot()
+        return snapshot
+
+    def affinity(self, task: dict) -> float:
+        """任务与当前已加载模型的匹配得分"""
+        loaded = self.loaded
+        if not loaded:
+            return 0
+        refs = extract_model_refs(task.get("workflow"))
+        score = 0
+        for folder, names in refs.items():
+            score += MODEL_WEIGHTS.get(folder, 1) * len(names & loaded.get(folder, set()))
+        return score
@@ -0,0 +1,36 @@
+import time
+import random
+
+
+class Backoff:
+    """
+    带抖动的指数退避
+    每次失败后等待时间在 [base, min(cap, base * 2^n)] 内随机取值，成功后重置；
+    随机抖动避免大量节点在同一时刻请求任务中心。
+    """
+    def __init__(self, base: float = 1, cap: float = 60):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self.next_at = 0.0
+
+    def ready(self) -> bool:
+        """是否已过退避等待时间"""
+        return time.time() >= self.next_at
+
+    def remaining(self) -> float:
+        """剩余等待秒数"""
+        return max(0.0, self.next_at - time.time())
+
+    def failure(self) -> float:
+        """记录一次失败（或空结果），返回下次等待秒数"""
+        upper = min(self.cap, self.base * (2 ** self.failures))
+        self.failures += 1
+        delay = random.uniform(self.base, max(self.base, upper))
+        self.next_at = time.time() + delay
+        return delay
+
+    def reset(self):
+        """成功后重置"""
+        self.failures = 0
+        self.next_at = 0.0
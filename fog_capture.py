@@ -0,0 +1,234 @@
+import io
+import os
+import re
+import json
+import logging
+import threading
+
+from typing import Optional, Union
+from collections import OrderedDict
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+MEMORY_SCHEME = "mem://"
+
+
+class FogImageStore:
+    """
+    Fog 任务输出图片的内存存储
+
+    FogMemorySaveImage 节点将编码后的图片放入此处，上传阶段直接发送内存中的 bytes，
+    避免 SaveImage 写盘、上传时读盘再删除。图片以 mem://<key>/<node>/<index> 引用；
+    内存占用超过 memory_budget 时新图片写入 spill_dir，路径由引用确定，
+    因此即使进程重启，已落盘的图片仍可按引用找到并继续上传。
+    已释放的 capture key 不再接收新图片，避免失败或超时后仍在执行的 prompt 继续占用内存预算。
+    """
+    # 记录的已释放 capture key 数
+    MAX_DISCARDED_KEYS = 1024
+
+    def __init__(self, spill_dir: str, memory_budget: int = 512 * 1024 * 1024):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.buffers = {}           # ref -> bytes
+        self.memory_used = 0
+        self.discarded_keys: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_ref(key: str, node: str, index: int) -> str:
+        return f"{MEMORY_SCHEME}{key}/{node}/{index}"
+
+    @staticmethod
+    def is_ref(file: str) -> bool:
+        return isinstance(file, str) and file.startswith(MEMORY_SCHEME)
+
+    def spill_path(self, ref: str) -> str:
+        """引用对应的落盘路径"""
+        name = re.sub(r'[^0-9A-Za-z_.-]', '_', ref[len(MEMORY_SCHEME):])
+        return os.path.join(self.spill_dir, f"{name}.img")
+
+    def add(self, key: str, node: str, index: int, data: bytes) -> str:
+        """保存一张图片，超出内存预算时落盘，返回引用"""
+        ref = self.make_ref(key, node, index)
+        with self.lock:
+            if key in self.discarded_keys:
+                logger.debug(f"Capture key already discarded, drop {ref}")
+                return ref
+            if self.memory_used + len(data) <= self.memory_budget:
+                self.buffers[ref] = data
+                self.memory_used += len(data)
+                return ref
+
+        # 先进先出上传，较早的图片保留在内存中，新图片落盘
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(self.spill_path(ref), 'wb') as f:
+            f.write(data)
+        logger.debug(f"Image store over memory budget, spilled {ref} to disk")
+        return ref
+
+    def open(self, ref: str) -> Union[bytes, io.BufferedReader]:
+        """
+        获取图片内容，内存中的返回 bytes（不复制），已落盘的返回文件对象
+
+        Raises:
+            FileNotFoundError: 引用的图片已不存在（如进程异常退出导致内存数据丢失）
+        """
+        with self.lock:
+            data = self.buffers.get(ref)
+        if data is not None:
+            return data
+        return open(self.spill_path(ref), 'rb')
+
+    def size(self, ref: str) -> Optional[int]:
+        with self.lock:
+            data = self.buffers.get(ref)
+        if data is not None:
+            return len(data)
+        try:
+            return os.path.getsize(self.spill_path(ref))
+        except OSError:
+            return None
+
+    def discard(self, ref: str):
+        """上传成功后释放图片"""
+        with self.lock:
+            data = self.buffers.pop(ref, None)
+            if data is not None:
+                self.memory_used -= len(data)
+                return
+        try:
+            os.remove(self.spill_path(ref))
+        except OSError:
+            pass
+
+    def discard_key(self, key: str):
+        """释放同一次执行（capture key）的全部图片，用于失败或被中断的任务"""
+        prefix = self.make_ref(key, "", 0).rsplit("/", 2)[0] + "/"
+        with self.lock:
+            self.discarded_keys[key] = True
+            while len(self.discarded_keys) > self.MAX_DISCARDED_KEYS:
+                self.discarded_keys.popitem(last=False)
+            refs = [ref for ref in self.buffers if ref.startswith(prefix)]
+        for ref in refs:
+            self.discard(ref)
+        spill_prefix = os.path.basename(self.spill_path(prefix))[:-len(".img")]
+        if os.path.isdir(self.spill_dir):
+            for name in os.listdir(self.spill_dir):
+                if name.startswith(spill_prefix):
+                    try:
+                        os.remove(os.path.join(self.spill_dir, name))
+                    except OSError:
+                        pass
+
+    def spill(self, ref: str):
+        """将一张内存中的图片落盘，引用不变，用于转入 dead_letter 的任务"""
+        with self.lock:
+            data = self.buffers.pop(ref, None)
+            if data is None:
+                return
+            self.memory_used -= len(data)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(self.spill_path(ref), 'wb') as f:
+            f.write(data)
+
+    def spill_all(self):
+        """将内存中的图片全部落盘，用于停止时保留未上传的结果"""
+        with self.lock:
+            buffers = self.buffers
+            self.buffers = {}
+            self.memory_used = 0
+        if buffers:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        for ref, data in buffers.items():
+            with open(self.spill_path(ref), 'wb') as f:
+                f.write(data)
+        if buffers:
+            logger.info(f"Image store spilled {len(buffers)} in-memory images to disk")
+
+
+FOG_IMAGE_STORE = FogImageStore(os.path.join(os.path.dirname(__file__), "spill"))
+
+
+def rewrite_for_capture(workflow: dict, key: str) -> dict:
+    """
+    将 workflow 中的 SaveImage 节点替换为 FogMemorySaveImage，输出图片保存在内存中
+
+    Returns:
+        替换后的新 workflow，原 workflow 不修改
+    """
+    rewritten = {}
+    for node_id, node in workflow.items():
+        if isinstance(node, dict) and node.get("class_type") == "SaveImage":
+            inputs = dict(node.get("inputs") or {})
+            inputs["fog_capture_key"] = key
+            node = dict(node, class_type="FogMemorySaveImage", inputs=inputs)
+        rewritten[node_id] = node
+    return rewritten
+
+
+class FogMemorySaveImage:
+    """
+    与 SaveImage 相同的 PNG 编码及元数据，但结果写入 FOG_IMAGE_STORE 而非 output 目录
+
+    仅供调度器替换 Fog 任务中的 SaveImage 使用，不在节点菜单中显示；
+    fog_capture_key 为空时（如本地 workflow 中手动添加）与 SaveImage 相同，保存到 output 目录
+    """
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "images": ("IMAGE", ),
+                "filename_prefix": ("STRING", {"default": "ComfyUI"}),
+                "fog_capture_key": ("STRING", {"default": ""}),
+            },
+            "hidden": {
+                "prompt": "PROMPT",
+                "extra_pnginfo": "EXTRA_PNGINFO",
+                "unique_id": "UNIQUE_ID",
+            },
+        }
+
+    RETURN_TYPES = ()
+    FUNCTION = "save_images"
+    OUTPUT_NODE = True
+    CATEGORY = "ComfyFog"
+    DEPRECATED = True
+
+    def save_images(self, images, filename_prefix="ComfyUI", fog_capture_key="", prompt=None, extra_pnginfo=None, unique_id=None):
+        if not fog_capture_key:
+            # 不是调度器提交的任务，图片不能进入 FOG_IMAGE_STORE，否则不会被上传或清理
+            import nodes
+            return nodes.SaveImage().save_images(images, filename_prefix, prompt, extra_pnginfo)
+
+        import numpy as np
+        from PIL import Image
+        from PIL.PngImagePlugin import PngInfo
+        from comfy.cli_args import args
+
+        results = []
+        for batch_number, image in enumerate(images):
+            i = 255. * image.cpu().numpy()
+            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+
+            metadata = None
+            if not args.disable_metadata:
+                metadata = PngInfo()
+                if prompt is not None:
+                    metadata.add_text("prompt", json.dumps(prompt))
+                if extra_pnginfo is not None:
+                    for x in extra_pnginfo:
+                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
+            buffer = io.BytesIO()
+            img.save(buffer, format="PNG", pnginfo=metadata, compress_level=4)
+            ref = FOG_IMAGE_STORE.add(fog_capture_key, str(unique_id), batch_number, buffer.getvalue())
+            results.append({
+                "filename": ref,
+                "subfolder": "",
+                "type": "fog_memory"
+            })
+
+        return {"ui": {"images": results}}
@@ -1,3 +1,4 @@
+import json
 import logging
 import requests
 import traceback  
@@ -6,9 +7,16 @@ import os
 
 from datetime import datetime
 from urllib3.util import Retry
-from typing import Optional, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List
 from requests.adapters import HTTPAdapter
 
+from .fog_capture import FOG_IMAGE_STORE
+from .fog_metrics import UPLOAD_BYTES_TOTAL, UPLOAD_FAILURES_TOTAL
+from .fog_trace import FOG_TRACER
+from .fog_profile import FOG_PROFILER
+from .fog_log import log_context, payload
+
 
 logger = logging.getLogger('ComfyFog')
 
@@ -17,10 +25,30 @@ class FogClient:
     任务中心客户端
     负责与远程任务中心通信，获取任务和提交结果
     """
-    def __init__(self, task_center_url: str):
+    def __init__(self, task_center_url: str, upload_workers: int = 4):
+        """
+        Args:
+            task_center_url: 任务中心地址
+            upload_workers: 并发上传线程数，同时决定连接池大小
+        """
         self.task_center_url = task_center_url
+        self.upload_workers = max(1, upload_workers)
         self.session = self._create_session()
         self.timeout = 30  # 添加默认超时时间
+        self.upload_pool = ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="FogUploadWorker")
+
+        # 任务中心是否支持长轮询，由响应头 X-Fog-Long-Poll 告知
+        self.long_poll_supported = False
+
+    def close(self, wait: bool = False):
+        """
+        关闭上传线程池及HTTP会话
+
+        Args:
+            wait: 是否等待进行中的上传完成
+        """
+        self.upload_pool.shutdown(wait=wait)
+        self.session.close()
         
     def _create_session(self):
         """
@@ -37,12 +65,38 @@ class FogClient:
             connect=5,  # 连接超时重试
             read=30     # 读取超时重试
         )
-        adapter = HTTPAdapter(max_retries=retry)
+        # 连接池需容纳所有并发上传线程，另留余量给任务获取等请求
+        adapter = HTTPAdapter(
+            max_retries=retry,
+            pool_connections=2,
+            pool_maxsize=self.upload_workers + 2
+        )
         session.mount('http://', adapter)
         session.mount('https://', adapter)
         return session
         
-    def fetch_task(self):
+    def _update_long_poll(self, response):
+        """根据响应头记录任务中心是否支持长轮询"""
+        self.long_poll_supported = response.headers.get('X-Fog-Long-Poll') == '1'
+
+    # X-Fog-Model-Hashes 头的长度上限，常见服务器的请求头总长限制为 8KB
+    HASH_HEADER_LIMIT = 6144
+
+    def _hash_headers(self, hashes: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+        """
+        本地模型 sha256 的请求头，只取前 16 位（64 bit）以压缩长度
+        超出 HASH_HEADER_LIMIT 时截断，并以 X-Fog-Model-Hashes-Truncated: 1 告知任务中心
+        """
+        prefixes = sorted({sha256[:16] for names in hashes.values() for sha256 in names.values() if sha256})
+        if not prefixes:
+            return {}
+        max_count = (self.HASH_HEADER_LIMIT + 1) // 17
+        headers = {'X-Fog-Model-Hashes': ",".join(prefixes[:max_count])}
+        if len(prefixes) > max_count:
+            headers['X-Fog-Model-Hashes-Truncated'] = '1'
+        return headers
+
+    def fetch_task(self, wait: float = 0, inventory: Optional[Dict[str, Any]] = None):
         """
         从任务中心获取任务
         预期API: GET /task
@@ -51,15 +105,33 @@ class FogClient:
             "workflow": {...},  # ComfyUI工作流数据
             "created_at": "2024-01-01T00:00:00Z"
         }
+
+        Args:
+            wait: 长轮询等待秒数，任务中心支持时会保持请求直到有任务或超时，无任务返回 204
+            inventory: 节点模型清单，GET 请求没有请求体，通过请求头上报：
+                       X-Fog-Models 为已加载的模型，X-Fog-Model-Hashes 为本地模型 sha256 的前 16 位，逗号分隔
         """
         logger.debug(f"Fetching task from: {self.task_center_url}/get")
         try:
+            headers = {'User-Agent': 'ComfyFog/1.0'}
+            if inventory:
+                headers['X-Fog-Models'] = json.dumps(inventory.get("loaded", {}), separators=(',', ':'))
+                headers.update(self._hash_headers(inventory.get("hashes") or {}))
             response = self.session.get(
                 f"{self.task_center_url}/get",
-                headers={'User-Agent': 'ComfyFog/1.0'},
-                timeout=self.timeout
+                headers=headers,
+                params={"wait": wait} if wait else None,
+                timeout=self.timeout + wait
             )
-            
+            self._update_long_poll(response)
+
+            if response.status_code == 204:
+                return {
+                    "success": False,
+                    "empty": True,
+                    "error": "No task available"
+                }
+
             if response.status_code == 200:
                 try:
                     task = response.json()
@@ -73,7 +145,8 @@ class FogClient:
                         "success": True,
                         "task_id": task.get('task_id'),
                         "workflow": task.get('workflow'),
-                        "create_at": task.get('create_at')
+                        "create_at": task.get('create_at'),
+                        "output_format": task.get('output_format')
                     }
                 
                 except ValueError as e:
@@ -90,12 +163,135 @@ class FogClient:
                 "error": error_msg
             }
     
+    def lease_tasks(self, max_tasks: int, lease_seconds: int, wait: float = 0, inventory: Optional[Dict[str, Any]] = None):
+        """
+        从任务中心批量租约获取任务
+        预期API: POST /lease
+        请求格式: {"max_tasks": N, "lease_seconds": T, "wait": W, "inventory": {"loaded": {...}, "cached": {...}, "hashes": {...}}}
+        wait 为长轮询等待秒数，任务中心支持时会保持请求直到有任务或超时；
+        inventory 为节点已加载及本地缓存的模型及其 sha256，任务中心可据此优先分配匹配的任务
+        返回格式: {
+            "tasks": [{
+                "task_id": "task_id",
+                "workflow": {...},          # ComfyUI工作流数据
+                "create_at": ...,
+                "priority": 0,              # 可选，越大越优先
+                "output_format": {...},     # 可选，输出转码格式，如 {"format": "webp", "quality": 90, "keep_metadata": true}
+                "lease_expire_at": ...      # 租约到期时间戳(秒)
+            }]
+        }
+        任务中心不支持租约接口(404/405)时返回 unsupported，调用方应回退到 fetch_task
+        """
+        logger.debug(f"Leasing up to {max_tasks} tasks from: {self.task_center_url}/lease")
+        try:
+            response = self.session.post(
+                f"{self.task_center_url}/lease",
+                headers={'User-Agent': 'ComfyFog/1.0'},
+                json={"max_tasks": max_tasks, "lease_seconds": lease_seconds, "wait": wait, "inventory": inventory or {}},
+                timeout=self.timeout + wait
+            )
+            self._update_long_poll(response)
+
+            if response.status_code in (404, 405):
+                return {
+                    "success": False,
+                    "unsupported": True,
+                    "error": f"Lease API not supported: {response.status_code}"
+                }
+
+            if response.status_code != 200:
+                raise Exception(f"Failed to lease tasks: {response.status_code}, Response: {response.text}")
+
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise Exception(f"Invalid JSON response: {e}. Raw response: {response.text}")
+
+            tasks = []
+            for task in data.get("tasks") or []:
+                if not task.get('task_id') or not task.get('workflow'):
+                    logger.error("Invalid leased task format, skip. Task: %s", payload(task))
+                    continue
+                tasks.append({
+                    "success": True,
+                    "task_id": task.get('task_id'),
+                    "workflow": task.get('workflow'),
+                    "create_at": task.get('create_at'),
+                    "priority": task.get('priority', 0),
+                    "lease_expire_at": task.get('lease_expire_at'),
+                    "output_format": task.get('output_format')
+                })
+
+            return {
+                "success": True,
+                "tasks": tasks
+            }
+
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Error leasing tasks, {str(e)}"
+            }
+
+    def renew_leases(self, task_ids: List[str], lease_seconds: int):
+        """
+        续约任务租约
+        预期API: POST /lease/renew
+        请求格式: {"task_ids": [...], "lease_seconds": T}
+        返回格式: {"status": "success", "leases": {"task_id": lease_expire_at, ...}}
+        """
+        return self._post_lease("renew", {"task_ids": task_ids, "lease_seconds": lease_seconds})
+
+    def release_leases(self, task_ids: List[str]):
+        """
+        释放未执行任务的租约，任务中心可将其重新分配给其他节点
+        预期API: POST /lease/release
+        请求格式: {"task_ids": [...]}
+        """
+        return self._post_lease("release", {"task_ids": task_ids})
+
+    def _post_lease(self, action: str, payload: Dict[str, Any]):
+        try:
+            response = self.session.post(
+                f"{self.task_center_url}/lease/{action}",
+                headers={'User-Agent': 'ComfyFog/1.0'},
+                json=payload,
+                timeout=self.timeout
+            )
+            if response.status_code != 200:
+                raise Exception(f"{response.status_code}, Response: {response.text}")
+
+            data = response.json()
+            if data.get("status") != "success":
+                raise Exception(f"response from server {data}")
+
+            return {
+                "success": True,
+                "leases": data.get("leases", {})
+            }
+
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Error {action} leases, {str(e)}"
+            }
+
     """
     
     Inputs: images:{'9': {'url': ['http://127.0.0.1:8188/view?filename=ComfyUI_01209_.png&subfolder=&type=output'], 'file': ['/data/home/clusterli/ComfyUI/output/ComfyUI_01209_.png']}}
     Resp: 
     """
-    def upload_images(self, meta:Dict[str, Any], images: Dict[str, Any], resp: Dict[str, Any]) -> bool:
+    def upload_images(self, meta:Dict[str, Any], images: Dict[str, Any], resp: Dict[str, Any], skip: Optional[set] = None) -> bool:
+        """
+        上传任务输出图片
+
+        Args:
+            skip: 已上传成功的 "node/index" 集合，重试时跳过，结果中记为成功
+        """
+        with FOG_PROFILER.memory("upload_images"):
+            return self._upload_images(meta, images, resp, skip)
+
+    def _upload_images(self, meta:Dict[str, Any], images: Dict[str, Any], resp: Dict[str, Any], skip: Optional[set] = None) -> bool:
        
         # 初始化返回
         ret = True
@@ -108,54 +304,88 @@ class FogClient:
 
 
         task_post_url = "{}/upload?{}".format(self.task_center_url, urllib.parse.urlencode(meta))
-        # 遍历 images 字典
+
+        # 每个文件一个上传任务，并发提交到上传线程池
+        jobs = []
         for node, details in images.items():
             files = details.get('file', [])                  
+            content_types = details.get('content_type', [])
             for index,file in enumerate(files):
+                if skip and f"{node}/{index}" in skip:
+                    resp[node][index] = {"success": True, "file": file, "skipped": True}
+                    continue
                 post_url = "{}&node={}&index={}".format(task_post_url, node, index)
                 logger.debug(f"submit post url {post_url}")
+                content_type = content_types[index] if index < len(content_types) else 'application/octet-stream'
+                jobs.append((node, index, file, self.upload_pool.submit(self._upload_job, post_url, file, content_type, meta.get("task_id"))))
 
-                try:
-                    # 上传本地生成文件
-                    with open(file, 'rb') as f:
-                        file_data = f.read()  # 读取文件内容
-                        response = self.session.post(
-                            f"{post_url}",
-                            headers={
-                                'User-Agent': 'ComfyFog/1.0',
-                                'Content-Type': 'application/octet-stream'  # 设置内容类型
-                            },
-                            data=file_data,  # 直接发送文件内容
-                            timeout=self.timeout
-                        )
-
-                        # 检查响应状态
-                        if response.status_code == 200:
-                            # 获取响应内容
-                            response_data = response.json()  # 假设返回的是 JSON 格式
-                            logger.debug(f"File {file} uploaded successfully. Response: {response_data}")
-                            if response_data.get("status") != "success":
-                                raise Exception(f"response from server {response_data}")
-
-                            # 在 resp 中记录上传成功的状态
-                            resp[node][index] = {"success": True, "file": file}
-                            
-                            # 删除本地文件
-                            try:
-                                os.remove(file)  # 删除本地文件
-                                logger.debug(f"Local file {file} deleted successfully.")
-                            except OSError as e:
-                                logger.error(f"Error deleting file {file}: {e}")
-                        else:
-                            raise Exception(f"Failed to upload {file}. Status code: {response.status_code}")
-                            
-
-                except Exception as e:
-                    ret = False
-                    err_msg = (f"Error upload image: {str(e)}")
-                    resp[node][index] = {"success":False, "file":file, "error": err_msg }
+        # 按原有 resp[node][index] 格式汇总结果
+        for node, index, file, future in jobs:
+            try:
+                future.result()
+                resp[node][index] = {"success": True, "file": file}
+            except Exception as e:
+                ret = False
+                UPLOAD_FAILURES_TOTAL.inc(kind="file")
+                err_msg = (f"Error upload image: {str(e)}")
+                resp[node][index] = {"success":False, "file":file, "error": err_msg }
 
         return ret
 
+    def _upload_job(self, post_url: str, file: str, content_type: str, task_id: Optional[str]):
+        """上传线程池中执行，日志附带 task_id，开启性能分析时记录"""
+        with FOG_PROFILER.profile("FogUploadWorker"), log_context(task_id=task_id):
+            return self._upload_file(post_url, file, content_type, task_id)
 
+    def _upload_file(self, post_url: str, file: str, content_type: str = 'application/octet-stream', task_id: Optional[str] = None):
+        """
+        流式上传单个文件，成功后删除本地文件
+        file 为 mem:// 引用时从 FOG_IMAGE_STORE 读取，成功后释放
+        task_id 用于记录任务 trace
 
+        直接将文件对象交给 requests，按块读取发送，不会把整个文件读入内存；
+        连接重试时 urllib3 会将文件对象重置到起始位置。
+
+        Raises:
+            Exception: 上传失败
+        """
+        in_memory = FOG_IMAGE_STORE.is_ref(file)
+
+        # 内存中的图片直接发送 bytes，不复制；落盘的图片流式发送文件内容
+        data = FOG_IMAGE_STORE.open(file) if in_memory else open(file, 'rb')
+        size = len(data) if isinstance(data, bytes) else os.fstat(data.fileno()).st_size
+        try:
+            with FOG_TRACER.span(task_id, "POST /upload", "upload", file=os.path.basename(file), bytes=size):
+                response = self.session.post(
+                    f"{post_url}",
+                    headers={
+                        'User-Agent': 'ComfyFog/1.0',
+                        'Content-Type': content_type  # 转码后为对应图片类型
+                    },
+                    data=data,
+                    timeout=self.timeout
+                )
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+        # 检查响应状态
+        if response.status_code != 200:
+            raise Exception(f"Failed to upload {file}. Status code: {response.status_code}")
+
+        response_data = response.json()  # 假设返回的是 JSON 格式
+        logger.debug("File %s uploaded successfully. Response: %s", file, payload(response_data))
+        if response_data.get("status") != "success":
+            raise Exception(f"response from server {response_data}")
+        UPLOAD_BYTES_TOTAL.inc(size)
+
+        if in_memory:
+            FOG_IMAGE_STORE.discard(file)
+            return
+
+        # 删除本地文件
+        try:
+            os.remove(file)  # 删除本地文件
+            logger.debug(f"Local file {file} deleted successfully.")
+        except OSError as e:
+            logger.error(f"Error deleting file {file}: {e}")
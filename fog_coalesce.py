@@ -0,0 +1,168 @@
+import json
+import copy
+import hashlib
+import logging
+
+from typing import Optional, List, Dict, Any, Tuple
+
+from .fog_affinity import extract_model_refs
+from .fog_admission import model_file_size
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+# 采样器的 seed 输入
+SEED_INPUTS = ("seed", "noise_seed")
+
+# 合并时扩大 batch_size 的 latent 节点
+LATENT_CLASS = "EmptyLatentImage"
+
+
+def _latent_node(workflow: dict) -> Optional[Tuple[str, dict]]:
+    """workflow 中唯一的 EmptyLatentImage 节点，没有或有多个时返回 None"""
+    latents = [(node_id, node) for node_id, node in workflow.items()
+               if isinstance(node, dict) and node.get("class_type") == LATENT_CLASS]
+    if len(latents) != 1:
+        return None
+    node_id, node = latents[0]
+    inputs = node.get("inputs") or {}
+    for name in ("width", "height", "batch_size"):
+        if not isinstance(inputs.get(name), int):
+            return None
+    return node_id, node
+
+
+def coalesce_key(workflow: dict) -> Optional[str]:
+    """
+    合并分组键：忽略 seed 后 workflow 完全相同的任务键相同
+    不可合并（无 seed 输入、没有唯一的 EmptyLatentImage）时返回 None
+    """
+    if not workflow or _latent_node(workflow) is None:
+        return None
+
+    masked = {}
+    has_seed = False
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            return None
+        inputs = dict(node.get("inputs") or {})
+        for name in SEED_INPUTS:
+            if isinstance(inputs.get(name), int):
+                inputs[name] = None
+                has_seed = True
+        masked[node_id] = [node.get("class_type"), inputs]
+    if not has_seed:
+        return None
+    return hashlib.sha1(json.dumps(masked, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def workflow_seed(workflow: dict) -> Optional[int]:
+    """workflow 中第一个采样器 seed，按节点 id 排序"""
+    for node_id in sorted(workflow, key=str):
+        inputs = workflow[node_id].get("inputs") or {}
+        for name in SEED_INPUTS:
+            if isinstance(inputs.get(name), int):
+                return inputs[name]
+    return None
+
+
+class SeedCoalescer:
+    """
+    Seed 扫描任务合并（需在配置中开启）
+
+    本地队列中忽略 seed 后 workflow 相同的任务合并为一个 prompt，EmptyLatentImage 的 batch_size
+    扩大为各任务之和，输出图片按顺序拆分回各 task_id 后上传。
+
+    ComfyUI 自带采样器对整个 batch 只使用一个 seed 生成噪声，无法为每个样本指定 seed，
+    因此合并后各任务实际使用第一个任务的 seed 及其在 batch 中的位置，得到的图片与单独执行不同，
+    上传时在 meta 中附带 batch_seed、batch_size、batch_index，任务中心可据此复现。
+    只有声明接受 batch seed 的任务（task 中 batch_seeds 为 true）参与合并，其余任务按原 seed 单独执行。
+    """
+    def __init__(self, backend, max_batch: int = 4, min_free_mb: float = 4000, mb_per_megapixel: float = 1024):
+        """
+        Args:
+            backend: 显存查询后端，与准入控制相同
+            max_batch: 一次最多合并的任务数
+            min_free_mb: 推理时至少保留的空闲显存(MB)，即 min_gpu_memory_available
+            mb_per_megapixel: 每百万像素样本的显存估算(MB)
+        """
+        self.backend = backend
+        self.max_batch = max(1, max_batch)
+        self.min_free_mb = min_free_mb
+        self.mb_per_megapixel = mb_per_megapixel
+
+    def key(self, task: dict) -> Optional[str]:
+        if not task.get("batch_seeds"):
+            return None
+        return coalesce_key(task.get("workflow"))
+
+    def batch_limit(self, workflow: dict) -> int:
+        """按空闲显存估算最多可合并的任务数"""
+        _, node = _latent_node(workflow)
+        inputs = node["inputs"]
+        per_task_mb = inputs["width"] * inputs["height"] * inputs["batch_size"] / 1e6 * self.mb_per_megapixel
+
+        try:
+            # 与准入控制相同：空闲显存加上可卸载的缓存模型，本 workflow 使用的模型不可卸载
+            keep = sum(model_file_size(folder, name)
+                       for folder, names in extract_model_refs(workflow).items() for name in names)
+            free_mb = self.backend.available_memory(keep=keep) / (1024 * 1024)
+        except Exception as e:
+            logger.debug(f"Failed to get free GPU memory, skip coalescing: {e}")
+            return 1
+
+        # 第一个任务无论如何都会执行，额外合并的任务需在保留 min_free_mb 后放得下
+        extra = int((free_mb - self.min_free_mb - per_task_mb) // max(per_task_mb, 1))
+        return max(1, min(self.max_batch, 1 + extra))
+
+    def collect(self, task: dict, task_queue) -> List[dict]:
+        """从本地队列中取出可与 task 合并的任务，返回包含 task 在内的任务组"""
+        key = self.key(task)
+        if key is None:
+            return [task]
+        limit = self.batch_limit(task["workflow"])
+        if limit <= 1:
+            return [task]
+        return [task] + task_queue.take(lambda t: self.key(t) == key, limit - 1)
+
+    def build(self, tasks: List[dict]) -> dict:
+        """合并后的 workflow：第一个任务的 workflow，batch_size 为各任务之和"""
+        workflow = copy.deepcopy(tasks[0]["workflow"])
+        _, node = _latent_node(workflow)
+        node["inputs"]["batch_size"] *= len(tasks)
+        return workflow
+
+    def split(self, tasks: List[dict], meta: Dict[str, Any], images: Dict[str, Any]) -> Optional[List[Tuple[dict, dict, dict]]]:
+        """
+        将合并执行的结果拆分回各任务
+
+        Returns:
+            [(task, meta, images)]，输出图片数与 batch 不一致无法拆分时返回 None
+        """
+        per_task = _latent_node(tasks[0]["workflow"])[1]["inputs"]["batch_size"]
+        total = per_task * len(tasks)
+        for node, details in images.items():
+            if len(details.get('file', [])) != total:
+                logger.error(f"Coalesced output node {node} has {len(details.get('file', []))} images, expect {total}")
+                return None
+
+        seed = workflow_seed(tasks[0]["workflow"])
+        result = []
+        for i, task in enumerate(tasks):
+            part = {}
+            images_idx = ""
+            for node, details in images.items():
+                part[node] = {key: list(values[i * per_task:(i + 1) * per_task]) for key, values in details.items()}
+                for index in range(per_task):
+                    images_idx += f"/{node}/{index},"
+
+            task_meta = dict(meta)
+            task_meta["task_id"] = task.get("task_id")
+            task_meta["create_at"] = task.get("create_at")
+            task_meta["images_idx"] = images_idx
+            task_meta["batch_seed"] = seed
+            task_meta["batch_size"] = total
+            task_meta["batch_index"] = i * per_task
+            result.append((task, task_meta, part))
+        return result
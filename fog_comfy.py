@@ -1,27 +1,65 @@
 import os
-import json
-import time
 import logging
 import requests
-import websocket
+import uuid
 import urllib.parse
 
-
+from typing import Optional
 
 from comfy.cli_args import args
 from server import PromptServer
 
+from .fog_events import FogEventListener
+from .fog_validate import ValidationCache, workflow_fingerprint
+from .fog_profile import FOG_PROFILER
+from .fog_log import payload
+
 logger = logging.getLogger('ComfyFog')
 
 class ComfyUIClient:
-    def __init__(self):
+    """
+    本地 ComfyUI 客户端
+
+    支持两种后端：
+        inprocess: 与 ComfyUI 同进程运行时，直接操作 PromptServer.instance.prompt_queue，无需 HTTP 回环
+        http:      通过 HTTP 接口访问 ComfyUI，用于远程 ComfyUI 实例，或 PromptServer 不可用时回退
+    """
+    MODES = ("inprocess", "http")
+
+    def __init__(self, mode: str = "inprocess", base_url: Optional[str] = None, validation_cache_size: int = 64):
+        """
+        Args:
+            mode: 后端模式，inprocess 或 http
+            base_url: http 模式下的 ComfyUI 地址，如 http://10.0.0.2:8188，为空时使用本机 ComfyUI
+            validation_cache_size: workflow 校验结果缓存条数
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown ComfyUIClient mode: {mode}, expect one of {self.MODES}")
+
         self.prompt_server = PromptServer.instance
-        self.address, self.port = self._get_server_info()
-        self.scheme = "https" if self._is_tls_enabled() else "http"
-        if self.address == "0.0.0.0":
-            self.address = "127.0.0.1"
         self.client_id = "ComfyFog"
-        logger.debug(f"ComfyUI server running at: {self.scheme}://{self.address}:{self.port}")
+
+        if base_url:
+            # 远程 ComfyUI 只能走 http
+            url = urllib.parse.urlparse(base_url)
+            self.scheme = url.scheme or "http"
+            self.address = url.hostname
+            self.port = url.port or (443 if self.scheme == "https" else 80)
+            mode = "http"
+        else:
+            self.address, self.port = self._get_server_info()
+            self.scheme = "https" if self._is_tls_enabled() else "http"
+            if self.address == "0.0.0.0":
+                self.address = "127.0.0.1"
+
+        if mode == "inprocess" and self.prompt_server is None:
+            logger.warning("PromptServer instance not available, fallback to http mode")
+            mode = "http"
+        self.mode = mode
+        self.events: Optional[FogEventListener] = None  # 执行事件监听器，首次提交时启动
+        self.validation_cache = ValidationCache(validation_cache_size)
+
+        logger.debug(f"ComfyUI server running at: {self.scheme}://{self.address}:{self.port}, mode: {self.mode}")
         
     def _get_server_info(self):
         """获取服务器地址和端口
@@ -59,9 +97,60 @@ class ComfyUIClient:
         """检查是否启用了 TLS"""
         return bool(args.tls_keyfile and args.tls_certfile)
 
-    def submit_workflow(self, workflow):
-        """提交工作流到 ComfyUI"""
+    def submit_workflow(self, workflow, valid=None):
+        """
+        提交工作流到 ComfyUI
+
+        Args:
+            workflow: ComfyUI API 格式的工作流
+            valid: validate_prompt 的校验结果，inprocess 模式下传入可避免重复校验
+        """
+        if self.mode == "inprocess":
+            return self._submit_workflow_inprocess(workflow, valid)
+        return self._submit_workflow_http(workflow)
+
+    def _submit_workflow_inprocess(self, workflow, valid=None):
+        """直接放入 PromptServer 的 prompt_queue，逻辑与 server.py 中 POST /prompt 保持一致"""
+        try:
+            server = self.prompt_server
+
+            # 与 POST /prompt 一致，先触发其他插件注册的 on_prompt 处理
+            if getattr(server, "on_prompt_handlers", None):
+                json_data = server.trigger_on_prompt({"prompt": workflow, "client_id": self.client_id})
+                workflow = json_data["prompt"]
+                valid = None  # prompt 可能已被修改，需要重新校验
+
+            if valid is None:
+                valid = self.validate_prompt(workflow)
+            if not valid[0]:
+                raise Exception(f"Failed to submit_workflow , invalid prompt: {valid[1]}, node_errors: {valid[3]}")
+
+            number = server.number
+            server.number += 1
+
+            prompt_id = str(uuid.uuid4())
+            extra_data = {"client_id": self.client_id}
+            self._ensure_listener().watch(prompt_id)  # 入队前注册，避免错过执行事件
+            server.prompt_queue.put((number, prompt_id, workflow, extra_data, valid[2]))
+
+            return {
+                "success": True,
+                "prompt_id": prompt_id,
+                "number": number,
+                "node_errors": valid[3]
+            }
+
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def _submit_workflow_http(self, workflow):
+        """通过 HTTP POST /prompt 提交工作流"""
         try:
+            # 提交前确保 WebSocket 已连接，提交返回前到达的事件由监听器暂存
+            events = self._ensure_listener()
+            if not events.connected.wait(timeout=5):
+                logger.warning("ComfyUI websocket not connected yet, execution events may be missed")
+
             url = f"{self.scheme}://{self.address}:{self.port}/prompt"
             
             # 准备请求数据
@@ -81,6 +170,7 @@ class ComfyUIClient:
                 
 
                 if prompt_id:
+                    events.watch(prompt_id)
                     return {
                         "success": True,
                         "prompt_id": prompt_id,
@@ -98,6 +188,18 @@ class ComfyUIClient:
 
     def get_queue_status(self):
         """获取当前队列任务状态"""
+        if self.mode == "inprocess":
+            try:
+                return {
+                    "success": True,
+                    "queue_remaining": self.prompt_server.prompt_queue.get_tasks_remaining()
+                }
+            except Exception as e:
+                return {
+                    "success": False,
+                    "error": str(e)
+                }
+
         try:
             url = f"{self.scheme}://{self.address}:{self.port}/prompt"
             
@@ -106,7 +208,7 @@ class ComfyUIClient:
             
             if response.status_code == 200:
                 data = response.json()
-                logger.debug(f"Get {url}, Resp: {data}");
+                logger.debug("Get %s, Resp: %s", url, payload(data))
                 queue_remaining = data.get("exec_info").get("queue_remaining")
                 return {
                     "success": True,
@@ -126,68 +228,128 @@ class ComfyUIClient:
                 "error": str(e)
             }
 
-    def _get_images(self, ws, prompt_id, timeout=300):
-        
-        output_images = {}
+    def get_queue(self):
+        """
+        获取 ComfyUI 正在执行及排队中的 prompt
 
-        start_time = time.time()  # 记录开始时间
+        Returns:
+            {"success": True, "running": [(prompt_id, client_id)], "pending": [(prompt_id, client_id)]}
+        """
+        try:
+            if self.mode == "inprocess":
+                running, pending = self.prompt_server.prompt_queue.get_current_queue()
+            else:
+                url = f"{self.scheme}://{self.address}:{self.port}/queue"
+                response = requests.get(url, timeout=10)
+                if response.status_code != 200:
+                    raise Exception(f"Get {url} failed,  {response.status_code}")
+                data = response.json()
+                running, pending = data.get("queue_running", []), data.get("queue_pending", [])
 
-        while True:
-            out = ws.recv()
+            def summarize(items):
+                # item: (number, prompt_id, prompt, extra_data, outputs_to_execute)
+                return [(item[1], (item[3] or {}).get("client_id")) for item in items]
 
-            # 检查是否超时
-            if time.time() - start_time > timeout:
-                raise Exception("Timeout reached while waiting for images.")
+            return {"success": True, "running": summarize(running), "pending": summarize(pending)}
 
-            if isinstance(out, str):
-                message = json.loads(out)
-                type = message.get('type')
-                data = message.get('data')
+        except Exception as e:
+            return {"success": False, "error": str(e)}
 
-                if type != 'crystools.monitor':
-                    logger.debug(f"Websock recv message: {out}")
-                
-                if type == 'executing':
-                    if data is None: 
-                        continue
-                    if data.get('prompt_id') != prompt_id:
-                        continue
-                    if data.get('node') is None:
-                       break  #Execution is done
-
-                if type == 'executed':
-                    if data is None: 
-                        continue
-                    if data.get('prompt_id') != prompt_id:
-                        continue
-                    output = data.get('output')
-                    if output is None:
-                        continue;                    
-                    images = output.get('images')
-                    if images is None:
-                        continue;
-                    
-                    node = data.get('node')
-                    output_images[node] = {'url':[],'file':[]}
-                    for image in images:                        
-                        url_values = urllib.parse.urlencode(image)
-                        output_images[node].get('url').append("{}://{}:{}/view?{}".format(self.scheme, self.address, self.port, url_values))
-                        import folder_paths
-                        output_dir = folder_paths.get_output_directory()
-                        output_images[node].get('file').append(os.path.join(output_dir, image.get('filename')))
+    def interrupt(self, prompt_id):
+        """
+        中断 ComfyFog 提交的 prompt：执行中的通过 ComfyUI 中断机制停止，排队中的从队列删除
+        只在该 prompt 确实属于 ComfyFog 且仍在执行/排队时操作，避免误中断本地用户的 prompt
+
+        Returns:
+            interrupted / removed，prompt 已不在队列中时返回 None
+        """
+        queue = self.get_queue()
+        if not queue["success"]:
+            logger.error(f"Failed to get ComfyUI queue: {queue['error']}")
+            return None
+
+        if (prompt_id, self.client_id) in queue["running"]:
+            if self.mode == "inprocess":
+                import nodes
+                nodes.interrupt_processing()
+            else:
+                url = f"{self.scheme}://{self.address}:{self.port}/interrupt"
+                requests.post(url, json={"prompt_id": prompt_id}, timeout=10)
+            return "interrupted"
+
+        if (prompt_id, self.client_id) in queue["pending"]:
+            if self.mode == "inprocess":
+                self.prompt_server.prompt_queue.delete_queue_item(lambda item: item[1] == prompt_id)
+            else:
+                url = f"{self.scheme}://{self.address}:{self.port}/queue"
+                requests.post(url, json={"delete": [prompt_id]}, timeout=10)
+            # 删除的 prompt 不会再有执行事件
+            self._ensure_listener().cancel(prompt_id, f"Prompt {prompt_id} removed from queue")
+            return "removed"
+
+        return None
+
+    def _ensure_listener(self):
+        """按需启动常驻事件监听器"""
+        if self.events is None:
+            if self.mode == "inprocess":
+                self.events = FogEventListener("inprocess", prompt_server=self.prompt_server)
+            else:
+                ws_scheme = "wss" if self.scheme == "https" else "ws"
+                ws_url = "{}://{}:{}/ws?clientId={}".format(ws_scheme, self.address, self.port, self.client_id)
+                self.events = FogEventListener("http", ws_url=ws_url)
+        self.events.start()
+        return self.events
+
+    def close(self):
+        """停止事件监听"""
+        if self.events is not None:
+            self.events.stop()
+
+    def _get_images(self, outputs):
+        """
+        将 executed 事件的输出转换为图片 url 及本地文件路径
+        FogMemorySaveImage 输出的图片在内存中，file 为 mem:// 引用，无 url
+        """
+        import folder_paths
+
+        output_images = {}
+        output_dir = folder_paths.get_output_directory()
+        for node, output in outputs.items():
+            images = output.get('images')
+            if images is None:
+                continue
+
+            output_images[node] = {'url':[],'file':[]}
+            for image in images:                        
+                if image.get('type') == 'fog_memory':
+                    output_images[node].get('url').append("")
+                    output_images[node].get('file').append(image.get('filename'))
+                    continue
+                url_values = urllib.parse.urlencode(image)
+                output_images[node].get('url').append("{}://{}:{}/view?{}".format(self.scheme, self.address, self.port, url_values))
+                output_images[node].get('file').append(os.path.join(output_dir, image.get('filename')))
         
         return output_images
     
-    def wait_websock_result(self, prompt_id):
+    def wait_websock_result(self, prompt_id, timeout=300, on_progress=None):
+        """
+        等待 prompt 执行结束并获取输出图片
+        事件由常驻监听器收集，prompt 需通过 submit_workflow 提交以确保提前注册
+
+        Args:
+            on_progress: 执行进度回调 on_progress(value, max, node)
+        """
         try:
-            ws = websocket.WebSocket()
-            ws.connect("ws://{}:{}/ws?clientId={}".format(self.address, self.port, self.client_id))
-            images = self._get_images(ws, prompt_id)
-            ws.close() 
+            watch = self._ensure_listener().wait(prompt_id, timeout, on_progress=on_progress)
+            with FOG_PROFILER.memory("_get_images"):
+                images = self._get_images(watch.outputs)
 
             return {
                 "success": True,
-                "images": images
+                "images": images,
+                "cached_nodes": watch.cached_nodes,
+                "timings": watch.timings()
             }
         
         except Exception as e:
@@ -213,8 +375,21 @@ class ComfyUIClient:
 
 
     def validate_prompt(self, prompt):
+        """
+        校验 workflow，校验通过的结果按图结构指纹缓存
+        同一模板仅 seed、提示词等不同的任务可跳过完整校验及模型目录扫描
+        """
         import execution
-        return execution.validate_prompt(prompt)
+
+        key = workflow_fingerprint(prompt)
+        valid = self.validation_cache.get(key)
+        if valid is not None:
+            logger.debug(f"Validation cache hit, fingerprint: {key}")
+            return valid
+
+        valid = execution.validate_prompt(prompt)
+        self.validation_cache.put(key, valid)
+        return valid
 
 
 
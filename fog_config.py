@@ -0,0 +1,226 @@
+import os
+import json
+import logging
+import threading
+
+from types import MappingProxyType
+from typing import Dict, Any, Callable, List
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+NUMBER = (int, float)
+
+# 配置项类型，未列出的配置项不校验
+CONFIG_SCHEMA = {
+    "enabled": bool,
+    "task_center_url": str,
+    "schedule": list,
+    "max_tasks_per_day": int,
+    "min_gpu_memory_available": NUMBER,
+    "retry_interval": NUMBER,
+    "max_retries": int,
+    "prefetch_queue_size": int,
+    "lease_batch_size": int,
+    "lease_seconds": int,
+    "long_poll_wait": NUMBER,
+    "fetch_backoff_max": NUMBER,
+    "outbox_max_pending": int,
+    "upload_workers": int,
+    "comfy_mode": str,
+    "comfy_url": str,
+    "validation_cache_size": int,
+    "output_capture": str,
+    "memory_budget_mb": NUMBER,
+    "transcode_workers": int,
+    "affinity_max_skips": int,
+    "model_prefetch": bool,
+    "prefetch_bandwidth_mb": NUMBER,
+    "prefetch_min_free_disk_gb": NUMBER,
+    "prefetch_page_cache": bool,
+    "inventory_hash_workers": int,
+    "inventory_scan_interval": NUMBER,
+    "coalesce_max_batch": int,
+    "coalesce_mb_per_megapixel": NUMBER,
+    "admission_control": bool,
+    "admission_backend": str,
+    "admission_defer_timeout": NUMBER,
+    "preempt_local": bool,
+    "preempt_check_interval": NUMBER,
+    "preempt_cooldown": NUMBER,
+    "trace_enabled": bool,
+    "trace_max": int,
+    "log_level": str,
+    "model_cache": dict,
+}
+
+# 取值范围限定的配置项
+CONFIG_CHOICES = {
+    "comfy_mode": ("inprocess", "http"),
+    "output_capture": ("memory", "disk"),
+    "admission_backend": ("comfy", "stub"),
+    "log_level": ("DEBUG", "INFO", "WARNING", "ERROR"),
+}
+
+
+def validate_config(config: Dict[str, Any]) -> List[str]:
+    """
+    按 CONFIG_SCHEMA 校验配置
+
+    Returns:
+        错误信息列表，为空表示通过
+    """
+    errors = []
+    for key, expected in CONFIG_SCHEMA.items():
+        if key not in config:
+            continue
+        value = config[key]
+        # bool 是 int 的子类，数值配置项不接受 true/false
+        if isinstance(value, bool) and expected is not bool:
+            errors.append(f"{key}: expect {_type_name(expected)}, got bool")
+        elif not isinstance(value, expected):
+            errors.append(f"{key}: expect {_type_name(expected)}, got {type(value).__name__}")
+        elif key in CONFIG_CHOICES and value not in CONFIG_CHOICES[key]:
+            errors.append(f"{key}: expect one of {list(CONFIG_CHOICES[key])}, got {value!r}")
+        elif expected is not bool and isinstance(value, NUMBER) and value < 0:
+            errors.append(f"{key}: must not be negative, got {value}")
+
+    for slot in config.get("schedule") or []:
+        if not isinstance(slot, dict) or not isinstance(slot.get("start"), str) or not isinstance(slot.get("end"), str):
+            errors.append(f"schedule: expect {{\"start\": \"HH:MM\", \"end\": \"HH:MM\"}}, got {slot!r}")
+    return errors
+
+
+def _type_name(expected) -> str:
+    if isinstance(expected, tuple):
+        return "number"
+    return expected.__name__
+
+
+def freeze(value):
+    """递归转换为只读结构：dict -> MappingProxyType，list -> tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """freeze 的逆操作，用于保存及修改"""
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class FogConfigStore:
+    """
+    配置文件的加载、校验与发布
+
+    启动时加载一次，之后 reload() 只比较文件的 mtime 及大小，文件变化时才重新解析；
+    校验失败时保留上一个有效配置。配置以只读快照发布，读取方通过 snapshot() 一次性取得
+    引用，不会读到更新到一半的配置。配置变化时按注册顺序调用订阅者 callback(old, new)。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.subscribers: List[Callable] = []
+        self._stamp = None
+        self._snapshot = freeze({})
+        self.reload()
+
+    def snapshot(self):
+        """当前配置的只读快照"""
+        return self._snapshot
+
+    def subscribe(self, callback: Callable):
+        """注册配置变化回调 callback(old, new)"""
+        self.subscribers.append(callback)
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def reload(self) -> bool:
+        """
+        配置文件变化时重新加载
+
+        Returns:
+            配置是否发生变化
+        """
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return False
+
+        with self.lock:
+            self._stamp = stamp
+            if stamp is None:
+                logger.warning(f"Config file not found: {self.path}")
+                return False
+            try:
+                with open(self.path, 'r') as f:
+                    config = json.load(f)
+            except Exception as e:
+                logger.error(f"Error loading config, keep previous: {e}")
+                return False
+
+            errors = validate_config(config) if isinstance(config, dict) else ["config must be an object"]
+            if errors:
+                logger.error(f"Invalid config, keep previous: {errors}")
+                return False
+            old = self._publish(config)
+
+        logger.info(f"Config reloaded from {self.path}")
+        return self._notify(old)
+
+    def update(self, changes: Dict[str, Any]):
+        """
+        合并更新配置并保存
+
+        Raises:
+            ValueError: 配置校验失败
+        """
+        with self.lock:
+            config = thaw(self._snapshot)
+            config.update(changes)
+            errors = validate_config(config)
+            if errors:
+                raise ValueError(f"Invalid config: {errors}")
+
+            # 先写临时文件再替换，避免其他读取方读到不完整的文件
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(config, f, indent=4)
+            os.replace(tmp_path, self.path)
+            self._stamp = self._file_stamp()
+            old = self._publish(config)
+
+        self._notify(old)
+        return self._snapshot
+
+    def _publish(self, config: Dict[str, Any]):
+        old = self._snapshot
+        self._snapshot = freeze(config)
+        return old
+
+    def _notify(self, old) -> bool:
+        new = self._snapshot
+        if old == new:
+            return False
+        for callback in list(self.subscribers):
+            try:
+                callback(old, new)
+            except Exception as e:
+                logger.error(f"Config subscriber error: {e}")
+        return True
+
+
+def changed_keys(old, new) -> List[str]:
+    """两个配置快照中取值不同的配置项"""
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
@@ -0,0 +1,325 @@
+import json
+import time
+import logging
+import threading
+import traceback
+
+from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+class PromptWatch:
+    """
+    单个 prompt 的执行事件收集
+    future 在 prompt 执行结束时完成，结果为 {node_id: output}
+    """
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.outputs = {}           # executed 事件的输出，按节点保存
+        self.cached_nodes = []      # execution_cached 事件中命中执行缓存的节点
+        self.future = Future()
+        self.registered = False     # 是否已有调用方注册等待
+        self.created_at = time.time()
+        self.started_at = None      # execution_start 事件时间
+        self.finished_at = None
+
+        # 各节点执行耗时，由相邻的 executing 事件计算
+        self.node_durations = {}
+        self.node_spans = []        # 按执行顺序的 (node_id, 开始时间, 结束时间)
+        self.current_node = None
+        self.current_since = None
+
+        # progress 事件：当前节点的进度，如采样步数
+        self.progress = None        # (value, max, node)
+        self.on_progress = None     # 回调 on_progress(value, max, node)
+
+    def node_started(self, node):
+        """executing 事件：上一个节点执行结束，node 开始执行，node 为 None 表示全部结束"""
+        now = time.time()
+        if self.current_node is not None:
+            self.node_durations[self.current_node] = now - self.current_since
+            self.node_spans.append((self.current_node, self.current_since, now))
+        self.current_node, self.current_since = node, now
+
+    def timings(self) -> dict:
+        """排队等待及执行耗时(秒)，事件缺失时为 None；各时间点为 time.time() 时间戳"""
+        return {
+            "queue_wait": self.started_at - self.created_at if self.started_at else None,
+            "execution": self.finished_at - self.started_at if self.started_at and self.finished_at else None,
+            "nodes": dict(self.node_durations),
+            "node_spans": list(self.node_spans),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+    def finish(self):
+        if not self.future.done():
+            self.node_started(None)
+            self.finished_at = time.time()
+            self.future.set_result(self.outputs)
+
+    def fail(self, error: str):
+        if not self.future.done():
+            self.future.set_exception(Exception(error))
+
+
+class FogEventListener:
+    """
+    常驻的 ComfyUI 执行事件监听器
+    将 executing / executed / execution_error 等事件按 prompt_id 路由到对应的 PromptWatch
+
+    事件来源：
+        inprocess: 挂接 PromptServer.send_sync，在 ComfyUI 进程内直接接收事件
+        http:      一个长连接 WebSocket 线程，断线自动重连
+    """
+    # 高频且无关的事件类型，按前缀过滤，避免无谓的 json 解析
+    # progress 事件只有已注册等待的 prompt 才会解析，progress_text / progress_state 等同前缀事件直接忽略
+    IGNORED_PREFIXES = ("crystools.", "status", "fog.")
+
+    # http 模式下允许缓存的未注册 prompt 数，用于处理提交返回前事件已到达的情况
+    MAX_ORPHANS = 64
+
+    # 所有 inprocess 监听器，send_sync 挂接只安装一次
+    _inprocess_listeners = set()
+    _inprocess_lock = threading.Lock()
+
+    def __init__(self, mode: str, ws_url: Optional[str] = None, prompt_server=None):
+        """
+        Args:
+            mode: inprocess 或 http
+            ws_url: http 模式下的 WebSocket 地址
+            prompt_server: inprocess 模式下的 PromptServer 实例
+        """
+        self.mode = mode
+        self.ws_url = ws_url
+        self.prompt_server = prompt_server
+
+        self.watches: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.connected = threading.Event()  # http 模式下 WebSocket 是否已连接
+
+        # json.dumps({"type": event, ...}) 的帧前缀
+        self._ignored_frames = tuple('{"type": "' + prefix for prefix in self.IGNORED_PREFIXES + ("progress_",))
+
+    def start(self):
+        """启动监听"""
+        if self.running:
+            return
+        self.running = True
+
+        if self.mode == "inprocess":
+            self._install_send_sync_hook(self.prompt_server)
+            with self._inprocess_lock:
+                self._inprocess_listeners.add(self)
+            self.connected.set()
+        else:
+            self.thread = threading.Thread(target=self._ws_loop, name="FogEvents", daemon=True)
+            self.thread.start()
+
+        logger.debug(f"FogEventListener started, mode: {self.mode}")
+
+    def stop(self):
+        """停止监听，未完成的等待全部以失败结束"""
+        if not self.running:
+            return
+        self.running = False
+
+        if self.mode == "inprocess":
+            with self._inprocess_lock:
+                self._inprocess_listeners.discard(self)
+        elif self.thread:
+            self.thread.join(timeout=2)
+
+        with self.lock:
+            for watch in self.watches.values():
+                watch.fail("FogEventListener stopped")
+            self.watches.clear()
+
+    def watch(self, prompt_id: str) -> PromptWatch:
+        """注册等待 prompt 的执行结果，需在提交前（inprocess）或提交后立即调用"""
+        with self.lock:
+            watch = self._get_watch(prompt_id, create=True)
+            watch.registered = True
+            return watch
+
+    def discard(self, prompt_id: str):
+        """放弃等待"""
+        with self.lock:
+            self.watches.pop(prompt_id, None)
+
+    def cancel(self, prompt_id: str, reason: str):
+        """以失败结束等待，用于不会再有执行事件的 prompt（如已从队列删除）"""
+        with self.lock:
+            watch = self.watches.get(prompt_id)
+            if watch is not None:
+                watch.fail(reason)
+
+    def wait(self, prompt_id: str, timeout: float, on_progress=None):
+        """
+        等待 prompt 执行结束
+
+        Args:
+            on_progress: 执行进度回调 on_progress(value, max, node)，在事件线程中调用，不应阻塞
+
+        Returns:
+            执行结束的 PromptWatch，outputs 为 {node_id: output}
+
+        Raises:
+            Exception: 执行失败、被中断或超时
+        """
+        watch = self.watch(prompt_id)
+        watch.on_progress = on_progress
+        try:
+            watch.future.result(timeout=timeout)
+            return watch
+        except FutureTimeoutError:
+            raise Exception(f"Timeout reached while waiting for prompt {prompt_id}.")
+        finally:
+            self.discard(prompt_id)
+
+    def _get_watch(self, prompt_id: str, create: bool) -> Optional[PromptWatch]:
+        watch = self.watches.get(prompt_id)
+        if watch is None and create:
+            watch = PromptWatch(prompt_id)
+            self.watches[prompt_id] = watch
+            self._trim_orphans()
+        return watch
+
+    def _trim_orphans(self):
+        """清理最早的未注册 prompt"""
+        orphans = [pid for pid, w in self.watches.items() if not w.registered]
+        for pid in orphans[:max(0, len(orphans) - self.MAX_ORPHANS)]:
+            del self.watches[pid]
+
+    def dispatch(self, event: str, data):
+        """处理一条 ComfyUI 事件"""
+        if not isinstance(event, str) or event.startswith(self.IGNORED_PREFIXES):
+            return
+        if not isinstance(data, dict):
+            return
+        prompt_id = data.get('prompt_id')
+        if prompt_id is None:
+            return
+
+        if event.startswith('progress'):
+            if event == 'progress':
+                self._dispatch_progress(prompt_id, data)
+            return
+
+        with self.lock:
+            # inprocess 模式下本地用户的 prompt 也会触发事件，只处理已注册的
+            watch = self._get_watch(prompt_id, create=(self.mode != "inprocess"))
+            if watch is None:
+                return
+
+            if event == 'executed':
+                node = data.get('node')
+                output = data.get('output')
+                if node is not None and output is not None:
+                    watch.outputs[node] = output
+
+            elif event == 'execution_start':
+                watch.started_at = time.time()
+
+            elif event == 'execution_cached':
+                watch.cached_nodes = list(data.get('nodes') or [])
+
+            elif event == 'executing':
+                watch.node_started(data.get('node'))
+                if data.get('node') is None:
+                    watch.finish()  # Execution is done
+
+            elif event == 'execution_success':
+                watch.finish()
+
+            elif event == 'execution_error':
+                watch.fail(f"Execution error on node {data.get('node_id')} ({data.get('node_type')}): {data.get('exception_message')}")
+
+            elif event == 'execution_interrupted':
+                watch.fail(f"Execution interrupted on node {data.get('node_id')}")
+
+    def _dispatch_progress(self, prompt_id: str, data: dict):
+        """progress 事件，只处理已注册的 prompt，回调在锁外执行"""
+        with self.lock:
+            watch = self.watches.get(prompt_id)
+            if watch is None or not watch.registered:
+                return
+            watch.progress = (data.get('value'), data.get('max'), data.get('node'))
+            callback = watch.on_progress
+        if callback is not None:
+            try:
+                callback(*watch.progress)
+            except Exception as e:
+                logger.debug(f"Progress callback error: {e}")
+
+    #  inprocess 事件源
+
+    @classmethod
+    def _install_send_sync_hook(cls, server):
+        """包装 PromptServer.send_sync，事件照常发送给前端，同时分发给监听器"""
+        with cls._inprocess_lock:
+            if getattr(server, "_fog_send_sync_hooked", False):
+                return
+
+            original_send_sync = server.send_sync
+
+            def send_sync(event, data, sid=None):
+                original_send_sync(event, data, sid)
+                if not cls._inprocess_listeners:
+                    return
+                try:
+                    for listener in list(cls._inprocess_listeners):
+                        listener.dispatch(event, data)
+                except Exception as e:
+                    logger.error(f"FogEventListener dispatch error: {e}")
+
+            server.send_sync = send_sync
+            server._fog_send_sync_hooked = True
+
+    #  http 事件源
+
+    def _ws_loop(self):
+        """WebSocket 长连接线程，断线后重连"""
+        import websocket
+
+        while self.running:
+            ws = None
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(self.ws_url)
+                ws.settimeout(1)  # 便于检查 running 标志
+                self.connected.set()
+                logger.debug(f"FogEventListener websocket connected: {self.ws_url}")
+
+                while self.running:
+                    try:
+                        out = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+
+                    # 二进制帧为预览图，忽略
+                    if not isinstance(out, str) or out.startswith(self._ignored_frames):
+                        continue
+
+                    message = json.loads(out)
+                    self.dispatch(message.get('type'), message.get('data'))
+
+            except Exception as e:
+                if self.running:
+                    logger.error(f"FogEventListener websocket error: {e}, reconnect later")
+                    logger.debug(traceback.format_exc())
+                    time.sleep(1)
+            finally:
+                self.connected.clear()
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
@@ -0,0 +1,228 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import traceback
+
+from typing import Optional, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+# 不是模型文件的目录
+EXCLUDED_FOLDERS = {"custom_nodes", "configs"}
+
+
+class ModelIndex:
+    """
+    本地模型文件索引
+
+    持久化记录 folder_paths.folder_names_and_paths 下所有模型文件（含 ComfyFog models/ 目录）的
+    size、mtime 及 sha256。FogInventory 线程定期扫描，只有新增或 size/mtime 变化的文件才重新计算 sha256，
+    哈希在线程池中分块读取计算，不阻塞扫描及推理。
+    通过模型缓存下载的文件直接使用缓存中已校验的 sha256。
+    """
+    HASH_BLOCK = 8 * 1024 * 1024
+
+    def __init__(self, db_path: Optional[str] = None, hash_workers: int = 2, scan_interval: float = 300, model_cache=None):
+        """
+        Args:
+            db_path: 索引数据库路径，默认为插件目录下 fog_inventory.db
+            hash_workers: 哈希计算线程数
+            scan_interval: 目录扫描间隔(秒)
+            model_cache: FogModelCache，其中的模型无需重新计算哈希
+        """
+        self.db_path = db_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "fog_inventory.db")
+        self.scan_interval = scan_interval
+        self.model_cache = model_cache
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._init_db()
+
+        self.hash_pool = ThreadPoolExecutor(max_workers=max(1, hash_workers), thread_name_prefix="FogHash")
+        self.hashing = set()        # 正在排队或计算哈希的路径
+
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _init_db(self):
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS models (
+                    path TEXT PRIMARY KEY,
+                    folder TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    sha256 TEXT,
+                    hashed_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_models_folder_name ON models (folder, name);
+            """)
+            self.db.commit()
+
+    def start(self):
+        if self.thread:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._worker, name="FogInventory", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=timeout)
+            self.thread = None
+        self.hash_pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        self.stop()
+        with self.lock:
+            self.db.close()
+
+    def _worker(self):
+        while not self.stop_event.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error(f"Model inventory scan error: {e}")
+                logger.error(traceback.format_exc())
+            self.stop_event.wait(self.scan_interval)
+
+    def _list_files(self) -> Dict[str, tuple]:
+        """当前磁盘上的模型文件，path -> (folder, name, size, mtime)"""
+        import folder_paths
+
+        files = {}
+        for folder, (paths, extensions) in list(folder_paths.folder_names_and_paths.items()):
+            if folder in EXCLUDED_FOLDERS:
+                continue
+            for base in paths:
+                if not os.path.isdir(base):
+                    continue
+                names = folder_paths.recursive_search(base, excluded_dir_names=[".git"])[0]
+                for name in folder_paths.filter_files_extensions(names, extensions):
+                    path = os.path.abspath(os.path.join(base, name))
+                    if path in files:
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (folder, name, stat.st_size, stat.st_mtime)
+        return files
+
+    def scan(self) -> Dict[str, int]:
+        """
+        扫描模型目录，更新索引并为新增或变化的文件排队计算哈希
+
+        Returns:
+            {"files": 文件数, "changed": 新增或变化数, "removed": 删除数}
+        """
+        files = self._list_files()
+        with self.lock:
+            known = {row[0]: row[1:] for row in self.db.execute("SELECT path, size, mtime, sha256 FROM models")}
+
+        changed = []
+        for path, (folder, name, size, mtime) in files.items():
+            row = known.get(path)
+            if row is None or row[0] != size or row[1] != mtime:
+                changed.append((path, folder, name, size, mtime))
+            elif row[2] is None:
+                self._submit_hash(path, size, mtime)
+
+        removed = [path for path in known if path not in files]
+
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO models (path, folder, name, size, mtime, sha256, hashed_at) VALUES (?, ?, ?, ?, ?, NULL, NULL)",
+                changed
+            )
+            self.db.executemany("DELETE FROM models WHERE path = ?", [(path,) for path in removed])
+            self.db.commit()
+
+        for path, folder, name, size, mtime in changed:
+            self._submit_hash(path, size, mtime)
+
+        if changed or removed:
+            logger.info(f"Model inventory scanned, {len(files)} files, {len(changed)} changed, {len(removed)} removed")
+        return {"files": len(files), "changed": len(changed), "removed": len(removed)}
+
+    def _submit_hash(self, path: str, size: int, mtime: float):
+        with self.lock:
+            if path in self.hashing:
+                return
+            self.hashing.add(path)
+        try:
+            self.hash_pool.submit(self._hash_file, path, size, mtime)
+        except RuntimeError:
+            # 线程池已关闭
+            with self.lock:
+                self.hashing.discard(path)
+
+    def _hash_file(self, path: str, size: int, mtime: float):
+        try:
+            sha256 = self.model_cache.hash_of_path(path) if self.model_cache is not None else None
+            if sha256 is None:
+                sha = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(self.HASH_BLOCK), b''):
+                        if self.stop_event.is_set():
+                            return
+                        sha.update(block)
+                sha256 = sha.hexdigest()
+
+            # 计算期间文件被修改则丢弃结果，等待下次扫描
+            stat = os.stat(path)
+            if stat.st_size != size or stat.st_mtime != mtime:
+                return
+
+            with self.lock:
+                self.db.execute(
+                    "UPDATE models SET sha256 = ?, hashed_at = ? WHERE path = ? AND size = ? AND mtime = ?",
+                    (sha256, time.time(), path, size, mtime)
+                )
+                self.db.commit()
+            logger.debug(f"Model hashed {path}: {sha256}")
+        except Exception as e:
+            logger.error(f"Failed to hash model {path}: {e}")
+        finally:
+            with self.lock:
+                self.hashing.discard(path)
+
+    def lookup(self, folder: str, name: str) -> Optional[str]:
+        """模型文件的 sha256，尚未计算或不存在时返回 None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha256 FROM models WHERE folder = ? AND name = ? AND sha256 IS NOT NULL LIMIT 1",
+                (folder, name)
+            ).fetchone()
+        return row[0] if row else None
+
+    def snapshot(self) -> Dict[str, Dict[str, str]]:
+        """已计算哈希的模型，{folder: {name: sha256}}，随任务获取请求上报"""
+        result: Dict[str, Dict[str, str]] = {}
+        with self.lock:
+            for folder, name, sha256 in self.db.execute("SELECT folder, name, sha256 FROM models WHERE sha256 IS NOT NULL"):
+                result.setdefault(folder, {}).setdefault(name, sha256)
+        return result
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """索引中的全部文件"""
+        with self.lock:
+            rows = self.db.execute("SELECT path, folder, name, size, mtime, sha256 FROM models ORDER BY folder, name").fetchall()
+        return [
+            {"path": path, "folder": folder, "name": name, "size": size, "mtime": mtime, "sha256": sha256}
+            for path, folder, name, size, mtime, sha256 in rows
+        ]
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            files, hashed = self.db.execute("SELECT COUNT(*), COUNT(sha256) FROM models").fetchone()
+            pending = len(self.hashing)
+        return {"files": files, "hashed": hashed, "pending": pending}
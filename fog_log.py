@@ -0,0 +1,202 @@
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+import logging.handlers
+
+from typing import Optional, Dict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# 当前线程处理的任务，写入每条日志的 task_id / prompt_id 字段
+_LOG_CONTEXT: contextvars.ContextVar = contextvars.ContextVar("fog_log_context", default={})
+
+# 日志中 workflow、上传结果等内容的默认长度上限
+PAYLOAD_LIMIT = 2048
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    with 块内当前线程的日志附带 fields，如 task_id、prompt_id，可嵌套
+    各线程的上下文相互独立，新线程从空上下文开始
+    """
+    token = _LOG_CONTEXT.set({**_LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        _LOG_CONTEXT.reset(token)
+
+
+class LogPayload:
+    """
+    日志中的大对象，格式化时才序列化，超过 limit 的部分截断
+    被级别或限流过滤掉的日志不会序列化
+    """
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = PAYLOAD_LIMIT):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        try:
+            text = json.dumps(self.value, ensure_ascii=False, default=str)
+        except Exception:
+            text = repr(self.value)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}...({len(text)} chars)"
+        return text
+
+
+def payload(value, limit: int = PAYLOAD_LIMIT) -> LogPayload:
+    """logger.debug("workflow: %s", payload(workflow))"""
+    return LogPayload(value, limit)
+
+
+class ContextFilter(logging.Filter):
+    """在记录日志的线程中附加关联 ID，需在入队前执行"""
+
+    def filter(self, record):
+        for key, value in _LOG_CONTEXT.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    DEBUG 日志按调用位置限流：每个位置最多突发 burst 条，之后每秒补充 rate 条
+    被丢弃的条数记在该位置下一条输出日志的 suppressed 字段中
+    """
+    def __init__(self, rate: float = 0.2, burst: int = 5):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[tuple, list] = {}     # (pathname, lineno) -> [tokens, updated_at, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON"""
+    FIELDS = ("task_id", "prompt_id", "suppressed")
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class FogQueueHandler(logging.handlers.QueueHandler):
+    """
+    日志放入有界队列，由 QueueListener 线程写文件，调用线程不做磁盘 IO
+    队列满时丢弃并计数，不阻塞调用线程
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # 在调用线程中格式化消息，避免参数对象入队后被修改
+        record = super().prepare(record)
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            record.suppressed = getattr(record, "suppressed", 0) + dropped
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+
+def setup_logging(logger: logging.Logger, log_file: str, level: int = logging.INFO, queue_size: int = 10000,
+                  debug_rate: float = 0.2, debug_burst: int = 5) -> logging.handlers.QueueListener:
+    """
+    配置异步 JSON 日志：logger -> FogQueueHandler -> QueueListener 线程 -> RotatingFileHandler
+
+    Args:
+        log_file: 日志文件，5MB 回滚，保留 5 个
+        level: 日志级别
+        queue_size: 日志队列容量
+        debug_rate: 每个调用位置每秒输出的 DEBUG 日志数
+        debug_burst: 每个调用位置 DEBUG 日志的突发条数
+
+    Returns:
+        QueueListener，进程退出时自动停止并写完队列中的日志
+    """
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file,
+        maxBytes=5 * 1024 * 1024,
+        backupCount=5,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = FogQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate=debug_rate, burst=debug_burst))
+    queue_handler.addFilter(ContextFilter())
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+
+    def stop_listener():
+        # 已手动停止时 QueueListener.stop 会出错
+        if listener._thread is not None:
+            listener.stop()
+    atexit.register(stop_listener)
+
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    return listener
+
+
+def set_level(logger: logging.Logger, level: Optional[str]):
+    """按配置中的级别名设置日志级别"""
+    if not level:
+        return
+    value = logging.getLevelName(str(level).upper())
+    if isinstance(value, int):
+        logger.setLevel(value)
+    else:
+        logger.warning(f"Unknown log level {level}")
@@ -1,15 +1,20 @@
 import os
-import json
+import atexit
 import time
 import threading
 import logging
 import traceback  # 导入 traceback 模块
 from typing import Optional
 
+from .fog_config import FogConfigStore, changed_keys, thaw
 from .fog_model import FogModel
+from .fog_inventory import ModelIndex
 from .fog_client import FogClient
-from .fog_comfy import ComfyUIClient
 from .fog_scheduler import FogScheduler
+from .fog_trace import FOG_TRACER
+from .fog_profile import FOG_PROFILER
+from .fog_status import FOG_STATUS
+from .fog_log import set_level
 
 
 
@@ -17,24 +22,34 @@ logger = logging.getLogger('ComfyFog')
 
 class FogManager:
     """ComfyFog插件的核心管理类"""
-    
+
+    # 无需重启即可生效的配置项，其余配置项在重启 ComfyUI 后生效
+    RELOADABLE_KEYS = {"enabled", "schedule", "max_tasks_per_day", "task_center_url", "upload_workers",
+                       "trace_enabled", "trace_max", "log_level"}
+
     def __init__(self):
         """初始化Fog管理器"""
         try:
-            # 1. 初始化配置
-            self.config = self._load_config()
+            # 1. 初始化配置，配置文件变化时由监控线程重新加载
+            self.lock = threading.Lock()
+            self.config_store = FogConfigStore(os.path.join(os.path.dirname(__file__), 'config.json'))
             
             # 2. 初始化组件
-            self.config.get('task_center_url',"https://control.comfyfog.org/schedule/task")
-            self.client = FogClient(self.config['task_center_url'])
-            self.scheduler = FogScheduler(self.client)
-            self.comfy_client =  ComfyUIClient()
-            self.model = FogModel();
-            
-            # 3. 初始化线程安全锁
-            self.lock = threading.Lock()
+            config = self.config
+            set_level(logger, config.get("log_level"))
+            self.model = FogModel(config.get("model_cache"))
+            self.index = ModelIndex(
+                hash_workers=config.get("inventory_hash_workers", 2),
+                scan_interval=config.get("inventory_scan_interval", 300),
+                model_cache=self.model.cache
+            )
+            self.index.start()
+            self.client = self._create_client()
+            self.scheduler = self._create_scheduler(self.client)
+            self.config_store.subscribe(self._on_config_change)
+            self._init_status()
             
-            # 4. 启动监控线程
+            # 3. 启动监控线程
             self.running = True 
             self._start_monitor_thread()
             
@@ -49,20 +64,94 @@ class FogManager:
             self.running = False
             raise
    
+    @property
+    def config(self):
+        """当前配置的只读快照"""
+        return self.config_store.snapshot()
+
+    def _create_client(self):
+        """创建任务中心客户端"""
+        config = self.config
+        return FogClient(
+            config.get('task_center_url', "https://control.comfyfog.org/schedule/task"),
+            upload_workers=config.get("upload_workers", 4)
+        )
+
+    def _create_scheduler(self, client):
+        """创建并启动任务调度流水线"""
+        config = self.config
+        scheduler = FogScheduler(
+            client,
+            prefetch_size=config.get("prefetch_queue_size", 1),
+            comfy_mode=config.get("comfy_mode", "inprocess"),
+            comfy_url=config.get("comfy_url") or None,
+            retry_interval=config.get("retry_interval", 5),
+            max_retries=config.get("max_retries", 3),
+            outbox_max_pending=config.get("outbox_max_pending", 100),
+            lease_batch_size=config.get("lease_batch_size", 1),
+            lease_seconds=config.get("lease_seconds", 300),
+            long_poll_wait=config.get("long_poll_wait", 20),
+            fetch_backoff_max=config.get("fetch_backoff_max", 60),
+            validation_cache_size=config.get("validation_cache_size", 64),
+            output_capture=config.get("output_capture", "memory"),
+            memory_budget_mb=config.get("memory_budget_mb", 512),
+            transcode_workers=config.get("transcode_workers", 2),
+            affinity_max_skips=config.get("affinity_max_skips", 3),
+            model_cache=self.model.cache,
+            model_prefetch=config.get("model_prefetch", True),
+            prefetch_bandwidth_mb=config.get("prefetch_bandwidth_mb", 100),
+            prefetch_min_free_disk_gb=config.get("prefetch_min_free_disk_gb", 20),
+            prefetch_page_cache=config.get("prefetch_page_cache", True),
+            model_index=self.index,
+            coalesce_max_batch=config.get("coalesce_max_batch", 0),
+            min_gpu_memory_available=config.get("min_gpu_memory_available", 4000),
+            coalesce_mb_per_megapixel=config.get("coalesce_mb_per_megapixel", 1024),
+            admission_control=config.get("admission_control", True),
+            admission_backend=config.get("admission_backend", "comfy"),
+            admission_defer_timeout=config.get("admission_defer_timeout", 300),
+            preempt_local=config.get("preempt_local", True),
+            preempt_check_interval=config.get("preempt_check_interval", 0.5),
+            preempt_cooldown=config.get("preempt_cooldown", 30),
+            trace_enabled=config.get("trace_enabled", False),
+            trace_max=config.get("trace_max", 50),
+            schedule=thaw(config.get("schedule", ())),
+            max_tasks_per_day=config.get("max_tasks_per_day", 0)
+        )
+        scheduler.start()
+        return scheduler
+
+    def _init_status(self):
+        """状态变化通过 ComfyUI 的 WebSocket 推送给前端面板"""
+        try:
+            from server import PromptServer
+            if PromptServer.instance is not None:
+                FOG_STATUS.set_sender(PromptServer.instance.send_sync)
+        except ImportError:
+            logger.warning("PromptServer not available, status updates will not be pushed")
+        config = self.config
+        FOG_STATUS.configure(config.get("enabled", False), thaw(config.get("schedule", ())),
+                             scheduler_active=bool(self.scheduler))
+
     def _start_monitor_thread(self):
         """启动监控线程"""
         def monitor_loop():
-            time.sleep(5) # 等待ComfyUI 完成加载并启动
+            # 由 ComfyUI 服务启动事件或首次路由访问创建，此时 ComfyUI 已完成加载，无需等待
             while self.running:
                 try:
                     logger.debug(f"-------------------- ComfyFog Task Process Working Start -----------------------\n")  
                     
                     self.model.get_folder_paths_info();
 
-                    self.config = self._load_config() 
+                    # 只比较配置文件的 mtime，变化时才重新加载
+                    self.config_store.reload()
 
-                    if self.scheduler and self.config.get("enabled"):
-                        self.scheduler.process_task()
+                    if self.scheduler:
+                        with FOG_PROFILER.profile("FogMonitor"):
+                            if self.config.get("enabled"):
+                                self.scheduler.process_task()
+                            else:
+                                # 停用后不再获取新任务，已租约的排队及推理中任务仍需续约
+                                self.scheduler.renew_leases()
 
 
                 except Exception as e:
@@ -81,66 +170,109 @@ class FogManager:
     #  ROUTES API LIST
 
     def get_status(self):
-        """获取当前状态"""
-        with self.lock:
-            return {
-                "enabled": self.config.get("enabled", False),
-                "scheduler_active": bool(self.scheduler),
-                "current_task": self.scheduler.current_task if self.scheduler else None,
-                "schedule": self.config.get("schedule", [])
-            }
+        """获取当前状态，来自增量维护的状态快照，无需获取 self.lock"""
+        status = FOG_STATUS.snapshot()
+        scheduler = self.scheduler
+        status["execution_cache"] = scheduler.similarity.stats() if scheduler else None
+        status["admission"] = scheduler.admission.stats() if scheduler and scheduler.admission else None
+        status["preempted"] = scheduler.preempt_count if scheduler else 0
+        return status
+
+    def get_inventory(self):
+        """获取本地模型索引"""
+        return {
+            "models": self.index.entries(),
+            "stats": self.index.stats()
+        }
+
+    def get_trace(self, task_id):
+        """获取任务的 Chrome trace，没有记录时返回 None"""
+        return FOG_TRACER.get(task_id)
+
+    def start_profile(self, options):
+        """开始性能分析会话"""
+        return FOG_PROFILER.start(**options)
+
+    def stop_profile(self):
+        """结束性能分析会话"""
+        return FOG_PROFILER.stop()
+
+    def get_profile(self):
+        """性能分析状态及已保存的结果"""
+        return FOG_PROFILER.status()
+
+    def get_profile_artifact(self, session_id, name):
+        """读取性能分析结果文件，不存在时返回 None"""
+        return FOG_PROFILER.artifact(session_id, name)
 
     def update_config(self, new_config):
-        """更新配置"""
-        with self.lock:
-            try:
-                self.config.update(new_config)
-                self._save_config()
-                
-                # 如果URL改变，重新初始化client
-                if 'task_center_url' in new_config:
-                    self.config.get('task_center_url',"https://control.comfyfog.org/schedule/task")
-                    self.client = FogClient(self.config['task_center_url'])
-                    self.scheduler = FogScheduler(self.client)
-                
-                return {"status": "success"}
-            except Exception as e:
-                logger.error(f"Failed to update config: {e}")
-                return {"status": "error", "message": str(e)}
+        """更新配置，保存后通过配置变化回调生效"""
+        try:
+            self.config_store.update(new_config)
+            return {"status": "success"}
+        except Exception as e:
+            logger.error(f"Failed to update config: {e}")
+            return {"status": "error", "message": str(e)}
+
+    def _on_config_change(self, old, new):
+        """配置变化回调"""
+        changed = changed_keys(old, new)
+        logger.info(f"Config changed: {changed}")
+
+        # 任务中心地址变化时重建 FogClient 并切换，排队、推理及待上传的任务不受影响
+        if "task_center_url" in changed or "upload_workers" in changed:
+            with self.lock:
+                old_client = self.client
+                self.client = self._create_client()
+                self.scheduler.set_client(self.client)
+            # 等待旧客户端进行中的上传结束后再关闭
+            threading.Thread(target=old_client.close, kwargs={"wait": True}, name="FogClientClose", daemon=True).start()
+            logger.info(f"FogClient switched to {new.get('task_center_url')}")
+
+        if "trace_enabled" in changed or "trace_max" in changed:
+            FOG_TRACER.configure(new.get("trace_enabled", False), new.get("trace_max", 50))
+
+        if "log_level" in changed:
+            set_level(logger, new.get("log_level"))
 
+        if "schedule" in changed or "max_tasks_per_day" in changed:
+            self.scheduler.configure(thaw(new.get("schedule", ())), new.get("max_tasks_per_day", 0))
+
+        if "enabled" in changed or "schedule" in changed:
+            FOG_STATUS.configure(new.get("enabled", False), thaw(new.get("schedule", ())))
+
+        restart = [key for key in changed if key not in self.RELOADABLE_KEYS]
+        if restart:
+            logger.warning(f"Config changes take effect after restart: {restart}")
 
 
     def __del__(self):
         """清理资源"""
+        self.shutdown(timeout=1)
+
+    def shutdown(self, timeout: float = 5):
+        """
+        停止监控线程及任务流水线，可重复调用
+        由进程退出时的 atexit 调用：未开始的任务释放租约，未上传的内存图片落盘，重启后继续上传
+        """
+        if getattr(self, '_shutdown', False):
+            return
+        self._shutdown = True
         try:
             self.running = False
             if hasattr(self, 'monitor_thread'):
                 self.monitor_thread.join(timeout=1)
+            if hasattr(self, 'scheduler'):
+                self.scheduler.stop(timeout=timeout)
             if hasattr(self, 'client'):
-                self.client.session.close()
+                self.client.close()
+            if hasattr(self, 'index'):
+                self.index.close()
+            if hasattr(self, 'model'):
+                self.model.close()
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
 
-    def _load_config(self):
-        """加载配置文件"""
-        self.config_file = os.path.join(os.path.dirname(__file__), 'config.json')
-        try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r') as f:
-                    return json.load(f)
-            return {}  # 默认空配置
-        except Exception as e:
-            logger.error(f"Error loading config: {e}")
-            return {}
-            
-    def _save_config(self):
-        """保存配置文件"""
-        try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving config: {e}")
-
     def get_history(self, limit: int = 10, status: Optional[str] = None):
         """获取任务历史"""
         filtered_history = self.history
@@ -151,4 +283,23 @@ class FogManager:
     def clear_history(self):
         """清除历史记录"""
         self.history = []
-        
\ No newline at end of file
+        
+
+
+_fog_manager: Optional[FogManager] = None
+_fog_manager_lock = threading.Lock()
+
+
+def get_fog_manager() -> FogManager:
+    """
+    获取 FogManager 单例，首次调用时创建并启动
+    由 ComfyUI 服务启动事件或首次访问 /fog 路由触发，导入插件时不创建
+    """
+    global _fog_manager
+    if _fog_manager is None:
+        with _fog_manager_lock:
+            if _fog_manager is None:
+                _fog_manager = FogManager()
+                # 单例在进程存活期间不会被回收，__del__ 不会执行
+                atexit.register(_fog_manager.shutdown)
+    return _fog_manager
@@ -2,11 +2,16 @@ import os
 import logging
 import folder_paths
 
+from typing import Optional
+
 logger = logging.getLogger('ComfyFog')
 
+# ComfyFog 额外模型目录，通常为 s3fs 挂载的远程目录
+FOG_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
 
 class FogModel:
-    def __init__(self):
+    def __init__(self, cache_config: Optional[dict] = None):
          
         # 添加ComfyFog 额外模型目录 comfyfog/models，通常为远程目录，本地comfyui模型目录优先
         
@@ -14,12 +19,42 @@ class FogModel:
         self._add_model_folder_path("controlnet")
         self._add_model_folder_path("loras")
 
+        # 远程模型本地缓存，任务执行前按需并行下载缺失模型
+        self.cache = self._create_cache(cache_config or {})
+
+        # 上次记录的模型目录，只在变化时输出
+        self._folder_paths_info = None
+
         return
+
+    def _create_cache(self, cache_config: dict):
+        """根据 config.json 中的 model_cache 创建 FogModelCache，未启用时返回 None"""
+        if not cache_config.get("enabled") or not cache_config.get("base_url"):
+            return None
+
+        from .fog_model_cache import FogModelCache
+        from .fog_affinity import MODEL_INPUTS
+
+        cache = FogModelCache(
+            cache_config["base_url"],
+            cache_config.get("cache_dir") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache"),
+            max_size_gb=cache_config.get("max_size_gb", 200),
+            pinned=cache_config.get("pinned", []),
+            download_workers=cache_config.get("download_workers", 8),
+            chunk_mb=cache_config.get("chunk_mb", 64),
+            bandwidth_mb=cache_config.get("bandwidth_mb", 0)
+        )
+        cache.register_folder_paths(sorted(set(MODEL_INPUTS.values())))
+        logger.info(f"Model cache enabled, base_url: {cache_config['base_url']}, cache_dir: {cache.cache_dir}")
+        return cache
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
     
     def _add_model_folder_path(self, folder_name):
         
-        fog_model_base_dir = os.path.join(os.path.dirname(__file__), "models")
-        fog_mode_dir = os.path.join(fog_model_base_dir, folder_name)
+        fog_mode_dir = os.path.join(FOG_MODEL_DIR, folder_name)
         folder_paths.add_model_folder_path(folder_name, fog_mode_dir)
         if not os.path.exists(fog_mode_dir):
             os.makedirs(fog_mode_dir)
@@ -27,9 +62,12 @@ class FogModel:
         return 
 
     def get_folder_paths_info(self):
-
+        """folder_paths 模型目录发生变化时记录日志"""
         try:
-            logger.debug( f"【folder_paths info】\n {folder_paths.folder_names_and_paths}")
+            info = repr(folder_paths.folder_names_and_paths)
+            if info != self._folder_paths_info:
+                self._folder_paths_info = info
+                logger.debug(f"【folder_paths info】\n {info}")
         except Exception as e:
             logger.error(f"Failed to get get_folder_paths: {e}")        
 
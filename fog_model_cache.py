@@ -0,0 +1,350 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import urllib.parse
+
+from typing import Optional, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+class FogModelCache:
+    """
+    远程模型本地缓存
+
+    模型桶根目录下的 manifest.json 描述可用模型：
+        {"checkpoints": {"v1-5.safetensors": {"size": 2132625894, "sha256": "...", "path": "checkpoints/v1-5.safetensors"}}}
+    模型按 sha256 存放在 cache_dir/objects 下（内容寻址），再以硬链接形式放到
+    cache_dir/links/<folder>/<filename>，该目录注册到 folder_paths，与 FogModel 的 models/ 目录一样被 ComfyUI 加载。
+
+    下载使用多个 HTTP Range 请求并行写入同一文件，完成后校验大小及 sha256；
+    缓存总大小超过 max_size 时按最近使用时间淘汰，pinned 中的模型（如底模）不淘汰。
+    """
+    def __init__(self, base_url: str, cache_dir: str, max_size_gb: float = 200, pinned: Optional[List[str]] = None,
+                 download_workers: int = 8, chunk_mb: int = 64, bandwidth_mb: float = 0):
+        """
+        Args:
+            base_url: 模型桶地址，manifest.json 及模型文件相对于此地址
+            cache_dir: 本地缓存目录
+            max_size_gb: 缓存总大小上限(GB)
+            pinned: 不淘汰的模型，格式 "folder/filename"
+            download_workers: 并行 Range 请求数
+            chunk_mb: 每个 Range 请求的大小(MB)
+            bandwidth_mb: 下载限速(MB/s)，0 为不限速
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.links_dir = os.path.join(cache_dir, "links")
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.pinned = set(pinned or [])
+        self.download_workers = max(1, download_workers)
+        self.chunk_size = max(1, chunk_mb) * 1024 * 1024
+        self.bandwidth = bandwidth_mb * 1024 * 1024
+        self.timeout = 30
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.links_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.download_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        self.manifest_at = 0.0
+        self.manifest_ttl = 300
+
+        self.lock = threading.Lock()
+        self.downloading: Dict[str, threading.Event] = {}   # "folder/name" -> 下载完成事件
+        self.throttles: Dict[str, float] = {}               # "folder/name" -> 下载限速(字节/秒)
+        self.throttle_clocks: Dict[str, float] = {}         # "folder/name" -> 已分配的发送时间，各下载线程共享
+
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.db"), check_same_thread=False)
+        self._init_db()
+
+    def _init_db(self):
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS links (
+                    folder TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    PRIMARY KEY (folder, name)
+                );
+            """)
+            self.db.commit()
+
+    def close(self):
+        self.session.close()
+        with self.lock:
+            self.db.close()
+
+    def register_folder_paths(self, folder_names: List[str]):
+        """将各模型目录的链接目录注册到 folder_paths"""
+        import folder_paths
+        for folder_name in folder_names:
+            link_dir = os.path.join(self.links_dir, folder_name)
+            os.makedirs(link_dir, exist_ok=True)
+            folder_paths.add_model_folder_path(folder_name, link_dir)
+
+    #  manifest
+
+    def _get_manifest(self) -> Dict[str, Dict[str, Any]]:
+        if self.manifest and time.time() - self.manifest_at < self.manifest_ttl:
+            return self.manifest
+        response = self.session.get(f"{self.base_url}/manifest.json", timeout=self.timeout)
+        if response.status_code != 200:
+            raise Exception(f"Failed to get model manifest: {response.status_code}")
+        self.manifest = response.json()
+        self.manifest_at = time.time()
+        return self.manifest
+
+    def lookup(self, folder: str, name: str) -> Optional[Dict[str, Any]]:
+        """manifest 中的模型信息，不存在时返回 None"""
+        return self._get_manifest().get(folder, {}).get(name)
+
+    #  cache
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def _link_path(self, folder: str, name: str) -> str:
+        return os.path.join(self.links_dir, folder, name)
+
+    def cached_path(self, folder: str, name: str) -> Optional[str]:
+        """已缓存模型的本地路径，并更新最近使用时间"""
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM links WHERE folder = ? AND name = ?", (folder, name)).fetchone()
+            if row is None:
+                return None
+            path = self._link_path(folder, name)
+            if not os.path.exists(path):
+                return None
+            self.db.execute("UPDATE objects SET last_access = ? WHERE sha256 = ?", (time.time(), row[0]))
+            self.db.commit()
+            return path
+
+    def hash_of_path(self, path: str) -> Optional[str]:
+        """缓存链接文件对应的 sha256，不是缓存中的文件时返回 None"""
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(self.links_dir))
+        if rel.startswith(os.pardir):
+            return None
+        folder, _, name = rel.partition(os.sep)
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM links WHERE folder = ? AND name = ?", (folder, name)).fetchone()
+        return row[0] if row else None
+
+    def ensure(self, folder: str, name: str, bandwidth_mb: Optional[float] = None) -> Optional[str]:
+        """
+        确保模型已缓存到本地，必要时下载；同一模型并发调用只下载一次
+
+        Args:
+            bandwidth_mb: 本次下载限速(MB/s)，为 None 时使用默认限速；
+                          未指定限速的调用等待限速中的下载（如预取）时，该下载恢复默认限速
+
+        Returns:
+            本地路径，manifest 中不存在该模型时返回 None
+
+        Raises:
+            Exception: 下载或校验失败
+        """
+        path = self.cached_path(folder, name)
+        if path:
+            return path
+
+        key = f"{folder}/{name}"
+        with self.lock:
+            event = self.downloading.get(key)
+            owner = event is None
+            if owner:
+                event = self.downloading[key] = threading.Event()
+                self.throttles[key] = self.bandwidth if bandwidth_mb is None else bandwidth_mb * 1024 * 1024
+            elif bandwidth_mb is None:
+                self.throttles[key] = self.bandwidth
+
+        if not owner:
+            event.wait()
+            return self.cached_path(folder, name)
+
+        try:
+            info = self.lookup(folder, name)
+            if info is None:
+                return None
+            return self._download(folder, name, info)
+        finally:
+            with self.lock:
+                self.downloading.pop(key, None)
+                self.throttles.pop(key, None)
+                self.throttle_clocks.pop(key, None)
+            event.set()
+
+    def _download(self, folder: str, name: str, info: Dict[str, Any]) -> str:
+        size = int(info["size"])
+        sha256 = info.get("sha256")
+        url = f"{self.base_url}/{urllib.parse.quote(info.get('path') or f'{folder}/{name}')}"
+
+        # 内容相同的模型已在缓存中，只需建立链接
+        if sha256 and os.path.exists(self._object_path(sha256)):
+            return self._link(folder, name, sha256, size)
+
+        self._evict(size)
+
+        # 临时文件名唯一，不同目录下的同名模型及并发下载互不影响
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix=".", suffix=".part")
+        start = time.time()
+        logger.info(f"Model download start, {folder}/{name}, size: {size}, url: {url}")
+        try:
+            try:
+                os.ftruncate(fd, size)
+                if self._supports_range(url):
+                    ranges = [(offset, min(offset + self.chunk_size, size) - 1) for offset in range(0, size, self.chunk_size)]
+                else:
+                    logger.warning(f"Model bucket does not support range requests, single stream download: {url}")
+                    ranges = [(0, size - 1)]
+                with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="FogModelDownload") as pool:
+                    for future in [pool.submit(self._download_range, url, fd, a, b, f"{folder}/{name}") for a, b in ranges]:
+                        future.result()
+            finally:
+                os.close(fd)
+
+            digest = self._sha256(tmp_path)
+            if sha256 and digest != sha256:
+                raise Exception(f"sha256 mismatch, expect {sha256}, got {digest}")
+
+            object_path = self._object_path(digest)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        elapsed = max(time.time() - start, 1e-6)
+        logger.info(f"Model download completed, {folder}/{name}, {size / elapsed / 1024 / 1024:.1f} MB/s")
+        return self._link(folder, name, digest, size)
+
+    def _supports_range(self, url: str) -> bool:
+        try:
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            return response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        except Exception as e:
+            logger.warning(f"Model HEAD request failed: {e}")
+            return False
+
+    def _download_range(self, url: str, fd: int, first: int, last: int, key: str):
+        """下载一个字节区间，按块写入文件对应位置"""
+        response = self.session.get(url, headers={'Range': f"bytes={first}-{last}"}, stream=True, timeout=self.timeout)
+        try:
+            # 不支持 Range 时只有整个文件一个区间，接受 200
+            if response.status_code != 206 and not (response.status_code == 200 and first == 0):
+                raise Exception(f"Model download failed, range {first}-{last}: {response.status_code}")
+            offset = first
+            for block in response.iter_content(chunk_size=1024 * 1024):
+                os.pwrite(fd, block, offset)
+                offset += len(block)
+                self._throttle(len(block), key)
+            if offset != last + 1:
+                raise Exception(f"Incomplete range {first}-{last}, got {offset - first} bytes")
+        finally:
+            response.close()
+
+    def _throttle(self, nbytes: int, key: str):
+        """
+        按该下载的限速等待，该下载的所有 Range 线程共享同一时间线，合计不超过限速；
+        等待中限速调整（如预取转为按需下载）立即生效
+        """
+        with self.lock:
+            bandwidth = self.throttles.get(key, self.bandwidth)
+            if bandwidth <= 0:
+                return
+            start = max(self.throttle_clocks.get(key, 0), time.time())
+            self.throttle_clocks[key] = start + nbytes / bandwidth
+
+        while True:
+            bandwidth = self.throttles.get(key, self.bandwidth)
+            if bandwidth <= 0:
+                return
+            remaining = start + nbytes / bandwidth - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.1))
+
+    @staticmethod
+    def _sha256(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def _link(self, folder: str, name: str, sha256: str, size: int) -> str:
+        """为缓存对象建立链接并记录索引"""
+        link_path = self._link_path(folder, name)
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.link(self._object_path(sha256), link_path)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects (sha256, size, last_access) VALUES (?, ?, ?)", (sha256, size, time.time()))
+            self.db.execute("INSERT OR REPLACE INTO links (folder, name, sha256) VALUES (?, ?, ?)", (folder, name, sha256))
+            self.db.commit()
+        return link_path
+
+    def _evict(self, incoming: int):
+        """按最近使用时间淘汰，为 incoming 字节腾出空间"""
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total + incoming <= self.max_size:
+                return
+
+            pinned = set()
+            for folder, name, sha256 in self.db.execute("SELECT folder, name, sha256 FROM links"):
+                if f"{folder}/{name}" in self.pinned:
+                    pinned.add(sha256)
+
+            for sha256, size in self.db.execute("SELECT sha256, size FROM objects ORDER BY last_access").fetchall():
+                if total + incoming <= self.max_size:
+                    break
+                if sha256 in pinned:
+                    continue
+                for folder, name in self.db.execute("SELECT folder, name FROM links WHERE sha256 = ?", (sha256,)).fetchall():
+                    try:
+                        os.remove(self._link_path(folder, name))
+                    except OSError:
+                        pass
+                try:
+                    os.remove(self._object_path(sha256))
+                except OSError:
+                    pass
+                self.db.execute("DELETE FROM links WHERE sha256 = ?", (sha256,))
+                self.db.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+                total -= size
+                logger.info(f"Model cache evicted {sha256}, size: {size}")
+
+            self.db.commit()
+            if total + incoming > self.max_size:
+                logger.warning(f"Model cache over budget after eviction, total: {total}, incoming: {incoming}")
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+        return {"objects": count, "size": total, "max_size": self.max_size}
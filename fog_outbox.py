@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import traceback
+
+from typing import Optional, Dict, Any
+
+from .fog_capture import FOG_IMAGE_STORE
+from .fog_metrics import STAGE_SECONDS, UPLOAD_RETRIES_TOTAL, UPLOAD_FAILURES_TOTAL
+from .fog_trace import FOG_TRACER
+from .fog_profile import FOG_PROFILER
+from .fog_status import FOG_STATUS
+from .fog_log import log_context, payload
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+class FogOutbox:
+    """
+    持久化上传队列（SQLite）
+
+    推理完成后先将任务 meta 及图片路径写入 outbox 表，再由后台线程上传；
+    上传失败按 retry_interval 指数退避重试，超过 max_retries 后转入 dead_letter 表。
+    图片文件只在上传成功后删除，因此 ComfyUI 重启后未完成的上传会继续进行。
+    """
+    def __init__(self, fog_client, db_path: Optional[str] = None, retry_interval: float = 5,
+                 max_retries: int = 3, max_pending: int = 100, max_backoff: float = 600):
+        """
+        Args:
+            fog_client: FogClient实例，用于上传图片
+            db_path: SQLite 文件路径，默认为插件目录下 fog_outbox.db
+            retry_interval: 首次重试间隔(秒)，之后每次翻倍
+            max_retries: 最大重试次数，超过后转入 dead_letter
+            max_pending: 待上传任务上限，达到上限时 put 阻塞
+            max_backoff: 重试间隔上限(秒)
+        """
+        self.fog_client = fog_client
+        self.db_path = db_path or os.path.join(os.path.dirname(__file__), "fog_outbox.db")
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.max_pending = max(1, max_pending)
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._init_db()
+
+    def _init_db(self):
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    task_id TEXT NOT NULL,
+                    meta TEXT NOT NULL,
+                    images TEXT NOT NULL,
+                    done TEXT NOT NULL DEFAULT '[]',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_outbox_next ON outbox(next_attempt_at);
+                CREATE TABLE IF NOT EXISTS dead_letter (
+                    id INTEGER PRIMARY KEY,
+                    task_id TEXT NOT NULL,
+                    meta TEXT NOT NULL,
+                    images TEXT NOT NULL,
+                    done TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    failed_at REAL NOT NULL
+                );
+            """)
+            self.db.commit()
+
+    def start(self):
+        """启动后台上传线程"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._worker, name="FogUpload", daemon=True)
+        self.thread.start()
+        logger.info(f"FogOutbox started, pending: {self.pending_count()}")
+
+    def stop(self, timeout: float = 10):
+        """停止后台上传线程，未完成的上传保留在 outbox 中，下次启动继续"""
+        if not self.running:
+            return
+        with self.wakeup:
+            self.running = False
+            self.wakeup.notify_all()
+        if self.thread:
+            self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        with self.lock:
+            self.db.close()
+
+    def set_client(self, fog_client):
+        """切换上传使用的FogClient"""
+        self.fog_client = fog_client
+
+    def put(self, meta: Dict[str, Any], images: Dict[str, Any]) -> int:
+        """
+        写入一个待上传任务，待上传任务达到 max_pending 时阻塞
+
+        Returns:
+            outbox 记录 id
+        """
+        with self.wakeup:
+            while self.running and self._pending_count() >= self.max_pending:
+                self.wakeup.wait(timeout=1)
+
+            cursor = self.db.execute(
+                "INSERT INTO outbox (task_id, meta, images, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (str(meta.get("task_id")), json.dumps(meta), json.dumps(images), time.time(), time.time())
+            )
+            self.db.commit()
+            self.wakeup.notify_all()
+            return cursor.lastrowid
+
+    def pending_count(self) -> int:
+        with self.lock:
+            return self._pending_count()
+
+    def _pending_count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        """待上传及失败任务数"""
+        with self.lock:
+            return {
+                "pending": self._pending_count(),
+                "dead": self.db.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+            }
+
+    def _next_due(self):
+        """取出一条到期的记录，没有到期记录时返回距下一条到期的等待秒数"""
+        row = self.db.execute(
+            "SELECT id, meta, images, done, attempts, next_attempt_at FROM outbox ORDER BY next_attempt_at, id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None, None
+        wait = row[5] - time.time()
+        if wait > 0:
+            return None, wait
+        return row[:5], 0
+
+    def _worker(self):
+        """后台上传线程"""
+        while True:
+            with self.wakeup:
+                if not self.running:
+                    break
+                row, wait = self._next_due()
+                if row is None:
+                    self.wakeup.wait(timeout=wait)
+                    continue
+
+            try:
+                with FOG_PROFILER.profile("FogUpload"):
+                    self._upload(row)
+            except Exception as e:
+                logger.error(f"ComyFog upload loop error: {e}")
+                logger.error(traceback.format_exc())
+                time.sleep(1)
+
+    def _upload(self, row):
+        """解析一条记录，在任务的日志上下文中上传"""
+        row_id, meta, images, done, attempts = row
+        meta = json.loads(meta)
+        with log_context(task_id=meta['task_id']):
+            self._upload_row(row_id, meta, json.loads(images), set(json.loads(done)), attempts)
+
+    def _spill_images(self, images, done):
+        """转入 dead_letter 的任务释放内存预算，未上传的内存图片落盘，引用不变，可手动重新上传"""
+        for node, details in images.items():
+            for index, file in enumerate(details.get('file', [])):
+                if FOG_IMAGE_STORE.is_ref(file) and f"{node}/{index}" not in done:
+                    try:
+                        FOG_IMAGE_STORE.spill(file)
+                    except OSError as e:
+                        logger.error(f"Failed to spill {file}: {e}")
+
+    def _upload_row(self, row_id, meta, images, done, attempts):
+        """上传一条记录，并根据结果删除、重试或转入 dead_letter"""
+        resp = {}
+        with STAGE_SECONDS.time(stage="upload"), FOG_TRACER.span(meta['task_id'], "upload", "upload", attempt=attempts + 1):
+            ret = self.fog_client.upload_images(meta, images, resp, skip=done)
+
+        # 记录已成功上传的文件，重试时跳过
+        for node, results in resp.items():
+            for index, result in enumerate(results):
+                if result.get("success"):
+                    done.add(f"{node}/{index}")
+
+        attempts += 1
+        with self.wakeup:
+            if ret:
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+                logger.info("Task upload success ,  task_id: %s, resp:%s", meta['task_id'], payload(resp))
+                FOG_TRACER.finish(meta['task_id'], "uploaded")
+                FOG_PROFILER.task_done()
+                FOG_STATUS.task_finished(meta['task_id'], "uploaded")
+
+            elif attempts > self.max_retries:
+                self.db.execute(
+                    "INSERT INTO dead_letter (id, task_id, meta, images, done, attempts, last_error, created_at, failed_at) "
+                    "SELECT id, task_id, meta, images, ?, ?, ?, created_at, ? FROM outbox WHERE id = ?",
+                    (json.dumps(sorted(done)), attempts, json.dumps(resp), time.time(), row_id)
+                )
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+                self._spill_images(images, done)
+                UPLOAD_FAILURES_TOTAL.inc(kind="dead_letter")
+                logger.error("Task upload failed after %s attempts, moved to dead_letter, task_id: %s, resp:%s", attempts, meta['task_id'], payload(resp))
+                FOG_TRACER.finish(meta['task_id'], "dead_letter")
+                FOG_PROFILER.task_done()
+                FOG_STATUS.task_finished(meta['task_id'], "upload_failed")
+
+            else:
+                backoff = min(self.retry_interval * (2 ** (attempts - 1)), self.max_backoff)
+                self.db.execute(
+                    "UPDATE outbox SET done = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (json.dumps(sorted(done)), attempts, time.time() + backoff, json.dumps(resp), row_id)
+                )
+                UPLOAD_RETRIES_TOTAL.inc()
+                logger.warning("Task upload error , retry in %ss (%s/%s), task_id: %s, resp:%s",
+                               backoff, attempts, self.max_retries, meta['task_id'], payload(resp))
+
+            self.db.commit()
+            self.wakeup.notify_all()
@@ -0,0 +1,167 @@
+import os
+import time
+import shutil
+import logging
+import threading
+import traceback
+
+from typing import Optional, Callable, List, Dict
+
+from .fog_affinity import extract_model_refs
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+class ModelPrefetcher:
+    """
+    排队任务的模型预取
+
+    FogPrefetch 线程扫描本地队列中等待的任务，提取其引用的模型文件，在当前任务推理期间提前准备：
+        1. 磁盘缓存：本地没有的模型通过 FogModelCache 下载，限速为 bandwidth_mb，磁盘剩余空间低于 min_free_disk_gb 时不下载
+        2. 页缓存：按 bandwidth_mb 限速顺序读取模型文件，加载器节点打开文件时直接命中页缓存；
+           对 s3fs 挂载的 models/ 目录，读取同时会填充 s3fs 的本地缓存
+    已在显存中的模型、刚预热过的文件不重复处理。
+    """
+    READ_BLOCK = 8 * 1024 * 1024
+
+    def __init__(self, snapshot: Callable[[], List[dict]], inventory, model_cache=None,
+                 bandwidth_mb: float = 100, min_free_disk_gb: float = 20, page_cache: bool = True,
+                 lookahead: int = 2, warm_ttl: float = 600):
+        """
+        Args:
+            snapshot: 返回排队中任务列表的函数，按出队顺序
+            inventory: ModelInventory，已加载的模型无需预热
+            model_cache: FogModelCache，为 None 时只预热页缓存
+            bandwidth_mb: 预取下载及读取的限速(MB/s)，0 为不限速
+            min_free_disk_gb: 下载后磁盘至少保留的剩余空间(GB)
+            page_cache: 是否预热页缓存
+            lookahead: 只处理队列中前 lookahead 个任务
+            warm_ttl: 同一文件预热后多久内不再重复预热(秒)
+        """
+        self.snapshot = snapshot
+        self.inventory = inventory
+        self.model_cache = model_cache
+        self.bandwidth_mb = bandwidth_mb
+        self.bandwidth = bandwidth_mb * 1024 * 1024
+        self.min_free_disk = int(min_free_disk_gb * 1024 ** 3)
+        self.page_cache = page_cache
+        self.lookahead = max(1, lookahead)
+        self.warm_ttl = warm_ttl
+
+        self.warmed: Dict[str, float] = {}     # path -> 预热时间
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._worker, name="FogPrefetch", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=timeout)
+            self.thread = None
+
+    def notify(self):
+        """队列中有新任务时唤醒预取线程"""
+        self.wakeup.set()
+
+    def _worker(self):
+        while self.running:
+            self.wakeup.wait(timeout=5)
+            self.wakeup.clear()
+            if not self.running:
+                break
+            try:
+                self._prefetch_queued()
+            except Exception as e:
+                logger.error(f"Model prefetch error: {e}")
+                logger.error(traceback.format_exc())
+
+    def _prefetch_queued(self):
+        loaded = self.inventory.loaded_models()
+        for task in self.snapshot()[:self.lookahead]:
+            for folder, names in extract_model_refs(task.get("workflow")).items():
+                for name in sorted(names - loaded.get(folder, set())):
+                    if not self.running:
+                        return
+                    path = self._ensure_local(folder, name)
+                    if path and self.page_cache:
+                        self._warm_page_cache(path)
+
+    def _ensure_local(self, folder: str, name: str) -> Optional[str]:
+        """模型本地路径，本地没有时在磁盘预算内下载到模型缓存"""
+        import folder_paths
+
+        if self.model_cache is not None:
+            path = self.model_cache.cached_path(folder, name)
+            if path:
+                return path
+
+        path = folder_paths.get_full_path(folder, name)
+        if path or self.model_cache is None:
+            return path
+
+        info = self.model_cache.lookup(folder, name)
+        if info is None:
+            return None
+        free = shutil.disk_usage(self.model_cache.cache_dir).free
+        if free - int(info["size"]) < self.min_free_disk:
+            logger.debug(f"Skip prefetch {folder}/{name}, disk free {free} below budget")
+            return None
+
+        logger.info(f"Prefetch model {folder}/{name}, size: {info['size']}")
+        return self.model_cache.ensure(folder, name, bandwidth_mb=self.bandwidth_mb)
+
+    def _warm_page_cache(self, path: str):
+        """限速顺序读取文件，填充页缓存"""
+        now = time.time()
+        if now - self.warmed.get(path, 0) < self.warm_ttl:
+            return
+
+        size = os.path.getsize(path)
+        available = self._available_memory()
+        if available is not None and size > available:
+            logger.debug(f"Skip page cache warm {path}, size {size} exceeds available memory {available}")
+            return
+
+        buffer = bytearray(self.READ_BLOCK)
+        start = time.time()
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            read = 0
+            while self.running:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                read += n
+                if self.bandwidth > 0:
+                    # 按累计读取量计算应耗时间，超前时等待
+                    ahead = read / self.bandwidth - (time.time() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        self.warmed[path] = time.time()
+        logger.debug(f"Page cache warmed {path}, {size} bytes in {time.time() - start:.1f}s")
+
+    @staticmethod
+    def _available_memory() -> Optional[int]:
+        """可用内存，Linux 上使用 MemAvailable（包含可回收的页缓存）"""
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            return None
@@ -0,0 +1,375 @@
+import io
+import os
+import sys
+import time
+import shutil
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+from typing import Optional, Dict, Any
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+# 未开启分析时返回的空上下文，复用同一个对象
+_NULL = nullcontext()
+
+MODES = ("cprofile", "sample")
+
+
+class ProfileSession:
+    """一次分析会话，覆盖接下来 tasks 个任务"""
+
+    def __init__(self, session_id: str, mode: str, tasks: int, memory: bool, top: int, interval: float):
+        self.id = session_id
+        self.mode = mode
+        self.tasks = tasks
+        self.memory = memory
+        self.top = top
+        self.interval = interval
+        self.started_at = time.time()
+        self.finished_at = None
+        self.done_tasks = 0
+        self.closed = False         # 不再开始新的分析区间，等待进行中的区间结束后输出结果
+        self.finalized = False
+        self.lock = threading.Lock()
+
+        # cprofile: 线程 -> (阶段, Profile)，每个线程一个 Profile，结束时按阶段合并
+        self.profiles: Dict[int, tuple] = {}
+        self.conflicts = 0          # Profile 启用失败次数（Python 3.12+ 同时只能启用一个）
+
+        # sample: 正在分析的线程 -> 阶段，以及采样得到的调用栈计数
+        self.sampling: Dict[int, str] = {}
+        self.stacks: Dict[tuple, int] = defaultdict(int)
+        self.samples = 0
+
+        # 分析区间嵌套时只在最外层启停
+        self.active: Dict[int, int] = defaultdict(int)
+
+        # tracemalloc: 阶段 -> 代码位置 -> [size_diff, count_diff]，以及调用次数
+        self.allocations: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        self.memory_calls: Dict[str, int] = defaultdict(int)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "tasks": self.tasks,
+            "done_tasks": self.done_tasks,
+            "memory": self.memory,
+            "started_at": int(self.started_at),
+            "finished_at": int(self.finished_at) if self.finished_at else None,
+            "state": "finished" if self.finalized else ("finishing" if self.closed else "running")
+        }
+
+
+class FogProfiler:
+    """
+    按需性能分析（通过 /fog/profile 路由开启）
+
+    开启后对接下来 N 个任务，在 FogMonitor、FogInference、FogTranscode、FogUpload 线程及上传线程池中
+    分析各阶段的执行：
+        cprofile: 每个线程一个 cProfile.Profile，只在分析区间内启用，结果按阶段合并为 .pstats 文件
+        sample:   采样线程按 interval 读取各线程调用栈，输出 folded stacks（可用 speedscope/flamegraph 查看），
+                  开销与任务无关，Python 3.12+ 多线程时建议使用
+    memory 为 true 时用 tracemalloc 对比 upload_images、_get_images 前后的内存分配；
+    快照包含同一时间其他线程的分配，结果按多次调用累计，仅作定位参考。
+    转码在子进程中执行，不在分析范围内。
+    未开启时 profile()/memory() 只判断一次会话是否存在，返回空上下文。
+    """
+    def __init__(self, output_dir: str, keep: int = 10):
+        """
+        Args:
+            output_dir: 分析结果目录，每个会话一个子目录
+            keep: 保留的会话数
+        """
+        self.output_dir = output_dir
+        self.keep = keep
+        self.session: Optional[ProfileSession] = None
+        self.last: Optional[ProfileSession] = None
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.tracemalloc_started = False
+
+    def start(self, tasks: int = 10, mode: str = "cprofile", memory: bool = False, top: int = 30,
+              interval: float = 0.01) -> Dict[str, Any]:
+        """
+        开始分析会话
+
+        Args:
+            tasks: 分析的任务数，任务上传完成或失败后计数
+            mode: cprofile 或 sample
+            memory: 是否记录 upload_images、_get_images 的内存分配
+            top: 结果中输出的条目数
+            interval: sample 模式的采样间隔(秒)
+        """
+        if mode not in MODES:
+            return {"success": False, "error": f"Unknown profile mode {mode}, supported: {list(MODES)}"}
+        with self.lock:
+            if self.session is not None:
+                return {"success": False, "error": f"Profile session {self.session.id} is running"}
+
+            session = ProfileSession(time.strftime("%Y%m%d-%H%M%S"), mode, max(1, int(tasks)), bool(memory),
+                                     max(1, int(top)), max(0.001, float(interval)))
+            if session.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracemalloc_started = True
+            if mode == "sample":
+                self.sampler = threading.Thread(target=self._sample_loop, args=(session,), name="FogProfileSampler", daemon=True)
+                self.sampler.start()
+            self.session = session
+
+        logger.info(f"Profile session {session.id} started, mode: {mode}, tasks: {session.tasks}, memory: {session.memory}")
+        return {"success": True, "session": session.info()}
+
+    def stop(self) -> Dict[str, Any]:
+        """提前结束当前会话，进行中的分析区间结束后输出结果"""
+        with self.lock:
+            session = self.session
+        if session is None:
+            return {"success": False, "error": "No profile session running"}
+        self._close(session)
+        return {"success": True, "session": session.info()}
+
+    def status(self) -> Dict[str, Any]:
+        """当前会话及已保存的分析结果"""
+        sessions = []
+        if os.path.isdir(self.output_dir):
+            for session_id in sorted(os.listdir(self.output_dir), reverse=True):
+                path = os.path.join(self.output_dir, session_id)
+                if os.path.isdir(path):
+                    sessions.append({"id": session_id, "artifacts": sorted(os.listdir(path))})
+        current = self.session or self.last
+        return {
+            "current": current.info() if current else None,
+            "sessions": sessions
+        }
+
+    def artifact(self, session_id: str, name: str) -> Optional[bytes]:
+        """读取分析结果文件"""
+        if os.path.basename(session_id) != session_id or os.path.basename(name) != name:
+            return None
+        path = os.path.join(self.output_dir, session_id, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def task_done(self):
+        """一个任务处理结束（上传完成或失败），达到会话任务数后结束会话"""
+        session = self.session
+        if session is None:
+            return
+        with session.lock:
+            session.done_tasks += 1
+            done = session.done_tasks >= session.tasks
+        if done:
+            self._close(session)
+
+    def profile(self, stage: str):
+        """分析 with 块内当前线程的执行，stage 为结果中的阶段名"""
+        session = self.session
+        if session is None or session.closed:
+            return _NULL
+        return self._profile(session, stage)
+
+    def memory(self, label: str):
+        """记录 with 块前后的内存分配差异"""
+        session = self.session
+        if session is None or session.closed or not session.memory:
+            return _NULL
+        return self._memory(session, label)
+
+    @contextmanager
+    def _profile(self, session: ProfileSession, stage: str):
+        ident = threading.get_ident()
+        with session.lock:
+            session.active[ident] += 1
+            outer = session.active[ident] == 1
+            profile = None
+            if outer and session.mode == "cprofile":
+                profile = session.profiles.setdefault(ident, (stage, cProfile.Profile()))[1]
+            elif outer:
+                session.sampling[ident] = stage
+
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ 的 cProfile 基于 sys.monitoring，同一时间只能启用一个
+                profile = None
+                with session.lock:
+                    session.conflicts += 1
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            with session.lock:
+                session.active[ident] -= 1
+                if not session.active[ident]:
+                    del session.active[ident]
+                    session.sampling.pop(ident, None)
+                finalize = session.closed and not session.active and not session.finalized
+            if finalize:
+                self._finalize(session)
+
+    @contextmanager
+    def _memory(self, session: ProfileSession, label: str):
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            exclude = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+            diffs = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), 'lineno')
+            with session.lock:
+                session.memory_calls[label] += 1
+                allocations = session.allocations[label]
+                for stat in diffs[:session.top * 2]:
+                    if not stat.size_diff:
+                        continue
+                    frame = stat.traceback[0]
+                    entry = allocations[f"{frame.filename}:{frame.lineno}"]
+                    entry[0] += stat.size_diff
+                    entry[1] += stat.count_diff
+
+    def _sample_loop(self, session: ProfileSession):
+        """采样线程：读取正在分析的线程的调用栈"""
+        while not session.closed:
+            time.sleep(session.interval)
+            with session.lock:
+                targets = dict(session.sampling)
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            for ident, stage in targets.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.append(stage)
+                with session.lock:
+                    session.stacks[tuple(reversed(stack))] += 1
+                    session.samples += 1
+
+    def _close(self, session: ProfileSession):
+        with session.lock:
+            if session.closed:
+                return
+            session.closed = True
+            finalize = not session.active
+        with self.lock:
+            if self.session is session:
+                self.session = None
+                self.last = session
+        if finalize:
+            self._finalize(session)
+
+    def _finalize(self, session: ProfileSession):
+        """输出分析结果文件"""
+        with session.lock:
+            if session.finalized:
+                return
+            session.finalized = True
+            session.finished_at = time.time()
+
+        if self.sampler is not None and self.sampler is not threading.current_thread():
+            self.sampler.join(timeout=1)
+            self.sampler = None
+        if self.tracemalloc_started:
+            tracemalloc.stop()
+            self.tracemalloc_started = False
+
+        path = os.path.join(self.output_dir, session.id)
+        try:
+            os.makedirs(path, exist_ok=True)
+            summary = io.StringIO()
+            summary.write(f"session {session.id}, mode {session.mode}, tasks {session.done_tasks}/{session.tasks}, "
+                          f"{session.finished_at - session.started_at:.1f}s\n")
+
+            if session.mode == "cprofile":
+                self._write_pstats(session, path, summary)
+            else:
+                self._write_samples(session, path, summary)
+            if session.memory:
+                self._write_memory(session, summary)
+
+            with open(os.path.join(path, "summary.txt"), 'w') as f:
+                f.write(summary.getvalue())
+            logger.info(f"Profile session {session.id} finished, results in {path}")
+        except Exception as e:
+            logger.error(f"Failed to write profile session {session.id}: {e}")
+
+        # 只保留最近 keep 个会话
+        sessions = sorted(d for d in os.listdir(self.output_dir) if os.path.isdir(os.path.join(self.output_dir, d)))
+        for old in sessions[:max(0, len(sessions) - self.keep)]:
+            shutil.rmtree(os.path.join(self.output_dir, old), ignore_errors=True)
+
+    def _write_pstats(self, session: ProfileSession, path: str, summary: io.StringIO):
+        """同一阶段的各线程 Profile 合并为 <stage>.pstats，summary 中输出按累计耗时排序的前 top 条"""
+        by_stage = defaultdict(list)
+        for stage, profile in session.profiles.values():
+            by_stage[stage].append(profile)
+        if session.conflicts:
+            summary.write(f"\n{session.conflicts} profile intervals skipped, another profiler was active; use mode=sample\n")
+
+        for stage, profiles in sorted(by_stage.items()):
+            stats = None
+            for profile in profiles:
+                profile.create_stats()
+                if not profile.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profile, stream=summary)
+                else:
+                    stats.add(profile)
+            if stats is None:
+                continue
+            stats.dump_stats(os.path.join(path, f"{stage}.pstats"))
+            summary.write(f"\n==== {stage} ({len(profiles)} threads) ====\n")
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(session.top)
+
+    def _write_samples(self, session: ProfileSession, path: str, summary: io.StringIO):
+        """输出 stacks.folded，summary 中按阶段输出自身及累计采样数最多的函数"""
+        with open(os.path.join(path, "stacks.folded"), 'w') as f:
+            for stack, count in sorted(session.stacks.items()):
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        summary.write(f"{session.samples} samples, interval {session.interval * 1000:.0f}ms\n")
+        stages = defaultdict(lambda: (defaultdict(int), defaultdict(int)))
+        totals = defaultdict(int)
+        for stack, count in session.stacks.items():
+            own, cumulative = stages[stack[0]]
+            totals[stack[0]] += count
+            own[stack[-1]] += count
+            for function in set(stack[1:]):
+                cumulative[function] += count
+
+        for stage, (own, cumulative) in sorted(stages.items()):
+            summary.write(f"\n==== {stage} ({totals[stage]} samples) ====\n")
+            for title, counts in (("self", own), ("cumulative", cumulative)):
+                summary.write(f"-- {title}\n")
+                for function, count in sorted(counts.items(), key=lambda item: -item[1])[:session.top]:
+                    summary.write(f"{count:8d} {count / totals[stage]:6.1%}  {function}\n")
+
+    def _write_memory(self, session: ProfileSession, summary: io.StringIO):
+        """summary 中按阶段输出内存分配增量最多的代码位置"""
+        for label, allocations in sorted(session.allocations.items()):
+            summary.write(f"\n==== tracemalloc {label} ({session.memory_calls[label]} calls) ====\n")
+            ranked = sorted(allocations.items(), key=lambda item: -abs(item[1][0]))[:session.top]
+            for location, (size, count) in ranked:
+                summary.write(f"{size / 1024:+12.1f} KiB {count:+8d} blocks  {location}\n")
+
+
+FOG_PROFILER = FogProfiler(os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
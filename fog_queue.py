@@ -0,0 +1,113 @@
+import itertools
+import threading
+
+from typing import Optional, List, Callable
+
+
+class FogTaskQueue:
+    """
+    本地任务优先队列
+    按任务的 priority 字段（越大越优先）出队，相同优先级按入队顺序；
+    容量有限，用于缓存已从任务中心租约获取、尚未开始推理的任务。
+
+    出队时可传入 score 函数，在同一优先级内优先取出得分高的任务（如与已加载模型匹配的任务），
+    被跳过 max_skips 次的任务下次必定出队，避免饥饿。
+    """
+    def __init__(self, capacity: int = 1, max_skips: int = 3):
+        self.capacity = max(1, capacity)
+        self.max_skips = max_skips
+        self.items = []             # [-priority, seq, task, skips]，保持 (-priority, seq) 有序
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+    def free_slots(self) -> int:
+        """剩余容量"""
+        with self.cond:
+            return max(0, self.capacity - len(self.items))
+
+    def full(self) -> bool:
+        return self.free_slots() == 0
+
+    def put(self, task: dict, front: bool = False):
+        """
+        放入任务，不阻塞，容量由调用方通过 free_slots 控制
+
+        Args:
+            front: 放在同优先级任务的最前面，用于被抢占后重新排队的任务
+        """
+        with self.cond:
+            seq = next(self.seq)
+            self.items.append([-int(task.get("priority") or 0), -seq if front else seq, task, 0])
+            self.items.sort(key=lambda item: (item[0], item[1]))
+            self.cond.notify()
+
+    def get(self, timeout: Optional[float] = None, score: Optional[Callable[[dict], float]] = None) -> Optional[dict]:
+        """
+        取出下一个任务，队列关闭或超时返回 None
+
+        Args:
+            score: 任务得分函数，同一优先级内得分高者先出队
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.closed, timeout=timeout):
+                return None
+            if self.closed:
+                return None
+            return self._pop(score)[2]
+
+    def _pop(self, score):
+        index = 0
+        if score is not None and len(self.items) > 1:
+            starved = [i for i, item in enumerate(self.items) if item[3] >= self.max_skips]
+            if starved:
+                index = starved[0]
+            else:
+                # 只在最高优先级内按得分选择，得分相同时保持入队顺序
+                top = self.items[0][0]
+                best = None
+                for i, item in enumerate(self.items):
+                    if item[0] != top:
+                        break
+                    value = score(item[2])
+                    if best is None or value > best:
+                        best, index = value, i
+
+        # 排在被选任务之前的任务记一次跳过
+        for item in self.items[:index]:
+            item[3] += 1
+        return self.items.pop(index)
+
+    def take(self, predicate: Callable[[dict], bool], limit: int) -> List[dict]:
+        """按出队顺序取出最多 limit 个满足 predicate 的任务，用于合并执行"""
+        with self.cond:
+            taken, remaining = [], []
+            for item in self.items:
+                if len(taken) < limit and predicate(item[2]):
+                    taken.append(item[2])
+                else:
+                    remaining.append(item)
+            self.items = remaining
+            return taken
+
+    def snapshot(self) -> List[dict]:
+        """当前排队中的任务（按默认出队顺序）"""
+        with self.cond:
+            return [item[2] for item in self.items]
+
+    def drain(self) -> List[dict]:
+        """清空队列并返回所有未开始的任务"""
+        with self.cond:
+            tasks = [item[2] for item in self.items]
+            self.items = []
+            return tasks
+
+    def close(self):
+        """关闭队列，唤醒所有等待的消费者"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
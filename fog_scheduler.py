@@ -1,43 +1,103 @@
-import sys
 import os
 import json
 import time
 import logging
+import uuid
 import base64
-import websocket
 import threading
 import traceback  # 导入 traceback 模块
 
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, date
 from queue import Queue, Empty
 
 from .fog_client import FogClient
 from .fog_comfy import ComfyUIClient
+from .fog_outbox import FogOutbox
+from .fog_queue import FogTaskQueue
+from .fog_backoff import Backoff
+from .fog_capture import FOG_IMAGE_STORE, rewrite_for_capture
+from .fog_transcode import FogTranscoder, normalize_format
+from .fog_affinity import ModelInventory, extract_model_refs
+from .fog_prefetch import ModelPrefetcher
+from .fog_similarity import GraphSimilarity
+from .fog_coalesce import SeedCoalescer
+from .fog_admission import AdmissionController, BACKENDS
+from .fog_metrics import STAGE_SECONDS, NODE_SECONDS, TASKS_TOTAL
+from .fog_trace import FOG_TRACER
+from .fog_profile import FOG_PROFILER
+from .fog_status import FOG_STATUS
+from .fog_log import log_context, payload
 
 
-# 获取 ComfyUI 的路径
-COMFY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-if COMFY_PATH not in sys.path:
-    sys.path.append(COMFY_PATH)
-
-# 正确导入 ComfyUI 的模块
-from execution import PromptQueue
-from server import PromptServer
-
 logger = logging.getLogger('ComfyFog')
 
 class FogScheduler:
     """
     任务调度器
     负责任务的执行、监控和结果处理
+
+    任务处理拆分为三个流水线阶段，各阶段之间通过有界队列衔接：
+        1. 预取阶段：由 FogMonitor 线程调用 process_task()，从任务中心批量租约获取任务放入本地优先队列 task_queue，
+           并为排队及执行中的任务续约
+        2. 推理阶段：FogInference 线程校验并提交 workflow，等待推理结果后写入 outbox
+        3. 转码阶段（可选）：任务要求 output_format 时，FogTranscode 线程在进程池中将 PNG 转为 webp/jpeg/avif
+        4. 上传阶段：结果写入持久化的 FogOutbox，由其 FogUpload 线程上传并失败重试
+    这样任务 N 的图片上传时，任务 N+1 已经可以在 GPU 上推理。
     """
-    def __init__(self, fog_client: FogClient):
+    def __init__(self, fog_client: FogClient, prefetch_size: int = 1,
+                 comfy_mode: str = "inprocess", comfy_url: Optional[str] = None,
+                 retry_interval: float = 5, max_retries: int = 3, outbox_max_pending: int = 100,
+                 lease_batch_size: int = 1, lease_seconds: int = 300,
+                 long_poll_wait: float = 20, fetch_backoff_max: float = 60,
+                 validation_cache_size: int = 64, output_capture: str = "memory", memory_budget_mb: int = 512,
+                 transcode_workers: int = 2, affinity_max_skips: int = 3, model_cache=None,
+                 model_prefetch: bool = True, prefetch_bandwidth_mb: float = 100,
+                 prefetch_min_free_disk_gb: float = 20, prefetch_page_cache: bool = True, model_index=None,
+                 coalesce_max_batch: int = 0, min_gpu_memory_available: float = 4000, coalesce_mb_per_megapixel: float = 1024,
+                 admission_control: bool = True, admission_backend: str = "comfy", admission_defer_timeout: float = 300,
+                 preempt_local: bool = True, preempt_check_interval: float = 0.5, preempt_cooldown: float = 30,
+                 trace_enabled: bool = False, trace_max: int = 50,
+                 schedule: Optional[list] = None, max_tasks_per_day: int = 0):
         """
         初始化FogScheduler
         
         Args:
             fog_client (FogClient): FogClient实例，用于与任务中心通信
+            prefetch_size (int): 本地任务队列容量，即最多提前获取多少个待推理任务
+            comfy_mode (str): ComfyUIClient 后端模式，inprocess 或 http
+            comfy_url (str): http 模式下远程 ComfyUI 地址，为空时使用本机 ComfyUI
+            retry_interval (float): 上传失败首次重试间隔(秒)
+            max_retries (int): 上传最大重试次数，超过后转入 dead_letter
+            outbox_max_pending (int): 待上传任务上限，上传积压达到上限时推理阶段阻塞等待
+            lease_batch_size (int): 每次租约获取的最大任务数
+            lease_seconds (int): 任务租约时长(秒)，剩余不足一半时续约
+            long_poll_wait (float): 长轮询等待秒数，任务中心不支持长轮询时忽略，需小于 lease_seconds 的一半
+            fetch_backoff_max (float): 不支持长轮询时，无任务或请求失败后的最大退避秒数
+            validation_cache_size (int): workflow 校验结果缓存条数
+            output_capture (str): 输出图片获取方式，memory 为内存获取（仅 inprocess 模式），disk 为 output 目录
+            memory_budget_mb (int): memory 方式下未上传图片的内存上限(MB)，超出部分落盘
+            transcode_workers (int): 转码线程数
+            affinity_max_skips (int): 本地队列按模型亲和度调度时，任务最多被跳过的次数
+            model_cache (FogModelCache): 远程模型本地缓存，为 None 时不下载缺失模型
+            model_prefetch (bool): 是否在推理期间预取排队任务的模型
+            prefetch_bandwidth_mb (float): 预取下载及读取的限速(MB/s)，避免影响当前任务
+            prefetch_min_free_disk_gb (float): 预取下载后磁盘至少保留的剩余空间(GB)
+            prefetch_page_cache (bool): 预取时是否读取模型文件预热页缓存
+            model_index (ModelIndex): 本地模型哈希索引，随任务获取请求上报
+            coalesce_max_batch (int): 只有 seed 不同的任务最多合并执行的个数，小于 2 时不合并
+            min_gpu_memory_available (float): 推理时至少保留的空闲显存(MB)，用于准入控制及合并执行
+            coalesce_mb_per_megapixel (float): 合并时每百万像素样本的显存估算(MB)
+            admission_control (bool): 是否按空闲显存控制任务提交
+            admission_backend (str): 显存查询后端，comfy 或 stub（无 GPU 联调）
+            admission_defer_timeout (float): 显存不足时任务最长推迟时间(秒)，超过后释放租约
+            preempt_local (bool): 本地用户提交 prompt 时是否中断正在执行的 Fog 任务，任务保留租约重新排队
+            preempt_check_interval (float): 检查本地用户 prompt 的间隔(秒)
+            preempt_cooldown (float): 抢占后至少等待多少秒的本地空闲才继续执行 Fog 任务
+            trace_enabled (bool): 是否记录每个任务的 Chrome trace 时间线
+            trace_max (int): 保留的最近任务 trace 文件数
+            schedule (list): 调度时间段 [{"start": "HH:MM", "end": "HH:MM"}]，为空时全天执行
+            max_tasks_per_day (int): 每天最多获取的任务数，0 表示不限
             
         Raises:
             ValueError: 当fog_client为None或类型不正确时
@@ -46,47 +106,543 @@ class FogScheduler:
             raise ValueError("fog_client must be an instance of FogClient")
             
         self.fog_client = fog_client
-        self.comfy_client = ComfyUIClient()
+        self.comfy_client = ComfyUIClient(mode=comfy_mode, base_url=comfy_url, validation_cache_size=validation_cache_size)
 
         self.current_task: Optional[dict] = None  # 当前在处理的任务
         self.current_prompt_id = None  # 当前正在执行的prompt ID
         self.current_task_id = None  # 当前正在执行的任务ID
 
 
-        self.schedule = []  # 添加调度时间列表
-        
-          
+        # 调度时间段及每日任务数，配置变化时由 configure() 更新
+        self.schedule = []
+        self.max_tasks_per_day = 0
+        self.tasks_today = 0
+        self.tasks_day = date.today()
+        self.configure(schedule, max_tasks_per_day)
+
+        # 输出图片内存获取，需要与 ComfyUI 同进程
+        self.capture_memory = output_capture == "memory" and self.comfy_client.mode == "inprocess"
+        FOG_IMAGE_STORE.memory_budget = memory_budget_mb * 1024 * 1024
+        FOG_TRACER.configure(trace_enabled, trace_max)
+
+        # 本地任务优先队列，同优先级内优先执行与已加载模型匹配、与上一个 workflow 共享节点多的任务
+        self.task_queue = FogTaskQueue(capacity=prefetch_size, max_skips=affinity_max_skips)
+        self.inventory = ModelInventory(index=model_index)
+        self.similarity = GraphSimilarity()
+
+        # 显存查询后端，comfy 后端只能查询本进程的设备，http 模式下不可用
+        memory_backend = None
+        if admission_backend != "comfy" or self.comfy_client.mode == "inprocess":
+            memory_backend = BACKENDS[admission_backend]()
+
+        # 显存准入控制
+        self.admission = None
+        if admission_control and memory_backend is not None:
+            self.admission = AdmissionController(
+                backend=memory_backend,
+                min_free_mb=min_gpu_memory_available,
+                defer_timeout=admission_defer_timeout
+            )
+
+        # 本地用户优先：检测到本地 prompt 时中断 Fog 任务
+        self.preempt_local = preempt_local
+        self.preempt_check_interval = preempt_check_interval
+        self.preempt_cooldown = preempt_cooldown
+        self.preempted = set()      # 被抢占、需重新排队的 task_id
+        self.preempted_at = 0.0
+        self.preempt_count = 0
+
+        # seed 扫描任务合并为一个 batch 执行，需按空闲显存决定合并数，无法查询显存时不合并
+        self.coalescer = None
+        if coalesce_max_batch > 1 and memory_backend is None:
+            logger.warning("Seed coalescing needs GPU memory info, disabled in http mode with the comfy backend")
+        elif coalesce_max_batch > 1:
+            self.coalescer = SeedCoalescer(
+                backend=memory_backend,
+                max_batch=coalesce_max_batch,
+                min_free_mb=min_gpu_memory_available,
+                mb_per_megapixel=coalesce_mb_per_megapixel
+            )
+        self.model_cache = model_cache
+
+        # 排队任务的模型预取
+        self.prefetcher = None
+        if model_prefetch:
+            self.prefetcher = ModelPrefetcher(
+                self.task_queue.snapshot,
+                self.inventory,
+                model_cache=model_cache,
+                bandwidth_mb=prefetch_bandwidth_mb,
+                min_free_disk_gb=prefetch_min_free_disk_gb,
+                page_cache=prefetch_page_cache,
+                lookahead=prefetch_size
+            )
+
+        # 任务租约，task_id -> 到期时间戳，覆盖排队中及推理中的任务
+        self.lease_batch_size = max(1, lease_batch_size)
+        self.lease_seconds = lease_seconds
+        self.lease_supported = True  # 任务中心不支持租约接口时回退到单任务获取
+        self.leases = {}
+        self.lease_lock = threading.Lock()
+
+        # 任务获取：优先长轮询，不支持时无任务按抖动指数退避，获取成功后重置
+        self.long_poll_wait = min(long_poll_wait, lease_seconds / 4)
+        self.fetch_backoff = Backoff(base=1, cap=fetch_backoff_max)
+
+        # 转码阶段
+        self.transcoder = FogTranscoder(workers=transcode_workers)
+        self.transcode_queue: Queue = Queue(maxsize=4)
+
+        # 持久化上传队列
+        self.outbox = FogOutbox(
+            fog_client,
+            retry_interval=retry_interval,
+            max_retries=max_retries,
+            max_pending=outbox_max_pending
+        )
+
+        self.running = False
+        self.workers = []
+
+    def configure(self, schedule: Optional[list], max_tasks_per_day: int):
+        """更新调度时间段及每日任务数上限，无需重启"""
+        self.schedule = list(schedule or [])
+        self.max_tasks_per_day = max_tasks_per_day or 0
+
+    def _daily_quota(self) -> Optional[int]:
+        """今天还可获取的任务数，不限时返回 None"""
+        today = date.today()
+        if today != self.tasks_day:
+            self.tasks_day, self.tasks_today = today, 0
+        if not self.max_tasks_per_day:
+            return None
+        return max(0, self.max_tasks_per_day - self.tasks_today)
+
+    def set_client(self, fog_client: FogClient):
+        """切换任务中心客户端，租约续约、释放及上传随后使用新的客户端"""
+        if not isinstance(fog_client, FogClient):
+            raise ValueError("fog_client must be an instance of FogClient")
+        self.fog_client = fog_client
+        self.outbox.set_client(fog_client)
+
+    def start(self):
+        """启动推理、上传工作线程"""
+        if self.running:
+            return
+        self.running = True
+        self.outbox.start()
+        self.workers = [
+            threading.Thread(target=self._inference_worker, name="FogInference", daemon=True),
+            threading.Thread(target=self._transcode_worker, name="FogTranscode", daemon=True),
+        ]
+        if self.preempt_local:
+            self.workers.append(threading.Thread(target=self._preempt_worker, name="FogPreempt", daemon=True))
+        for worker in self.workers:
+            worker.start()
+        if self.prefetcher:
+            self.prefetcher.start()
+        logger.info("FogScheduler pipeline started")
+
+    def stop(self, timeout: float = 10):
+        """
+        停止流水线
+        未开始推理的任务释放租约交还任务中心，已完成推理的任务保留在 outbox 中，下次启动继续上传
+        """
+        if not self.running:
+            return
+        self.running = False
+
+        # 释放未开始任务的租约，并唤醒推理线程
+        for task in self.task_queue.drain():
+            try:
+                self._finish_lease(task, release=True)
+            except Exception as e:
+                logger.error(f"Failed to release lease, task_id: {task.get('task_id')}: {e}")
+        self.task_queue.close()
+
+        # 先停止上传线程，唤醒可能因上传积压阻塞的推理线程
+        self.outbox.stop(timeout=timeout)
+
+        try:
+            for worker in self.workers:
+                worker.join(timeout=timeout)
+            self.workers = []
+            if self.prefetcher:
+                self.prefetcher.stop(timeout=timeout)
+            self.comfy_client.close()
+            self.transcoder.close()
+            self.outbox.close()
+        finally:
+            FOG_IMAGE_STORE.spill_all()  # 未上传的内存图片落盘，重启后继续上传
+        logger.info("FogScheduler pipeline stopped")
             
     def process_task(self):
-        """任务处理主流程"""
-        # 1. 检查是否在调度时间内
+        """预取阶段：续约进行中的任务，在调度时间内且本地队列未满时，从任务中心获取新任务"""
+        if not self.running:
+            return False
+
+        # 1. 续约排队中及推理中的任务
+        self.renew_leases()
+
+        # 2. 检查是否在调度时间内
         if not self._is_in_schedule():
             logger.debug("Not in scheduled time")
             return False
-            
-        # 2. 检查队列状态
-        queue_status = self.comfy_client.get_queue_status()
-        if  not queue_status["success"]:
-            logger.error(f"ComfyQueue status get error : {queue_status['error']}")
-            return False;
-        if queue_status["queue_remaining"]:
-            logger.info(f"ComfyQueue remaining {queue_status['queue_remaining']} task, wait next loop.")
+
+        # 3. 检查本地队列，队列满说明推理阶段尚未消费，无需继续获取
+        free_slots = self.task_queue.free_slots()
+        if not free_slots:
+            logger.debug(f"Task queue is full, {len(self.task_queue)} task waiting, wait next loop.")
             return False
-        logger.info(f"ComfyQueue is idle, {queue_status['queue_remaining']} task, next step")
 
-        # 3. 获取新任务        
-        self.current_task = self.fog_client.fetch_task()
-        if not self.current_task.get("success"):  
-            logger.error(f"{self.current_task.get("error")}")
+        # 4. 检查每日任务数
+        quota = self._daily_quota()
+        if quota is not None:
+            if not quota:
+                logger.debug(f"Daily task limit {self.max_tasks_per_day} reached")
+                return False
+            free_slots = min(free_slots, quota)
+
+        # 5. 退避期间不请求任务中心
+        if not self.fetch_backoff.ready():
             return False
 
+        # 6. 获取新任务
+        tasks, error = self._fetch_tasks(min(free_slots, self.lease_batch_size))
+        self.tasks_today += len(tasks)
+        FOG_STATUS.set_connected(not error)
+        if tasks:
+            self.fetch_backoff.reset()
+        elif error or not self.fog_client.long_poll_supported:
+            # 长轮询返回空结果时任务中心已经等待过，可立即再次请求
+            delay = self.fetch_backoff.failure()
+            logger.debug(f"No task fetched, backoff {delay:.1f}s")
+
+        for task in tasks:
+            logger.info(f"Task fetched, task_id: {task.get('task_id')}, create_at: {task.get('create_at')}, lease_expire_at: {task.get('lease_expire_at')}")
+            self.task_queue.put(task)
+            FOG_STATUS.stage(task.get("task_id"), "queued")
+        if tasks and self.prefetcher:
+            self.prefetcher.notify()
+        return bool(tasks)
+
+    def _fetch_tasks(self, max_tasks: int):
+        """
+        租约获取最多 max_tasks 个任务，任务中心不支持租约时回退到单任务获取
+
+        Returns:
+            (tasks, error) error 表示请求失败，而非任务中心暂无任务
+        """
+        if self.lease_supported:
+            start = time.time()
+            with STAGE_SECONDS.time(stage="fetch"):
+                result = self.fog_client.lease_tasks(max_tasks, self.lease_seconds, wait=self.long_poll_wait,
+                                                     inventory=self.inventory.snapshot())
+            if result.get("success"):
+                now = time.time()
+                with self.lease_lock:
+                    for task in result["tasks"]:
+                        task["lease_expire_at"] = task.get("lease_expire_at") or now + self.lease_seconds
+                        self.leases[task["task_id"]] = task["lease_expire_at"]
+                        FOG_TRACER.add(task["task_id"], "POST /lease", "task_center", start, now, batch=len(result["tasks"]))
+                return result["tasks"], False
+
+            if not result.get("unsupported"):
+                logger.error(f"{result.get('error')}")
+                return [], True
+
+            logger.info(f"{result.get('error')}, fallback to single task fetch")
+            self.lease_supported = False
+
+        start = time.time()
+        with STAGE_SECONDS.time(stage="fetch"):
+            task = self.fog_client.fetch_task(wait=self.long_poll_wait, inventory=self.inventory.snapshot())
+        if task.get("empty"):
+            return [], False
+        if not task.get("success"):  
+            logger.error(f"{task.get('error')}")
+            return [], True
+        FOG_TRACER.add(task.get("task_id"), "GET /task", "task_center", start, time.time())
+        return [task], False
+
+    def renew_leases(self):
+        """续约剩余时长不足一半的租约"""
+        now = time.time()
+        with self.lease_lock:
+            due = [task_id for task_id, expire_at in self.leases.items() if expire_at - now < self.lease_seconds / 2]
+        if not due:
+            return
+
+        start = time.time()
+        result = self.fog_client.renew_leases(due, self.lease_seconds)
+        for task_id in due:
+            FOG_TRACER.add(task_id, "POST /lease/renew", "task_center", start, time.time(), success=bool(result.get("success")))
+        if not result.get("success"):
+            logger.error(f"{result.get('error')}")
+            return
+
+        renewed = result.get("leases") or {}
+        with self.lease_lock:
+            for task_id in due:
+                if task_id in self.leases:
+                    self.leases[task_id] = renewed.get(task_id) or now + self.lease_seconds
+        logger.debug(f"Task leases renewed, task_ids: {due}")
+
+    def _finish_lease(self, task: dict, release: bool, result: str = "released"):
+        """
+        结束任务租约
+
+        Args:
+            release: 是否通知任务中心释放，未执行或执行失败的任务可被重新分配
+            result: 释放时任务的结束状态：released / failed / rejected
+        """
+        task_id = task.get("task_id")
+        with self.lease_lock:
+            leased = self.leases.pop(task_id, None) is not None
+        if leased and release:
+            with FOG_TRACER.span(task_id, "POST /lease/release", "task_center"):
+                response = self.fog_client.release_leases([task_id])
+            if not response.get("success"):
+                logger.error(f"{response.get('error')}")
+            else:
+                logger.info(f"Task lease released, task_id: {task_id}")
+        if release:
+            FOG_TRACER.finish(task_id, result)
+            FOG_PROFILER.task_done()
+            FOG_STATUS.task_finished(task_id, result)
 
-        # 4. 处理任务
+    def _release_if_leased(self, task: dict):
+        """异常处理：任务仍持有租约时以失败释放，已交给上传阶段的任务不处理"""
+        with self.lease_lock:
+            leased = task.get("task_id") in self.leases
+        if not leased:
+            return
+        try:
+            self._finish_lease(task, release=True, result="failed")
+        except Exception as e:
+            logger.error(f"Failed to release lease, task_id: {task.get('task_id')}: {e}")
+
+    def _wait_comfy_idle(self):
+        """等待 ComfyUI 队列空闲，避免与本地用户的任务抢占GPU；刚发生抢占时额外等待 preempt_cooldown"""
+        while self.running:
+            queue_status = self.comfy_client.get_queue_status()
+            if not queue_status["success"]:
+                logger.error(f"ComfyQueue status get error : {queue_status['error']}")
+            elif queue_status["queue_remaining"]:
+                logger.debug(f"ComfyQueue remaining {queue_status['queue_remaining']} task, wait.")
+                if self.preempted_at:
+                    self.preempted_at = time.time()  # 本地用户仍活跃，冷却时间从空闲时开始计算
+            elif time.time() - self.preempted_at < self.preempt_cooldown:
+                logger.debug("Local user active recently, wait.")
+            else:
+                return True
+            time.sleep(1)
+        return False
+
+    def _inference_worker(self):
+        """推理阶段工作线程"""
+        while True:
+            task = self.task_queue.get(score=self._task_score)
+            if task is None or not self.running:
+                break
+
+            if not self._wait_comfy_idle():
+                self._finish_lease(task, release=True)
+                break
+
+            with FOG_PROFILER.profile("FogInference"), log_context(task_id=task.get("task_id")):
+                try:
+                    self._infer(task)
+                except Exception as e:
+                    # 单个任务的异常不能终止推理线程，仍持有租约的任务释放
+                    logger.error(f"Task inference error, task_id: {task.get('task_id')}: {e}")
+                    logger.error(traceback.format_exc())
+                    self._release_if_leased(task)
+
+        # 推理阶段退出后通知转码阶段，转码线程处理完积压后退出
+        self.transcode_queue.put(None)
+
+    def _infer(self, task):
+        """准入检查后执行任务，与队列中只有 seed 不同的任务合并执行"""
+        if not self._admit(task):
+            return
+
+        group = self.coalescer.collect(task, self.task_queue) if self.coalescer else [task]
+        if len(group) > 1:
+            self._run_coalesced(group)
+            return
+
+        item = self._run_inference(task)
+        if item is None:
+            if not self._requeue_preempted(task, [task]):
+                TASKS_TOTAL.inc(result="failed")
+                self._finish_lease(task, release=True, result="failed")
+            return
+
+        meta, images = item
+        self._complete(task, meta, images)
+
+    def _preempt_worker(self):
+        """抢占检测线程：Fog 任务执行期间出现本地用户的 prompt 时中断 Fog 任务"""
+        client_id = self.comfy_client.client_id
+        while self.running:
+            time.sleep(self.preempt_check_interval)
+            prompt_id, task_id = self.current_prompt_id, self.current_task_id
+            if not prompt_id:
+                continue
+
+            queue = self.comfy_client.get_queue()
+            if not queue["success"]:
+                continue
+            local = [pid for pid, cid in queue["running"] + queue["pending"] if cid != client_id]
+            if not local:
+                continue
+
+            self.preempted.add(task_id)
+            action = self.comfy_client.interrupt(prompt_id)
+            if action is None:
+                # 已执行结束
+                self.preempted.discard(task_id)
+                continue
+            self.preempted_at = time.time()
+            self.preempt_count += 1
+            logger.info(f"Task preempted by local prompts {local}, task_id: {task_id}, prompt_id: {prompt_id}, {action}")
+
+    def _requeue_preempted(self, task, group) -> bool:
+        """被抢占的任务保留租约，放回本地队列最前面，等待本地空闲后重新执行"""
+        if task.get("task_id") not in self.preempted:
+            return False
+        self.preempted.discard(task.get("task_id"))
+        TASKS_TOTAL.inc(len(group), result="preempted")
+        for t in reversed(group):
+            FOG_TRACER.instant(t.get("task_id"), "preempted", "inference")
+            FOG_STATUS.stage(t.get("task_id"), "queued")
+            self.task_queue.put(t, front=True)
+        logger.info(f"Preempted tasks requeued, task_ids: {[t.get('task_id') for t in group]}")
+        return True
+
+    def _admit(self, task) -> bool:
+        """
+        显存准入检查
+        显存暂时不足的任务放回队列稍后重试，超出设备能力或推迟超时的任务释放租约
+        """
+        if self.admission is None:
+            return True
+
+        verdict = self.admission.check(task, self.inventory.loaded_models())
+        if verdict["decision"] == AdmissionController.ADMIT:
+            return True
+
+        FOG_TRACER.instant(task.get("task_id"), f"admission {verdict['decision']}", "inference", reason=verdict["reason"])
+        if verdict["decision"] == AdmissionController.DEFER:
+            logger.debug(f"Task deferred, task_id: {task.get('task_id')}, {verdict['reason']}")
+            self.task_queue.put(task)
+            time.sleep(2)
+        else:
+            logger.warning(f"Task rejected, task_id: {task.get('task_id')}, {verdict['reason']}")
+            TASKS_TOTAL.inc(result="rejected")
+            self._finish_lease(task, release=True, result="rejected")
+        return False
+
+    def _run_coalesced(self, group):
+        """合并执行一组 seed 扫描任务，结果拆分回各任务；失败时全部释放租约"""
+        logger.info(f"Coalesce {len(group)} tasks into one batch, task_ids: {[t.get('task_id') for t in group]}")
+        combined = dict(group[0], workflow=self.coalescer.build(group))
+        item = self._run_inference(combined)
+        if item is None and self._requeue_preempted(combined, group):
+            return
+        parts = self.coalescer.split(group, *item) if item else None
+        if parts is None:
+            if item:
+                self._discard_images(item[1])
+            TASKS_TOTAL.inc(len(group), result="failed")
+            for t in group:
+                self._finish_lease(t, release=True, result="failed")
+            return
+
+        for task, meta, images in parts:
+            FOG_TRACER.instant(task.get("task_id"), "coalesced", "inference", batch_task_id=group[0].get("task_id"))
+            self._complete(task, meta, images)
+
+    def _discard_images(self, images):
+        """丢弃无法上传的输出图片"""
+        for details in images.values():
+            for file in details.get('file', []):
+                if FOG_IMAGE_STORE.is_ref(file):
+                    FOG_IMAGE_STORE.discard(file)
+                else:
+                    try:
+                        os.remove(file)
+                    except OSError:
+                        pass
+
+    def _complete(self, task, meta, images):
+        """推理完成的任务交给转码或上传阶段"""
+        TASKS_TOTAL.inc(result="completed")
+        self.inventory.mark_loaded(task.get("workflow"))
+        output_format = normalize_format(task.get("output_format"))
+        FOG_STATUS.stage(task.get("task_id"), "transcoding" if output_format else "uploading", count="completed")
+        if output_format:
+            self.transcode_queue.put((task, meta, images, output_format))
+        else:
+            self._deliver(task, meta, images)
+
+    def _transcode_worker(self):
+        """转码阶段工作线程，转码失败时上传原图"""
+        while True:
+            item = self.transcode_queue.get()
+            if item is None:
+                break
+
+            task, meta, images, output_format = item
+            with FOG_PROFILER.profile("FogTranscode"), log_context(task_id=meta.get("task_id")):
+                try:
+                    self._transcode(task, meta, images, output_format)
+                except Exception as e:
+                    logger.error(f"Task transcode stage error, task_id: {meta.get('task_id')}: {e}")
+                    logger.error(traceback.format_exc())
+                    self._release_if_leased(task)
+
+    def _transcode(self, task, meta, images, output_format):
+        """转码后交给上传阶段"""
+        try:
+            with STAGE_SECONDS.time(stage="transcode"), FOG_TRACER.span(meta['task_id'], "transcode", "transcode", format=output_format['format']):
+                images = self.transcoder.transcode(meta, images, output_format, FOG_IMAGE_STORE)
+            logger.debug(f"Task transcode completed, task_id: {meta['task_id']}, format: {output_format['format']}")
+        except Exception as e:
+            logger.error(f"Task transcode error, upload original, task_id: {meta['task_id']}: {e}")
+            logger.error(traceback.format_exc())
+        self._deliver(task, meta, images)
+
+    def _task_score(self, task: dict) -> float:
+        """本地队列出队得分：模型亲和度 + 可复用 ComfyUI 执行缓存的节点数"""
+        return self.inventory.affinity(task) + self.similarity.score(task)
+
+    def _deliver(self, task, meta, images):
+        """结果交给上传阶段，先持久化再上传，上传积压达到上限时阻塞，形成背压"""
+        FOG_STATUS.stage(task.get("task_id"), "uploading")
+        self.outbox.put(meta, images)
+        self._finish_lease(task, release=False)
+
+    def _run_inference(self, task):
+        """
+        校验、提交任务到ComfyUI并等待推理结果
+
+        Returns:
+            (meta, images) 供上传阶段使用，失败时返回 None
+        """
+        self.current_task = task
         self.task_start_time = int(time.time())
+        capture_key = None
         try:
-            # 4.1 提交任务到ComfyUI并获取prompt_id
+            # 1. 提交任务到ComfyUI并获取prompt_id
             self.current_task_id = self.current_task.get("task_id")
             self.current_workflow = self.current_task.get("workflow")
+            FOG_STATUS.task_started(self.current_task_id)
+            if self.capture_memory:
+                # SaveImage 替换为内存输出节点，图片不经过 output 目录
+                capture_key = uuid.uuid4().hex
+                self.current_workflow = rewrite_for_capture(self.current_workflow, capture_key)
 
             # workflow 校验并上报 缺失插件 或 模型, 校验返回    valid[3]
             """
@@ -109,35 +665,60 @@ class FogScheduler:
                 }
             }
             """
-            miss_nodes = self.comfy_client.validate_node(self.current_workflow)
+            # 缺失的模型从模型缓存下载，需在校验前完成
+            with FOG_TRACER.span(self.current_task_id, "ensure_models", "inference"):
+                self._ensure_models(self.current_workflow)
+
+            with STAGE_SECONDS.time(stage="validate_node"), FOG_TRACER.span(self.current_task_id, "validate_node", "inference"):
+                miss_nodes = self.comfy_client.validate_node(self.current_workflow)
             if len(miss_nodes):     
                 raise Exception(f"Invalid workflow, missing nodes {miss_nodes}")
                             
-            valid = self.comfy_client.validate_prompt(self.current_workflow)
+            with STAGE_SECONDS.time(stage="validate_prompt"), FOG_TRACER.span(self.current_task_id, "validate_prompt", "inference"):
+                valid = self.comfy_client.validate_prompt(self.current_workflow)
             if not valid[0]:
-                logger.error(f"Invalid workflow, {valid}")          
+                logger.error("Invalid workflow, %s", payload(valid))
                 raise Exception("Invalid workflow: {}".format(valid[1]))
                               
-            logger.debug(f"Task submitted to ComfyUI, task_id: {self.current_task_id}, workflow: {self.current_workflow}, create_at: {self.current_task.get("create_at")}")
+            logger.debug("Task submitted to ComfyUI, task_id: %s, workflow: %s, create_at: %s",
+                         self.current_task_id, payload(self.current_workflow), self.current_task.get('create_at'))
+
+            # 记录本任务的显存峰值，用于修正准入估算
+            if self.admission:
+                estimate = self.admission.estimate(self.current_workflow, self.inventory.loaded_models())
+                baseline = self.admission.begin()
 
-            result = self.comfy_client.submit_workflow(self.current_workflow)
+            with STAGE_SECONDS.time(stage="submit"), FOG_TRACER.span(self.current_task_id, "submit", "inference"):
+                result = self.comfy_client.submit_workflow(self.current_workflow, valid)
             
             if not result["success"]:
                 raise Exception(result["error"])
             
             self.current_prompt_id = result['prompt_id']                
+            FOG_STATUS.stage(self.current_task_id, "executing")
             logger.debug(f"Task prompt_queue success, task_id: {self.current_task_id }, prompt_id: {self.current_prompt_id}")
 
             
-            # 4.2 等待任务完成并获取结果
-            result = self.comfy_client.wait_websock_result(self.current_prompt_id)            
-            logger.debug(f"Task interface completed ,  task_id: {self.current_task_id }, prompt_id: {self.current_prompt_id}, resp:{result}")
+            # 2. 等待任务完成并获取结果
+            with FOG_TRACER.span(self.current_task_id, "wait_result", "inference", prompt_id=self.current_prompt_id), \
+                    log_context(prompt_id=self.current_prompt_id):
+                task_id = self.current_task_id
+                result = self.comfy_client.wait_websock_result(
+                    self.current_prompt_id,
+                    on_progress=lambda value, maximum, node: FOG_STATUS.progress(task_id, value, maximum, node)
+                )
+                logger.debug("Task interface completed ,  task_id: %s, prompt_id: %s, resp:%s",
+                             self.current_task_id, self.current_prompt_id, payload(result))
             if not result["success"]:
                 raise Exception(result["error"])
             images = result["images"]
+            self.similarity.mark_executed(self.current_task, result.get("cached_nodes"))
+            self._observe_timings(self.current_workflow, result.get("timings") or {})
+            self._trace_timings(self.current_task_id, self.current_workflow, result.get("timings") or {}, result.get("cached_nodes"))
+            if self.admission:
+                self.admission.record(self.current_task, estimate, baseline)
             
-            # 4.3 上传图片以及相关meta信息, 失败进队列，后续可重试
-   
+            # 3. 组装上传meta信息，交给上传阶段
             meta = {};
             meta["task_id"] = self.current_task_id
             meta["create_at"] = self.current_task.get("create_at")
@@ -148,27 +729,72 @@ class FogScheduler:
                 files = details.get('file', [])
                 for index,file in enumerate(files):
                     meta["images_idx"] += (f"/{node}/{index},")
-            
-            resp = {}
-            ret = self.fog_client.upload_images(meta, images, resp)
-            if not ret :
-                logger.error(f"Task upload error ,  task_id: {self.current_task_id }, prompt_id: {self.current_prompt_id}, resp:{resp}")
-            else:
-                logger.info(f"Task upload success ,  task_id: {self.current_task_id }, prompt_id: {self.current_prompt_id}, resp:{resp}")
- 
-        
+
+            self.preempted.discard(self.current_task_id)  # 中断前已执行完成
+            return meta, images
 
         except Exception as e:
-            logger.error(f"ComyFog processing loop error: {e}")
-            logger.error(traceback.format_exc())  
- 
+            if self.current_task_id in self.preempted:
+                logger.info(f"Task interrupted for local user, task_id: {self.current_task_id}")
+            else:
+                logger.error(f"ComyFog processing loop error: {e}")
+                logger.error(traceback.format_exc())  
+                if self.current_prompt_id:
+                    # 超时等情况下 prompt 仍在排队或执行，中断以免继续占用 GPU 及产生图片
+                    try:
+                        self.comfy_client.interrupt(self.current_prompt_id)
+                    except Exception as interrupt_error:
+                        logger.error(f"Failed to interrupt prompt {self.current_prompt_id}: {interrupt_error}")
+            if capture_key:
+                FOG_IMAGE_STORE.discard_key(capture_key)  # 中断或失败前已保存的部分图片
+            return None
             
         finally:
             self.current_prompt_id = None
             self.current_task_id = None
             self.current_task = None
 
+    def _observe_timings(self, workflow: dict, timings: dict):
+        """记录 ComfyUI 排队、执行及各节点耗时"""
+        for stage in ("queue_wait", "execution"):
+            if timings.get(stage) is not None:
+                STAGE_SECONDS.observe(timings[stage], stage=stage)
+        for node_id, seconds in (timings.get("nodes") or {}).items():
+            class_type = (workflow.get(node_id) or {}).get("class_type", "unknown")
+            NODE_SECONDS.observe(seconds, class_type=class_type)
+
+    def _trace_timings(self, task_id, workflow: dict, timings: dict, cached_nodes):
+        """将 ComfyUI 排队、执行及各节点的时间段写入任务 trace"""
+        if not FOG_TRACER.enabled:
+            return
+        created_at, started_at, finished_at = timings.get("created_at"), timings.get("started_at"), timings.get("finished_at")
+        if created_at and started_at:
+            FOG_TRACER.add(task_id, "queue_wait", "comfyui", created_at, started_at)
+        if started_at and finished_at:
+            FOG_TRACER.add(task_id, "execution", "comfyui", started_at, finished_at, cached_nodes=list(cached_nodes or []))
+        for node_id, start, end in timings.get("node_spans") or []:
+            class_type = (workflow.get(node_id) or {}).get("class_type", "unknown")
+            FOG_TRACER.add(task_id, f"{class_type} #{node_id}", "comfyui", start, end, node_id=node_id)
+
+    def _ensure_models(self, workflow: dict):
+        """
+        确保 workflow 引用的模型在本地可用，本地没有的从模型缓存下载
+
+        Raises:
+            Exception: 模型下载或校验失败
+        """
+        if self.model_cache is None:
+            return
 
+        import folder_paths
+        for folder, names in extract_model_refs(workflow).items():
+            for name in names:
+                # 已缓存的模型更新最近使用时间；本地 ComfyUI 目录中的模型直接使用
+                if self.model_cache.cached_path(folder, name) or folder_paths.get_full_path(folder, name):
+                    continue
+                path = self.model_cache.ensure(folder, name)
+                if path is None:
+                    logger.warning(f"Model not found in model cache manifest, {folder}/{name}")
 
     def _is_in_schedule(self) -> bool:
         """检查当前时间是否在调度时间内"""
@@ -177,7 +803,11 @@ class FogScheduler:
             
         current_time = datetime.now().strftime("%H:%M")
         for slot in self.schedule:
-            if slot['start'] <= current_time <= slot['end']:
+            if slot['start'] <= slot['end']:
+                if slot['start'] <= current_time <= slot['end']:
+                    return True
+            # 跨越午夜的时间段，如 23:00 - 06:00
+            elif current_time >= slot['start'] or current_time <= slot['end']:
                 return True
         return False
 
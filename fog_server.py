@@ -1,33 +1,57 @@
+import asyncio
 import logging
+import threading
 
 logger = logging.getLogger('ComfyFog')
 
-from . import fog_manager
+from .fog_metrics import FOG_METRICS
+
+
+class _LazyManager:
+    """首次调用方法时才创建 FogManager，导入本模块不加载调度器、HTTP 客户端等组件"""
+
+    def __getattr__(self, name):
+        from .fog_manager import get_fog_manager
+        return getattr(get_fog_manager(), name)
+
+
+fog_manager = _LazyManager()
 
 def fog_status(req):
     """
-    获取Fog节点当前状态
+    获取Fog节点当前状态，面板打开及重连时获取一次，之后通过 fog.* 事件增量更新
     
     请求方式：GET /fog/status
     
     Returns:
         {
             "status": {
+                "version": int,         # 状态版本，与 fog.* 事件的 version 对应
                 "enabled": bool,        # 是否启用
                 "connected": bool,      # 是否连接到任务中心
                 "scheduler_active": bool,  # 调度器是否活跃
-                "current_task": {       # 当前任务信息，无任务时为null
+                "current_task": {       # 当前推理的任务，无任务时为null
                     "id": str,          # 任务ID
-                    "status": str,      # 任务状态：processing/completed/failed
+                    "status": str,      # 任务状态：processing
+                    "stage": str,       # 阶段：preparing/executing
                     "started_at": str,  # 开始时间，ISO格式
-                    "progress": float   # 进度，0-1
+                    "progress": float,  # 当前节点进度，0-1，来自 ComfyUI 的 progress 事件
+                    "node": str         # 上报进度的节点
                 },
+                "tasks": {str: str},    # 未结束任务的阶段：queued/preparing/executing/transcoding/uploading
+                "recent": [             # 最近结束的任务
+                    {"id": str, "result": str, "finished_at": str}
+                ],
+                "counts": {str: int},   # completed/failed/rejected/uploaded/upload_failed 计数
                 "schedule": [           # 调度时间段列表
                     {
                         "start": str,   # 开始时间，格式 "HH:MM"
                         "end": str      # 结束时间，格式 "HH:MM"
                     }
-                ]
+                ],
+                "execution_cache": dict,
+                "admission": dict,
+                "preempted": int
             }
         }
     """
@@ -37,6 +61,182 @@ def fog_status(req):
         logger.error(f"Error getting status: {e}")
         return {"status": "error", "message": str(e)}
 
+def fog_inventory(req):
+    """
+    获取本地模型索引
+    
+    请求方式：GET /fog/inventory
+    
+    Returns:
+        {
+            "inventory": {
+                "models": [             # 本地模型文件
+                    {
+                        "path": str,    # 文件绝对路径
+                        "folder": str,  # folder_paths 目录名，如 checkpoints
+                        "name": str,    # 文件名
+                        "size": int,    # 文件大小
+                        "mtime": float, # 修改时间
+                        "sha256": str   # 文件哈希，尚未计算时为null
+                    }
+                ],
+                "stats": {
+                    "files": int,       # 文件数
+                    "hashed": int,      # 已计算哈希的文件数
+                    "pending": int      # 等待计算哈希的文件数
+                }
+            }
+        }
+    """
+    try:
+        return {"inventory": fog_manager.get_inventory()}
+    except Exception as e:
+        logger.error(f"Error getting inventory: {e}")
+        return {"status": "error", "message": str(e)}
+
+def fog_metrics(req):
+    """
+    获取 Prometheus 格式的指标
+    
+    请求方式：GET /fog/metrics
+    
+    Returns:
+        text/plain; version=0.0.4 文本，包括：
+            fog_stage_seconds{stage}        各阶段耗时直方图：fetch/validate_node/validate_prompt/submit/
+                                            queue_wait/execution/transcode/upload
+            fog_node_seconds{class_type}    节点执行耗时直方图
+            fog_tasks_total{result}         任务数：completed/failed/preempted/rejected
+            fog_upload_bytes_total          上传字节数
+            fog_upload_retries_total        上传重试次数
+            fog_upload_failures_total{kind} 上传失败次数
+    """
+    return FOG_METRICS.render()
+
+def fog_trace(req):
+    """
+    获取任务的执行时间线，需在配置中开启 trace_enabled
+    
+    请求方式：GET /fog/trace/<task_id>
+    
+    Returns:
+        Chrome trace event 格式的 JSON，可直接用 chrome://tracing 或 https://ui.perfetto.dev 打开：
+        {
+            "traceEvents": [            # 任务获取、模型准备、校验、提交、ComfyUI 排队及各节点执行、转码、上传
+                {"name": str, "cat": str, "ph": "X", "ts": int, "dur": int, "pid": 1, "tid": int, "args": {...}}
+            ],
+            "displayTimeUnit": "ms",
+            "otherData": {"task_id": str, "status": str}    # status: running/uploaded/dead_letter/released
+        }
+        没有记录时：
+        {
+            "status": "error",
+            "message": str
+        }
+    """
+    try:
+        task_id = req.match_info["task_id"]
+        trace = fog_manager.get_trace(task_id)
+        if trace is None:
+            return {"status": "error", "message": f"No trace for task {task_id}"}
+        return trace
+    except Exception as e:
+        logger.error(f"Error getting trace: {e}")
+        return {"status": "error", "message": str(e)}
+
+def fog_profile_status(req):
+    """
+    获取性能分析状态及已保存的结果
+    
+    请求方式：GET /fog/profile
+    
+    Returns:
+        {
+            "profile": {
+                "current": {            # 当前或最近一次会话，没有时为null
+                    "id": str,
+                    "mode": str,        # cprofile/sample
+                    "tasks": int,       # 分析的任务数
+                    "done_tasks": int,  # 已完成的任务数
+                    "memory": bool,     # 是否记录内存分配
+                    "state": str        # running/finishing/finished
+                },
+                "sessions": [           # 已保存的结果，通过 /fog/profile/<id>/<artifact> 下载
+                    {"id": str, "artifacts": [str]}
+                ]
+            }
+        }
+    """
+    try:
+        return {"profile": fog_manager.get_profile()}
+    except Exception as e:
+        logger.error(f"Error getting profile status: {e}")
+        return {"status": "error", "message": str(e)}
+
+def fog_profile_start(req):
+    """
+    开始性能分析，覆盖接下来 N 个任务的 FogMonitor、推理、转码、上传线程
+    
+    请求方式：POST /fog/profile/start
+    
+    请求体：
+    {
+        "tasks": int,           # 可选，分析的任务数，默认10
+        "mode": str,            # 可选，cprofile 或 sample（采样），默认cprofile
+        "memory": bool,         # 可选，是否用 tracemalloc 记录 upload_images/_get_images 的内存分配
+        "top": int,             # 可选，summary.txt 中输出的条目数，默认30
+        "interval": float       # 可选，sample 模式的采样间隔(秒)，默认0.01
+    }
+    
+    Returns:
+        {"success": bool, "session": {...}, "error": str}
+    """
+    try:
+        body = req.json or {}
+        options = {key: body[key] for key in ("tasks", "mode", "memory", "top", "interval") if key in body}
+        return fog_manager.start_profile(options)
+    except Exception as e:
+        logger.error(f"Error starting profile: {e}")
+        return {"status": "error", "message": str(e)}
+
+def fog_profile_stop(req):
+    """
+    提前结束性能分析，进行中的任务阶段结束后输出结果
+    
+    请求方式：POST /fog/profile/stop
+    
+    Returns:
+        {"success": bool, "session": {...}, "error": str}
+    """
+    try:
+        return fog_manager.stop_profile()
+    except Exception as e:
+        logger.error(f"Error stopping profile: {e}")
+        return {"status": "error", "message": str(e)}
+
+def fog_profile_artifact(req):
+    """
+    下载性能分析结果文件
+    
+    请求方式：GET /fog/profile/<session_id>/<artifact>
+    
+    artifact：
+        summary.txt         各阶段耗时前 N 的函数及内存分配增量
+        <stage>.pstats      cprofile 模式各阶段的统计，可用 pstats/snakeviz 打开
+        stacks.folded       sample 模式的调用栈，可用 speedscope/flamegraph.pl 打开
+    
+    Returns:
+        文件内容(bytes)，不存在时 {"status": "error", "message": str}
+    """
+    try:
+        session_id, name = req.match_info["session_id"], req.match_info["artifact"]
+        data = fog_manager.get_profile_artifact(session_id, name)
+        if data is None:
+            return {"status": "error", "message": f"No profile artifact {session_id}/{name}"}
+        return data
+    except Exception as e:
+        logger.error(f"Error getting profile artifact: {e}")
+        return {"status": "error", "message": str(e)}
+
 def fog_update_config(req):
     """
     更新Fog节点配置
@@ -54,7 +254,7 @@ def fog_update_config(req):
             }
         ],
         "max_tasks_per_day": int,     # 可选，每日最大任务数
-        "min_gpu_memory": int,        # 可选，最小GPU内存要求(MB)
+        "min_gpu_memory_available": int,  # 可选，推理时至少保留的空闲显存(MB)
         "retry_interval": int,        # 可选，重试间隔(秒)
         "max_retries": int           # 可选，最大重试次数
     }
@@ -84,8 +284,87 @@ def fog_update_config(req):
 ROUTES = [
     ("fog/status", fog_status),                    # GET 获取状态
     ("fog/config", fog_update_config, ["POST"]),   # POST 更新配置
+    ("fog/inventory", fog_inventory),              # GET 本地模型索引
+    ("fog/metrics", fog_metrics),                  # GET Prometheus 指标
+    ("fog/trace/{task_id}", fog_trace),            # GET 任务 Chrome trace
+    ("fog/profile", fog_profile_status),           # GET 性能分析状态
+    ("fog/profile/start", fog_profile_start, ["POST"]),  # POST 开始性能分析
+    ("fog/profile/stop", fog_profile_stop, ["POST"]),    # POST 结束性能分析
+    ("fog/profile/{session_id}/{artifact}", fog_profile_artifact),  # GET 下载分析结果
 
 ]
 
+
+
+class FogRequest:
+    """路由处理函数的请求参数"""
+
+    def __init__(self, json=None, match_info=None, query=None):
+        self.json = json                    # 请求体，非 JSON 时为 None
+        self.match_info = match_info or {}  # 路径参数，如 {task_id}
+        self.query = query or {}            # 查询参数
+
+
+def _to_response(result, request):
+    """处理函数返回值转换为 HTTP 响应：dict 为 JSON，str 为 Prometheus 文本，bytes 为下载文件"""
+    from aiohttp import web
+
+    if isinstance(result, bytes):
+        name = request.match_info.get("artifact", "download")
+        return web.Response(body=result, content_type="application/octet-stream",
+                            headers={"Content-Disposition": f'attachment; filename="{name}"'})
+    if isinstance(result, str):
+        return web.Response(body=result.encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    return web.json_response(result)
+
+
+def _wrap(handler):
+    """同步处理函数包装为 aiohttp 处理函数，在线程池中执行，不阻塞 ComfyUI 事件循环"""
+    async def route(request):
+        body = None
+        if request.can_read_body:
+            try:
+                body = await request.json()
+            except Exception:
+                body = None
+        req = FogRequest(body, dict(request.match_info), dict(request.query))
+        result = await asyncio.get_running_loop().run_in_executor(None, handler, req)
+        return _to_response(result, request)
+    route.__name__ = handler.__name__
+    return route
+
+
+def register_routes(server):
+    """将 ROUTES 注册到 PromptServer.routes，需在 ComfyUI 调用 add_routes 之前，即插件导入时调用"""
+    for route in ROUTES:
+        path, handler = route[0], route[1]
+        methods = route[2] if len(route) > 2 else ["GET"]
+        for method in methods:
+            server.routes.route(method, "/" + path)(_wrap(handler))
+
+
+def _start_manager():
+    try:
+        from .fog_manager import get_fog_manager
+        get_fog_manager()
+    except Exception as e:
+        logger.error(f"FogManager start failed: {e}")
+
+
+def start_on_server_startup(server):
+    """
+    ComfyUI 服务启动时在后台线程创建 FogManager，不阻塞事件循环
+    服务已启动（无法注册启动事件）时立即创建
+    """
+    async def on_startup(app):
+        threading.Thread(target=_start_manager, name="FogStartup", daemon=True).start()
+
+    try:
+        server.app.on_startup.append(on_startup)
+    except RuntimeError:
+        threading.Thread(target=_start_manager, name="FogStartup", daemon=True).start()
+
+
 # 导出必要的变量
-__all__ = ['ROUTES']
\ No newline at end of file
+__all__ = ['ROUTES', 'register_routes', 'start_on_server_startup']
\ No newline at end of file
@@ -0,0 +1,105 @@
+import json
+import hashlib
+import threading
+
+from typing import Dict, List, Optional
+from collections import OrderedDict
+
+
+def node_signatures(workflow: dict) -> Dict[str, str]:
+    """
+    计算 workflow 各节点的输入签名
+
+    签名由 class_type、常量输入及上游节点签名递归得到（Merkle 方式），
+    与 ComfyUI 执行缓存的判定一致：两个 prompt 中签名相同的节点，后执行的可直接复用前一个的输出。
+    """
+    signatures: Dict[str, str] = {}
+    visiting = set()
+
+    def sign(node_id: str) -> str:
+        if node_id in signatures:
+            return signatures[node_id]
+        node = workflow.get(node_id)
+        if not isinstance(node, dict) or node_id in visiting:
+            return f"<missing:{node_id}>"
+        visiting.add(node_id)
+
+        inputs = {}
+        for name, value in (node.get("inputs") or {}).items():
+            # 连线输入 [node_id, output_index] 替换为上游签名
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int):
+                inputs[name] = ["<link>", sign(value[0]), value[1]]
+            else:
+                inputs[name] = value
+
+        payload = json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str)
+        signatures[node_id] = hashlib.sha1(payload.encode()).hexdigest()
+        visiting.discard(node_id)
+        return signatures[node_id]
+
+    for node_id in workflow or {}:
+        sign(node_id)
+    return signatures
+
+
+class GraphSimilarity:
+    """
+    按与上一个执行的 workflow 的节点重合度为排队任务打分
+
+    ComfyUI 默认只缓存上一个 prompt 的节点输出，因此同一优先级内优先执行与上一个 workflow
+    共享节点（相同 checkpoint 加载、相同 CLIP 编码等）最多的任务，可跳过这些节点的重复执行。
+    公平性由 FogTaskQueue 的 max_skips 保证。
+    实际节省的节点执行数由 ComfyUI 的 execution_cached 事件统计。
+    """
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.cache: OrderedDict = OrderedDict()     # task_id -> frozenset(签名)
+        self.last = frozenset()
+        self.lock = threading.Lock()
+
+        self.tasks = 0              # 已执行任务数
+        self.nodes = 0              # 已执行任务的节点总数
+        self.cached_nodes = 0       # 命中执行缓存、未实际执行的节点数
+        self.predicted_nodes = 0    # 按签名预计可复用的节点数
+
+    def signatures(self, task: dict) -> frozenset:
+        task_id = task.get("task_id")
+        with self.lock:
+            sigs = self.cache.get(task_id)
+            if sigs is not None:
+                self.cache.move_to_end(task_id)
+                return sigs
+
+        sigs = frozenset(node_signatures(task.get("workflow") or {}).values())
+        with self.lock:
+            self.cache[task_id] = sigs
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return sigs
+
+    def score(self, task: dict) -> float:
+        """与上一个执行的 workflow 共享的节点数"""
+        last = self.last
+        if not last:
+            return 0
+        return len(self.signatures(task) & last)
+
+    def mark_executed(self, task: dict, cached_nodes: Optional[List[str]] = None):
+        """记录刚执行完成的任务，及其命中执行缓存的节点"""
+        sigs = self.signatures(task)
+        with self.lock:
+            self.predicted_nodes += len(sigs & self.last)
+            self.last = sigs
+            self.cache.pop(task.get("task_id"), None)
+            self.tasks += 1
+            self.nodes += len(task.get("workflow") or {})
+            self.cached_nodes += len(cached_nodes or [])
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "tasks": self.tasks,
+                "nodes": self.nodes,
+                "cached_nodes": self.cached_nodes,
+                "predicted_nodes": self.predicted_nodes,
+            }
@@ -0,0 +1,173 @@
+import time
+import logging
+import threading
+
+from typing import Optional, Dict, Any, Callable
+from datetime import datetime
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+class FogStatus:
+    """
+    节点状态快照，由各流水线阶段在状态变化时增量更新，并通过 ComfyUI 的 WebSocket 推送给前端面板
+
+    /fog/status 直接返回快照的副本，不需要获取 FogManager.lock。
+    每次更新 version 加 1，推送的事件为 {"version": n, "patch": {顶层字段: 新值}, ...事件字段}，
+    前端按 version 合并 patch，发现 version 不连续时重新获取完整状态。
+
+    推送的事件：
+        fog.task_started   任务开始推理
+        fog.stage          任务阶段变化：queued / preparing / executing / transcoding / uploading
+        fog.progress       推理进度，来自 ComfyUI 的 progress 事件
+        fog.task_finished  任务结束：uploaded / upload_failed / failed / rejected / released
+        fog.config         配置或任务中心连接状态变化
+    """
+    # 同一任务 progress 事件的最小推送间隔(秒)，节点执行完成时总会推送
+    PROGRESS_INTERVAL = 0.5
+
+    # 推理阶段，current_task 所处的阶段
+    INFERENCE_STAGES = ("preparing", "executing")
+
+    # 保留的最近结束任务数
+    MAX_RECENT = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sender: Optional[Callable] = None
+        self.version = 0
+        self.state: Dict[str, Any] = {
+            "enabled": False,
+            "connected": False,
+            "scheduler_active": False,
+            "current_task": None,
+            "tasks": {},            # 未结束任务的阶段 task_id -> stage
+            "recent": [],           # 最近结束的任务，新的在前
+            "counts": {"completed": 0, "failed": 0, "rejected": 0, "uploaded": 0, "upload_failed": 0},
+            "schedule": [],
+        }
+        self._progress_sent = 0.0
+
+    def set_sender(self, sender: Optional[Callable]):
+        """设置推送函数 sender(event, data)，通常为 PromptServer.send_sync"""
+        self.sender = sender
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态的副本"""
+        with self.lock:
+            state = dict(self.state)
+            state["tasks"] = dict(state["tasks"])
+            state["counts"] = dict(state["counts"])
+            state["version"] = self.version
+            return state
+
+    def _commit(self, event: str, patch: Dict[str, Any], **fields):
+        """更新状态并推送，需持有 self.lock"""
+        self.state.update(patch)
+        self.version += 1
+        data = {"version": self.version, "patch": patch, **fields}
+        sender = self.sender
+        if sender is None:
+            return
+        try:
+            # send_sync 只是把消息放入事件循环的队列，持锁调用可保证推送顺序与 version 一致
+            sender(event, data)
+        except Exception as e:
+            logger.debug(f"Failed to push {event}: {e}")
+
+    def _set_stage(self, task_id: str, stage: Optional[str]) -> Dict[str, str]:
+        tasks = dict(self.state["tasks"])
+        if stage is None:
+            tasks.pop(task_id, None)
+        else:
+            tasks[task_id] = stage
+        return tasks
+
+    def configure(self, enabled: bool, schedule: list, connected: Optional[bool] = None,
+                  scheduler_active: Optional[bool] = None):
+        """配置变化"""
+        with self.lock:
+            patch = {"enabled": bool(enabled), "schedule": list(schedule or [])}
+            if connected is not None:
+                patch["connected"] = connected
+            if scheduler_active is not None:
+                patch["scheduler_active"] = scheduler_active
+            self._commit("fog.config", patch)
+
+    def stage(self, task_id: Optional[str], stage: str, count: Optional[str] = None):
+        """
+        任务进入新阶段，离开推理阶段（preparing / executing）时清除 current_task
+
+        Args:
+            count: 同时加 1 的计数项
+        """
+        if not task_id:
+            return
+        with self.lock:
+            if self.state["tasks"].get(task_id) == stage and count is None:
+                return
+            patch = {"tasks": self._set_stage(task_id, stage)}
+            current = self.state["current_task"]
+            if current and current["id"] == task_id:
+                patch["current_task"] = dict(current, stage=stage) if stage in self.INFERENCE_STAGES else None
+            if count:
+                patch["counts"] = dict(self.state["counts"], **{count: self.state["counts"].get(count, 0) + 1})
+            self._commit("fog.stage", patch, task_id=task_id, stage=stage)
+
+    def task_started(self, task_id: Optional[str]):
+        """任务开始推理"""
+        if not task_id:
+            return
+        with self.lock:
+            current = {
+                "id": task_id,
+                "status": "processing",
+                "stage": "preparing",
+                "started_at": datetime.now().isoformat(timespec="seconds"),
+                "progress": 0.0,
+                "node": None,
+            }
+            self._progress_sent = 0.0
+            self._commit("fog.task_started", {"current_task": current, "tasks": self._set_stage(task_id, "preparing")},
+                         task_id=task_id)
+
+    def progress(self, task_id: Optional[str], value, maximum, node=None):
+        """推理进度，按 PROGRESS_INTERVAL 限制推送频率"""
+        with self.lock:
+            current = self.state["current_task"]
+            if not current or current["id"] != task_id or not maximum:
+                return
+            progress = min(1.0, max(0.0, value / maximum))
+            now = time.monotonic()
+            if progress < 1.0 and now - self._progress_sent < self.PROGRESS_INTERVAL:
+                return
+            self._progress_sent = now
+            self._commit("fog.progress", {"current_task": dict(current, progress=progress, node=node)},
+                         task_id=task_id, value=value, max=maximum, node=node, progress=progress)
+
+    def set_connected(self, connected: bool):
+        """任务中心连接状态，变化时才推送"""
+        with self.lock:
+            if self.state["connected"] != connected:
+                self._commit("fog.config", {"connected": connected})
+
+    def task_finished(self, task_id: Optional[str], result: str):
+        """任务结束，从进行中的任务中移除"""
+        if not task_id:
+            return
+        with self.lock:
+            patch = {
+                "tasks": self._set_stage(task_id, None),
+                "recent": ([{"id": task_id, "result": result, "finished_at": datetime.now().isoformat(timespec="seconds")}]
+                           + self.state["recent"])[:self.MAX_RECENT],
+            }
+            if result in self.state["counts"]:
+                patch["counts"] = dict(self.state["counts"], **{result: self.state["counts"][result] + 1})
+            current = self.state["current_task"]
+            if current and current["id"] == task_id:
+                patch["current_task"] = None
+            self._commit("fog.task_finished", patch, task_id=task_id, result=result)
+
+
+FOG_STATUS = FogStatus()
@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from typing import Optional, Dict, Any
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+class FogTracer:
+    """
+    单任务时间线追踪（需在配置中开启）
+
+    按 task_id 收集任务各阶段的时间段：任务获取及租约 HTTP 请求、模型准备、校验、提交、
+    ComfyUI 排队及各节点执行（来自执行事件）、转码、上传，任务结束后以 Chrome trace event 格式
+    写入 trace_dir/<task_id>.json，可直接用 chrome://tracing 或 Perfetto 打开。
+    只保留最近 max_traces 个文件。未开启时各记录方法直接返回，没有额外开销。
+    """
+    # 时间线中的泳道
+    LANES = {
+        "task_center": 1,
+        "inference": 2,
+        "comfyui": 3,
+        "transcode": 4,
+        "upload": 5,
+    }
+
+    # 未结束任务的最大数量，避免异常丢失的任务无限占用内存
+    MAX_ACTIVE = 256
+
+    def __init__(self, trace_dir: str, max_traces: int = 50, enabled: bool = False):
+        self.trace_dir = trace_dir
+        self.max_traces = max_traces
+        self.enabled = enabled
+        self.active: OrderedDict = OrderedDict()    # task_id -> [event]
+        self.finished = deque()                      # 已写入文件的 task_id，按完成顺序
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def configure(self, enabled: bool, max_traces: int = 50):
+        self.enabled = enabled
+        self.max_traces = max(1, max_traces)
+
+    @staticmethod
+    def _file_name(task_id: str) -> str:
+        return re.sub(r'[^0-9A-Za-z_.-]', '_', str(task_id)) + ".json"
+
+    def add(self, task_id: Optional[str], name: str, lane: str, start: float, end: float, **args):
+        """记录一个时间段，start/end 为 time.time() 时间戳"""
+        if not self.enabled or not task_id:
+            return
+        event = {
+            "name": name,
+            "cat": lane,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": max(0, int((end - start) * 1e6)),
+            "pid": 1,
+            "tid": self.LANES.get(lane, 0),
+        }
+        if args:
+            event["args"] = args
+        self._append(task_id, event)
+
+    def instant(self, task_id: Optional[str], name: str, lane: str, at: Optional[float] = None, **args):
+        """记录一个时间点"""
+        if not self.enabled or not task_id:
+            return
+        event = {
+            "name": name,
+            "cat": lane,
+            "ph": "i",
+            "s": "t",
+            "ts": int((at or time.time()) * 1e6),
+            "pid": 1,
+            "tid": self.LANES.get(lane, 0),
+        }
+        if args:
+            event["args"] = args
+        self._append(task_id, event)
+
+    @contextmanager
+    def span(self, task_id: Optional[str], name: str, lane: str, **args):
+        """记录 with 块的时间段"""
+        if not self.enabled or not task_id:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(task_id, name, lane, start, time.time(), **args)
+
+    def _append(self, task_id: str, event: Dict[str, Any]):
+        with self.lock:
+            events = self.active.get(task_id)
+            if events is None:
+                events = self.active[task_id] = []
+                while len(self.active) > self.MAX_ACTIVE:
+                    self.active.popitem(last=False)
+            events.append(event)
+
+    def _build(self, task_id: str, events: list, status: Optional[str] = None) -> Dict[str, Any]:
+        metadata = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"task {task_id}"}}]
+        for lane, tid in self.LANES.items():
+            metadata.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": lane}})
+            metadata.append({"name": "thread_sort_index", "ph": "M", "pid": 1, "tid": tid, "args": {"sort_index": tid}})
+        trace = {
+            "traceEvents": metadata + sorted(events, key=lambda e: e["ts"]),
+            "displayTimeUnit": "ms",
+            "otherData": {"task_id": task_id}
+        }
+        if status:
+            trace["otherData"]["status"] = status
+        return trace
+
+    def _load_finished(self):
+        """启动后首次使用时，按修改时间载入已有的 trace 文件"""
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.isdir(self.trace_dir):
+            return
+        names = [n for n in os.listdir(self.trace_dir) if n.endswith(".json")]
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(self.trace_dir, n)))
+        self.finished.extend(n[:-len(".json")] for n in names)
+
+    def finish(self, task_id: Optional[str], status: str = "completed"):
+        """任务结束，写入 trace 文件，超出 max_traces 时删除最早的文件"""
+        if not self.enabled or not task_id:
+            return
+        with self.lock:
+            events = self.active.pop(task_id, None)
+        if not events:
+            return
+
+        trace = self._build(task_id, events, status)
+        try:
+            # 先载入已有文件，否则刚写入的文件会被载入一次后再次加入
+            with self.lock:
+                self._load_finished()
+            os.makedirs(self.trace_dir, exist_ok=True)
+            name = self._file_name(task_id)
+            with open(os.path.join(self.trace_dir, name), 'w') as f:
+                json.dump(trace, f)
+
+            with self.lock:
+                stem = name[:-len(".json")]
+                # 同一任务再次结束（如释放后重新获取）时覆盖原文件，只保留一项
+                if stem in self.finished:
+                    self.finished.remove(stem)
+                self.finished.append(stem)
+                expired = []
+                while len(self.finished) > self.max_traces:
+                    expired.append(self.finished.popleft())
+            for old in expired:
+                try:
+                    os.remove(os.path.join(self.trace_dir, old + ".json"))
+                except OSError:
+                    pass
+        except Exception as e:
+            logger.error(f"Failed to write trace for task {task_id}: {e}")
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """获取任务 trace，未结束的任务返回当前已记录的部分"""
+        with self.lock:
+            events = list(self.active.get(task_id) or [])
+        if events:
+            return self._build(task_id, events, "running")
+
+        path = os.path.join(self.trace_dir, self._file_name(task_id))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+
+FOG_TRACER = FogTracer(os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces"))
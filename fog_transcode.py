@@ -0,0 +1,163 @@
+import io
+import os
+import logging
+
+from typing import Optional, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "avif": "image/avif",
+}
+
+# ComfyUI 保存 WebP 元数据使用的 EXIF 标签，prompt 写入 0x0110，其余依次递减
+EXIF_PROMPT_TAG = 0x0110
+
+
+def normalize_format(output_format: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    规范化任务中的 output_format，无需转码时返回 None
+    格式: {"format": "webp", "quality": 90, "keep_metadata": true}
+    """
+    if not output_format:
+        return None
+    fmt = str(output_format.get("format", "png")).lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt == "png" or fmt not in CONTENT_TYPES:
+        return None
+    return {
+        "format": fmt,
+        "quality": int(output_format.get("quality", 90)),
+        "keep_metadata": bool(output_format.get("keep_metadata", False)),
+    }
+
+
+def transcode_image(data: bytes, fmt: str, quality: int, keep_metadata: bool) -> bytes:
+    """
+    PNG 转码为 webp/jpeg/avif，在转码线程中执行
+
+    keep_metadata 时将 PNG 文本块（prompt、workflow）按 ComfyUI 的方式写入 EXIF
+    """
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    img.load()
+
+    params = {"quality": quality}
+    if keep_metadata and getattr(img, "text", None):
+        exif = Image.Exif()
+        tag = EXIF_PROMPT_TAG
+        for key, value in img.text.items():
+            exif[tag] = f"{key}:{value}"
+            tag -= 1
+        params["exif"] = exif.tobytes()
+
+    if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if fmt == "webp":
+        params["method"] = 4
+
+    output = io.BytesIO()
+    img.save(output, format=fmt.upper(), **params)
+    return output.getvalue()
+
+
+class FogTranscoder:
+    """
+    输出图片转码，在线程池中执行，不占用推理线程
+
+    Pillow 编码时释放 GIL，多个线程可并行编码。不使用进程池：进程池在首次转码时创建，
+    此时进程中已有多个线程并已初始化 CUDA，fork 可能继承其他线程持有的锁而死锁；
+    spawn / forkserver 的子进程会重新执行 ComfyUI 的 main.py，Windows 上也只能使用 spawn。
+    线程池在首次转码时才创建，Pillow 不可用时不转码，上传原图。
+    """
+    def __init__(self, workers: int = 2):
+        self.workers = max(1, workers)
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.available: Optional[bool] = None
+
+    def _get_pool(self) -> Optional[ThreadPoolExecutor]:
+        if self.available is None:
+            try:
+                import PIL.Image  # noqa: F401
+                self.available = True
+            except ImportError:
+                logger.warning("Pillow is not available, output images will not be transcoded")
+                self.available = False
+        if not self.available:
+            return None
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="FogTranscodeWorker")
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def transcode(self, meta: Dict[str, Any], images: Dict[str, Any], output_format: Dict[str, Any], store) -> Dict[str, Any]:
+        """
+        转码任务的全部输出图片，各图片并行转码
+
+        Args:
+            meta: 任务 meta，task_id 用于生成转码结果的引用
+            images: {node: {'url': [...], 'file': [...]}}，file 为本地路径或 mem:// 引用
+            output_format: normalize_format 的结果
+            store: FogImageStore，源图片从中读取，转码结果写入其中
+
+        Returns:
+            新的 images，file 为转码结果的 mem:// 引用，并带有 content_type；
+            单张图片转码失败时保留原图
+        """
+        fmt = output_format["format"]
+        pool = self._get_pool()
+        if pool is None:
+            return images
+
+        jobs = []
+        for node, details in images.items():
+            for index, file in enumerate(details.get('file', [])):
+                source = store.open(file) if store.is_ref(file) else open(file, 'rb')
+                if hasattr(source, 'read'):
+                    with source:
+                        source = source.read()
+                future = pool.submit(transcode_image, source, fmt, output_format["quality"], output_format["keep_metadata"])
+                jobs.append((node, index, file, future))
+
+        result = {}
+        for node, details in images.items():
+            files = details.get('file', [])
+            result[node] = {
+                'url': list(details.get('url', [])),
+                'file': list(files),
+                'content_type': list(details.get('content_type', [CONTENT_TYPES["png"]] * len(files)))
+            }
+
+        key = f"{meta.get('task_id')}-{fmt}"
+        for node, index, file, future in jobs:
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.warning(f"Transcode {file} to {fmt} failed, upload original: {e}")
+                continue
+
+            result[node]['file'][index] = store.add(key, node, index, data)
+            result[node]['content_type'][index] = CONTENT_TYPES[fmt]
+
+            # 原图不再需要
+            if store.is_ref(file):
+                store.discard(file)
+            else:
+                try:
+                    os.remove(file)
+                except OSError as e:
+                    logger.error(f"Error deleting file {file}: {e}")
+
+        return result
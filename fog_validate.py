@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from typing import Optional
+from collections import OrderedDict
+
+
+logger = logging.getLogger('ComfyFog')
+
+
+# 自由文本输入，不同任务通常只是提示词不同，不影响校验结果
+VOLATILE_TEXT_INPUTS = {"text", "text_g", "text_l", "prompt", "positive", "negative", "string", "fog_capture_key"}
+
+
+def workflow_fingerprint(workflow: dict) -> str:
+    """
+    计算 workflow 的图结构指纹
+    包含节点 id、class_type、连线以及模型/文件等字符串取值；
+    数值（seed、steps、cfg 等）只保留类型，自由文本输入忽略取值，
+    因此同一模板仅参数不同的任务具有相同指纹。
+    """
+    normalized = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        inputs = {}
+        for name, value in (node.get("inputs") or {}).items():
+            if isinstance(value, bool):
+                inputs[name] = value
+            elif isinstance(value, (int, float)):
+                inputs[name] = f"<{type(value).__name__}>"
+            elif isinstance(value, str) and name in VOLATILE_TEXT_INPUTS:
+                inputs[name] = "<str>"
+            else:
+                inputs[name] = value  # 连线 [node_id, index]、模型文件名、下拉选项等
+        normalized[node_id] = [node.get("class_type"), inputs]
+
+    data = json.dumps(normalized, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class ValidationCache:
+    """
+    workflow 校验结果的 LRU 缓存，按图结构指纹索引
+    只缓存校验通过的结果；节点映射或 folder_paths 中的模型目录发生变化时整体失效。
+    """
+    def __init__(self, max_size: int = 64):
+        self.max_size = max(1, max_size)
+        self.cache: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.env_token = None
+        self.hits = 0
+        self.misses = 0
+
+    def _environment_token(self):
+        """
+        节点映射及模型目录的状态标识
+        目录新增/删除文件会改变其 mtime，只需 stat 目录本身，不必列出 s3fs 上的文件
+        """
+        import nodes
+        import folder_paths
+
+        token = [id(nodes.NODE_CLASS_MAPPINGS), len(nodes.NODE_CLASS_MAPPINGS)]
+        for folder_name, (paths, _) in folder_paths.folder_names_and_paths.items():
+            for path in paths:
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtime = None
+                token.append((folder_name, path, mtime))
+        return hash(tuple(token))
+
+    def _check_environment(self):
+        """环境变化时清空缓存，需在持有锁时调用"""
+        token = self._environment_token()
+        if token != self.env_token:
+            if self.cache:
+                logger.debug(f"Validation cache invalidated, {len(self.cache)} entries dropped")
+            self.cache.clear()
+            self.env_token = token
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self.lock:
+            self._check_environment()
+            valid = self.cache.get(key)
+            if valid is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return (valid[0], valid[1], list(valid[2]), valid[3])
+
+    def put(self, key: str, valid: tuple):
+        if not valid[0]:
+            return
+        with self.lock:
+            self._check_environment()
+            self.cache[key] = (valid[0], valid[1], list(valid[2]), valid[3])
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.cache), "hits": self.hits, "misses": self.misses}
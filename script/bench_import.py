@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+ComfyFog 插件导入耗时测试，即插件给 ComfyUI 启动增加的时间
+
+    python script/bench_import.py --comfy /data/ComfyUI --repeat 5
+
+每次在新的子进程中：先导入 ComfyUI 启动时已加载的模块（folder_paths、server、nodes 等，不计入），
+再按 ComfyUI 加载 custom_nodes 的方式导入本插件并计时，输出各次耗时及中位数。
+--importtime 使用 python -X importtime 列出插件导入期间自身耗时最多的模块。
+--startup 额外测试 FogManager 的创建耗时（会连接任务中心、启动工作线程）。
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MARKER = "--comfyfog-import-start--"
+
+# 子进程中执行的测试代码
+CHILD = r"""
+import os, sys, time, json, importlib.util
+
+comfy_root, plugin, marker, startup = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4] == "1"
+os.chdir(comfy_root)
+sys.path.insert(0, comfy_root)
+
+# ComfyUI 启动时已加载的模块，不计入插件耗时
+start = time.perf_counter()
+import folder_paths, execution, server, nodes
+comfy_seconds = time.perf_counter() - start
+
+sys.stderr.write(marker + "\n")
+sys.stderr.flush()
+
+name = os.path.basename(plugin)
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location(name, os.path.join(plugin, "__init__.py"),
+                                              submodule_search_locations=[plugin])
+module = importlib.util.module_from_spec(spec)
+sys.modules[name] = module
+spec.loader.exec_module(module)
+plugin_seconds = time.perf_counter() - start
+
+startup_seconds = None
+if startup:
+    manager_module = importlib.import_module(name + ".fog_manager")
+    start = time.perf_counter()
+    manager = manager_module.get_fog_manager()
+    startup_seconds = time.perf_counter() - start
+    manager.running = False
+
+print(json.dumps({"comfy": comfy_seconds, "plugin": plugin_seconds, "startup": startup_seconds}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+
+def run_once(comfy: str, plugin: str, importtime: bool, startup: bool):
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", CHILD, comfy, plugin, MARKER, "1" if startup else "0"]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        raise RuntimeError(f"Benchmark process failed:\n{result.stderr[-4000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(stderr: str, top: int):
+    """插件导入期间 -X importtime 的输出，按模块自身耗时排序"""
+    lines = stderr.split(MARKER, 1)[-1].splitlines()
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+            modules.append((int(self_us), int(cumulative_us), module.rstrip()))
+        except ValueError:
+            continue
+    modules.sort(reverse=True)
+    return modules[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time ComfyFog adds to ComfyUI boot")
+    parser.add_argument("--comfy", default=os.path.dirname(os.path.dirname(PLUGIN_DIR)),
+                        help="ComfyUI root directory, default is the parent of custom_nodes")
+    parser.add_argument("--plugin", default=PLUGIN_DIR, help="ComfyFog plugin directory")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs")
+    parser.add_argument("--importtime", action="store_true", help="list the slowest modules imported by the plugin")
+    parser.add_argument("--top", type=int, default=20, help="number of modules listed with --importtime")
+    parser.add_argument("--startup", action="store_true", help="also measure FogManager creation")
+    args = parser.parse_args()
+
+    runs = []
+    for i in range(args.repeat):
+        timing, _ = run_once(args.comfy, args.plugin, False, args.startup)
+        runs.append(timing)
+        startup = f", FogManager {timing['startup'] * 1000:.0f}ms" if timing["startup"] is not None else ""
+        print(f"run {i + 1}: ComfyUI modules {timing['comfy'] * 1000:.0f}ms, ComfyFog import {timing['plugin'] * 1000:.1f}ms{startup}")
+
+    print(f"\nComfyFog import median: {statistics.median(r['plugin'] for r in runs) * 1000:.1f}ms "
+          f"(min {min(r['plugin'] for r in runs) * 1000:.1f}ms, max {max(r['plugin'] for r in runs) * 1000:.1f}ms)")
+    if args.startup:
+        print(f"FogManager startup median: {statistics.median(r['startup'] for r in runs) * 1000:.0f}ms")
+
+    if args.importtime:
+        _, stderr = run_once(args.comfy, args.plugin, True, False)
+        print("\nSlowest modules imported by ComfyFog (self / cumulative, ms):")
+        for self_us, cumulative_us, module in parse_importtime(stderr, args.top):
+            print(f"{self_us / 1000:8.1f} {cumulative_us / 1000:8.1f}  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+本地模型桶模拟服务，用于在无远程模型存储时联调 FogModelCache
+
+    python script/mock_model_bucket.py --root /data/models --port 8901
+
+目录结构与 ComfyUI models 目录相同（<root>/checkpoints/xxx.safetensors），
+然后将 config.json 中 model_cache.base_url 设置为 http://127.0.0.1:8901
+
+支持接口：
+    GET  /manifest.json     模型清单，启动时计算各文件 sha256
+    HEAD /<folder>/<name>   文件大小
+    GET  /<folder>/<name>   文件下载，支持 Range: bytes=a-b
+
+--latency 为每个请求增加延迟，--rate 限制每个连接的速率(MB/s)，用于观察并行 Range 下载的效果；
+--no-range 模拟不支持 Range 的存储。
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import urllib.parse
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def build_manifest(root):
+    """扫描 root 下各模型目录，生成 {folder: {name: {size, sha256, path}}}"""
+    manifest = {}
+    for folder in sorted(os.listdir(root)):
+        folder_path = os.path.join(root, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for dirpath, _, filenames in os.walk(folder_path):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, folder_path).replace(os.sep, "/")
+                sha = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                        sha.update(block)
+                manifest.setdefault(folder, {})[name] = {
+                    "size": os.path.getsize(path),
+                    "sha256": sha.hexdigest(),
+                    "path": f"{folder}/{name}"
+                }
+                print(f"[mock_model_bucket] {folder}/{name} {sha.hexdigest()}")
+    return manifest
+
+
+def make_handler(root, manifest, latency, rate, support_range):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _resolve(self):
+            path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip("/")
+            full_path = os.path.abspath(os.path.join(root, path))
+            if not full_path.startswith(os.path.abspath(root) + os.sep) or not os.path.isfile(full_path):
+                return None
+            return full_path
+
+        def _send_error(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_HEAD(self):
+            full_path = self._resolve()
+            if full_path is None:
+                return self._send_error(404)
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(full_path)))
+            if support_range:
+                self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+
+            if urllib.parse.urlparse(self.path).path == "/manifest.json":
+                body = json.dumps(manifest).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            full_path = self._resolve()
+            if full_path is None:
+                return self._send_error(404)
+
+            size = os.path.getsize(full_path)
+            first, last = 0, size - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+            if support_range and match:
+                first = int(match.group(1))
+                last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                if first > last:
+                    return self._send_error(416)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(last - first + 1))
+            if support_range:
+                self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+
+            with open(full_path, "rb") as f:
+                f.seek(first)
+                remaining = last - first + 1
+                while remaining > 0:
+                    block = f.read(min(1024 * 1024, remaining))
+                    if not block:
+                        break
+                    self.wfile.write(block)
+                    remaining -= len(block)
+                    if rate:
+                        time.sleep(len(block) / (rate * 1024 * 1024))
+
+        def log_message(self, format, *args):
+            print("[mock_model_bucket] " + format % args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyFog mock model bucket")
+    parser.add_argument("--root", required=True, help="模型根目录，子目录为 checkpoints、loras 等")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=0, help="每个请求的额外延迟(秒)")
+    parser.add_argument("--rate", type=float, default=0, help="每个连接的速率上限(MB/s)，0 为不限速")
+    parser.add_argument("--no-range", action="store_true", help="模拟不支持 Range 请求的存储")
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.root)
+    handler = make_handler(args.root, manifest, args.latency, args.rate, not args.no_range)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Mock model bucket running at http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
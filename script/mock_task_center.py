@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""
+本地任务中心模拟服务，用于在无远程任务中心时联调 ComfyFog
+
+    python script/mock_task_center.py --workflow workflow_api.json --tasks 10 --port 8900
+
+然后将 config.json 中 task_center_url 设置为 http://127.0.0.1:8900/schedule/task
+
+支持接口：
+    GET  /schedule/task/get             单任务获取，?wait=N 长轮询，无任务返回 204
+    POST /schedule/task/lease           批量租约获取，支持 wait 长轮询
+    POST /schedule/task/lease/renew     租约续约
+    POST /schedule/task/lease/release   租约释放
+    POST /schedule/task/upload          图片上传，保存到 --output 目录
+
+所有响应带 X-Fog-Long-Poll: 1 头，--no-long-poll 可模拟不支持长轮询的任务中心；
+--arrival N 每 N 秒生成一个新任务，用于观察长轮询/退避下的任务获取延迟。
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.parse
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+PREFIX = "/schedule/task"
+
+
+class TaskCenter:
+    """内存任务池，租约到期的任务自动回到待分配状态"""
+    def __init__(self, workflow, tasks, output_dir):
+        self.lock = threading.Condition()
+        self.output_dir = output_dir
+        self.pending = []
+        self.leased = {}        # task_id -> (task, lease_expire_at)
+        for _ in range(tasks):
+            self.add_task(workflow)
+
+    def add_task(self, workflow):
+        workflow = json.loads(json.dumps(workflow))
+        # 随机化 seed，模拟同模板不同参数的任务
+        for node in workflow.values():
+            inputs = node.get("inputs", {})
+            for key in ("seed", "noise_seed"):
+                if key in inputs:
+                    inputs[key] = random.randint(0, 2**32)
+        with self.lock:
+            self.pending.append({
+                "task_id": uuid.uuid4().hex,
+                "workflow": workflow,
+                "create_at": int(time.time()),
+                "priority": 0
+            })
+            self.lock.notify_all()
+
+    def _expire(self):
+        now = time.time()
+        for task_id, (task, expire_at) in list(self.leased.items()):
+            if expire_at < now:
+                del self.leased[task_id]
+                self.pending.append(task)
+
+    def lease(self, max_tasks, lease_seconds, wait=0):
+        with self.lock:
+            self._expire()
+            if wait:
+                self.lock.wait_for(lambda: self.pending, timeout=wait)
+            tasks = []
+            while self.pending and len(tasks) < max_tasks:
+                task = self.pending.pop(0)
+                expire_at = time.time() + lease_seconds
+                self.leased[task["task_id"]] = (task, expire_at)
+                tasks.append(dict(task, lease_expire_at=expire_at))
+            return tasks
+
+    def renew(self, task_ids, lease_seconds):
+        with self.lock:
+            leases = {}
+            for task_id in task_ids:
+                if task_id in self.leased:
+                    task, _ = self.leased[task_id]
+                    self.leased[task_id] = (task, time.time() + lease_seconds)
+                    leases[task_id] = self.leased[task_id][1]
+            return leases
+
+    def release(self, task_ids):
+        with self.lock:
+            for task_id in task_ids:
+                if task_id in self.leased:
+                    task, _ = self.leased.pop(task_id)
+                    self.pending.append(task)
+            self.lock.notify_all()
+
+    def complete(self, task_id):
+        with self.lock:
+            self.leased.pop(task_id, None)
+
+
+def make_handler(center: TaskCenter, long_poll: bool):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if long_poll:
+                self.send_header("X-Fog-Long-Poll", "1")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length)
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path == f"{PREFIX}/get":
+                query = dict(urllib.parse.parse_qsl(url.query))
+                wait = float(query.get("wait", 0)) if long_poll else 0
+                tasks = center.lease(1, 3600, wait)
+                if not tasks:
+                    self.send_response(204)
+                    if long_poll:
+                        self.send_header("X-Fog-Long-Poll", "1")
+                    self.end_headers()
+                    return
+                return self._send_json(tasks[0])
+            self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            body = self._read_body()
+
+            if url.path == f"{PREFIX}/lease":
+                req = json.loads(body or b"{}")
+                wait = req.get("wait", 0) if long_poll else 0
+                tasks = center.lease(req.get("max_tasks", 1), req.get("lease_seconds", 300), wait)
+                return self._send_json({"tasks": tasks})
+
+            if url.path == f"{PREFIX}/lease/renew":
+                req = json.loads(body or b"{}")
+                leases = center.renew(req.get("task_ids", []), req.get("lease_seconds", 300))
+                return self._send_json({"status": "success", "leases": leases})
+
+            if url.path == f"{PREFIX}/lease/release":
+                req = json.loads(body or b"{}")
+                center.release(req.get("task_ids", []))
+                return self._send_json({"status": "success"})
+
+            if url.path == f"{PREFIX}/upload":
+                query = dict(urllib.parse.parse_qsl(url.query))
+                task_id = query.get("task_id", "unknown")
+                name = f"{task_id}_{query.get('node')}_{query.get('index')}"
+                os.makedirs(center.output_dir, exist_ok=True)
+                with open(os.path.join(center.output_dir, name), "wb") as f:
+                    f.write(body)
+                center.complete(task_id)
+                return self._send_json({"status": "success", "size": len(body)})
+
+            self._send_json({"error": "not found"}, 404)
+
+        def log_message(self, format, *args):
+            print("[mock_task_center] " + format % args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyFog mock task center")
+    parser.add_argument("--workflow", required=True, help="ComfyUI API 格式的 workflow 文件")
+    parser.add_argument("--tasks", type=int, default=10, help="生成的任务数")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--output", default="./mock_uploads", help="上传图片保存目录")
+    parser.add_argument("--arrival", type=float, default=0, help="每隔 N 秒生成一个新任务，0 为不生成")
+    parser.add_argument("--no-long-poll", action="store_true", help="模拟不支持长轮询的任务中心")
+    args = parser.parse_args()
+
+    with open(args.workflow, "r") as f:
+        workflow = json.load(f)
+
+    center = TaskCenter(workflow, args.tasks, args.output)
+
+    if args.arrival > 0:
+        def arrival_loop():
+            while True:
+                time.sleep(args.arrival)
+                center.add_task(workflow)
+        threading.Thread(target=arrival_loop, daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(center, not args.no_long_poll))
+    print(f"Mock task center running at http://{args.host}:{args.port}{PREFIX}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -37,8 +37,8 @@ app.registerExtension({
         // 3. 绑定事件处理器
         this.bindEvents();
         
-        // 4. 启动状态更新循环
-        this.startUpdates();
+        // 4. 订阅后端推送的状态事件
+        this.subscribe();
         
         // 5. 记录扩展已加载
         console.log("Fog Control Panel loaded");
@@ -80,6 +80,8 @@ app.registerExtension({
                     <h4>Status</h4>
                     <div>Running: <span id="fog-running-status">No</span></div>
                     <div>Current Task: <span id="fog-current-task">None</span></div>
+                    <div>Progress: <span id="fog-task-progress">-</span></div>
+                    <div>Pending: <span id="fog-pending-tasks">0</span></div>
                 </div>
                 
                 <!-- 控制开关区域 -->
@@ -131,10 +133,11 @@ app.registerExtension({
         const enabledSwitch = document.getElementById('fog-enabled');
         enabledSwitch.addEventListener('change', async (e) => {
             try {
-                // 发送配置更新请求
-                await this.updateConfig({ enabled: e.target.checked });
-                // 更新显示状态
-                await this.updateStatus();
+                // 发送配置更新请求，状态变化由 fog.config 事件推送
+                const result = await this.updateConfig({ enabled: e.target.checked });
+                if (result.status !== 'success') {
+                    throw new Error(result.message);
+                }
             } catch (error) {
                 console.error('Failed to update config:', error);
                 // 更新失败时恢复开关状态
@@ -148,7 +151,7 @@ app.registerExtension({
     },
     
     // 更新状态显示
-    // 从后端获取最新状态并更新UI
+    // 从后端获取完整状态快照，面板打开、版本不连续或重连时调用
     async updateStatus() {
         try {
             const response = await api.fetchApi('/fog/status');
@@ -156,7 +159,11 @@ app.registerExtension({
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
             const data = await response.json();
-            updateUI(data);
+            if (typeof data.status !== 'object') {
+                throw new Error(data.message);
+            }
+            this.status = data.status;
+            this.updateUI(this.status);
         } catch (error) {
             console.error('Error updating status:', error);
             // 显示错误信息给用户
@@ -164,15 +171,92 @@ app.registerExtension({
         }
     },
     
-    // 启动定期更新
-    // 只在面板可见时更新状态
-    startUpdates() {
-        this.updateInterval = setInterval(() => {
-            const panel = document.getElementById('fog-control-panel');
-            if (panel.style.display !== 'none') {
+    // 订阅状态事件
+    // 后端在状态变化时通过ComfyUI的WebSocket推送 fog.* 事件，事件数据为 {version, patch, ...}
+    // patch 为状态快照中变化的顶层字段，按 version 依次合并，不连续时重新获取完整状态
+    subscribe() {
+        const events = ['fog.task_started', 'fog.stage', 'fog.progress', 'fog.task_finished', 'fog.config'];
+        events.forEach(name => {
+            api.addEventListener(name, ({ detail }) => this.applyEvent(detail));
+        });
+        
+        // WebSocket重连期间可能丢失事件
+        api.addEventListener('reconnected', () => {
+            if (this.isPanelVisible()) {
+                this.updateStatus();
+            } else {
+                this.status = null;
+            }
+        });
+    },
+    
+    // 合并一条状态事件
+    applyEvent(detail) {
+        // 尚未获取过完整状态时，面板打开时再获取
+        if (!this.status || !detail) {
+            return;
+        }
+        if (detail.version <= this.status.version) {
+            return;
+        }
+        if (detail.version !== this.status.version + 1) {
+            // 丢失了事件（如 ComfyUI 重启后版本重新计数），重新获取
+            this.status = null;
+            if (this.isPanelVisible()) {
                 this.updateStatus();
             }
-        }, 5000);  // 每5秒更新一次
+            return;
+        }
+        Object.assign(this.status, detail.patch, { version: detail.version });
+        if (this.isPanelVisible()) {
+            this.updateUI(this.status);
+        }
+    },
+    
+    isPanelVisible() {
+        const panel = document.getElementById('fog-control-panel');
+        return panel && panel.style.display !== 'none';
+    },
+    
+    // 按状态快照更新面板
+    updateUI(status) {
+        document.getElementById('fog-running-status').textContent =
+            status.enabled && status.scheduler_active ? (status.connected ? 'Yes' : 'Yes (disconnected)') : 'No';
+        document.getElementById('fog-enabled').checked = !!status.enabled;
+        
+        const task = status.current_task;
+        document.getElementById('fog-current-task').textContent = task ? `${task.id} (${task.stage})` : 'None';
+        document.getElementById('fog-task-progress').textContent =
+            task && task.stage === 'executing' ? `${Math.round(task.progress * 100)}%` : '-';
+        document.getElementById('fog-pending-tasks').textContent = Object.keys(status.tasks || {}).length;
+        
+        this.renderSchedule(status.schedule || []);
+        this.renderHistory(status.recent || []);
+    },
+    
+    // 显示调度时间段，正在编辑时不覆盖
+    renderSchedule(schedule) {
+        const scheduleList = document.getElementById('fog-schedule-list');
+        if (scheduleList.contains(document.activeElement)) {
+            return;
+        }
+        scheduleList.innerHTML = '';
+        schedule.forEach(slot => {
+            const element = this.addScheduleSlot();
+            element.querySelector('.start-time').value = slot.start;
+            element.querySelector('.end-time').value = slot.end;
+        });
+    },
+    
+    // 显示最近结束的任务
+    renderHistory(recent) {
+        const history = document.getElementById('fog-task-history');
+        history.innerHTML = '';
+        recent.forEach(item => {
+            const row = document.createElement('div');
+            row.textContent = `${item.finished_at} ${item.id} ${item.result}`;
+            history.appendChild(row);
+        });
     },
     
     // 更新配置
@@ -212,6 +296,7 @@ app.registerExtension({
         });
         
         scheduleList.appendChild(slot);
+        return slot;
     },
     
     // 保存调度时间设置